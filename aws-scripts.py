@@ -0,0 +1,43 @@
+import argparse
+import sys
+
+from scripts_common import load_script
+
+# The scripts are only loaded when their subcommand runs, so the help and the lightweight subcommands never import boto3
+COMMANDS = {
+    'profiles': {
+        'get': ('aws-sso-profiles-get.py', 'Get the SSO profiles from the AWS CLI configuration file into a CSV file.'),
+        'set': ('aws-sso-profiles-set.py', 'Set the SSO profiles of a CSV file in an AWS CLI configuration file.')
+    },
+    'waf': {
+        'scan': ('waf-coverage-get-info.py', 'Get the WAF association of the entrypoints in every account.'),
+        'coverage': ('waf-coverage-calculate.py', 'Calculate the WAF coverage from a scan.'),
+        'merge': ('waf-coverage-merge.py', 'Merge the outputs of sharded scans.'),
+        'serve': ('waf-coverage-serve.py', 'Serve the WAF coverage over HTTP and refresh it in the background.')
+    }
+}
+
+parser = argparse.ArgumentParser(prog='aws-scripts.py', description='Run the AWS scripts of this repository as subcommands.')
+group_subparsers = parser.add_subparsers(dest='group', required=True)
+for group_name, commands in COMMANDS.items():
+    group_parser = group_subparsers.add_parser(group_name, help=f"{', '.join(commands)}")
+    command_subparsers = group_parser.add_subparsers(dest='command', required=True)
+    for command_name, (filename, description) in commands.items():
+        # Every option after the subcommand belongs to the script, which parses it with its own parser
+        command_subparsers.add_parser(command_name, help=description, add_help=False)
+
+
+def run_command(group_name, command_name, argv):
+    filename = COMMANDS[group_name][command_name][0]
+    script = load_script(filename)
+    script.parser.prog = f'{parser.prog} {group_name} {command_name}'
+    return script.main(argv)
+
+
+def main(argv=None):
+    args, script_argv = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return run_command(args.group, args.command, script_argv)
+
+
+if __name__ == '__main__':
+    main()
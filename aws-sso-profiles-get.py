@@ -2,23 +2,25 @@ import argparse
 import configparser
 import csv
 import os
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-parser = argparse.ArgumentParser(description='Set AWS SSO profiles from a CSV file.')
+parser = argparse.ArgumentParser(description='Get AWS SSO profiles from the AWS CLI configuration file into a CSV file.')
 parser.add_argument('--input-file', default='~/.aws/config', help='Input AWS config file. Default is ~/.aws/config.')
 parser.add_argument('--output-file', default='workspace/aws-profiles.csv', help='Output CSV file. Default is aws-profiles.csv.')
+parser.add_argument('--sso-session', help='Discover the accounts of this sso-session of the input file from IAM Identity Center and merge them into the output file, instead of reading the profiles of the input file.')
+parser.add_argument('--sso-role-name', help='With --sso-session, only keep the accounts where this role is available. Default is any role.')
+parser.add_argument('--sso-cache-dir', default='~/.aws/sso/cache', help='Directory of the SSO token cache written by aws sso login. Default is ~/.aws/sso/cache.')
+parser.add_argument('--max-workers', type=int, default=8, help='Number of accounts whose roles are listed in parallel. Default is 8.')
 
-args = parser.parse_args()
 
-aws_config_filepath = os.path.expanduser(args.input_file)
-output_csv_filepath = os.path.expanduser(args.output_file)
-
-config = configparser.ConfigParser()
-config.read(aws_config_filepath)
-
-with open(output_csv_filepath, mode='w', newline='') as file:
-    writer = csv.writer(file, quoting=csv.QUOTE_ALL)
-    writer.writerow(['sso_session', 'profile_name', 'account_id'])
+def get_sso_profiles(aws_config_filepath):
+    config = configparser.ConfigParser()
+    config.read(aws_config_filepath)
 
+    profiles = []
     for section in config.sections():
         if not section.startswith('profile '):
             continue
@@ -28,4 +30,159 @@ with open(output_csv_filepath, mode='w', newline='') as file:
 
         if sso_session != 'Unknown':
             account_id = config.get(section, 'sso_account_id')
-            writer.writerow([sso_session, profile_name, account_id])
+            profiles.append({ 'sso_session': sso_session, 'profile_name': profile_name, 'account_id': account_id })
+
+    return profiles
+
+
+def read_profiles_csv(csv_filepath):
+    if not os.path.exists(csv_filepath):
+        return []
+
+    with open(csv_filepath, mode='r', newline='') as file:
+        return list(csv.DictReader(file))
+
+
+def write_profiles_csv(output_csv_filepath, profiles):
+    with open(output_csv_filepath, mode='w', newline='') as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        writer.writerow(['sso_session', 'profile_name', 'account_id'])
+
+        for profile_info in profiles:
+            writer.writerow([profile_info['sso_session'], profile_info['profile_name'], profile_info['account_id']])
+
+
+def slugify(name):
+    # Accents are dropped instead of splitting the word, so "Produção" becomes "producao"
+    ascii_name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^a-z0-9]+', '-', ascii_name.lower()).strip('-')
+
+
+def get_sso_session_config(aws_config_filepath, sso_session):
+    config = configparser.ConfigParser()
+    config.read(aws_config_filepath)
+
+    section = f'sso-session {sso_session}'
+    if not config.has_section(section):
+        raise ValueError(f'sso-session not found in {aws_config_filepath}: {sso_session}')
+
+    return { 'sso_start_url': config.get(section, 'sso_start_url'), 'sso_region': config.get(section, 'sso_region') }
+
+
+def load_sso_access_token(sso_cache_dirpath, sso_session, sso_start_url):
+    from botocore.exceptions import SSOTokenLoadError
+    from botocore.utils import JSONFileCache, SSOTokenLoader, parse_timestamp
+
+    # aws sso login caches the token under the session name, and the scripts only read it
+    try:
+        token = SSOTokenLoader(JSONFileCache(sso_cache_dirpath))(sso_start_url, session_name=sso_session)
+    except SSOTokenLoadError:
+        raise ValueError(f'no SSO token for {sso_session}, run: aws sso login --sso-session {sso_session}')
+
+    if parse_timestamp(token['expiresAt']) <= datetime.now(timezone.utc):
+        raise ValueError(f'the SSO token of {sso_session} has expired, run: aws sso login --sso-session {sso_session}')
+
+    return token['accessToken']
+
+
+def create_sso_client(sso_region):
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
+    # The SSO portal API is authorized by the access token, not by signed requests.
+    # Its role listing is throttled at a few calls per second, so the adaptive mode paces the parallel calls.
+    return boto3.Session().client('sso', region_name=sso_region, config=Config(signature_version=UNSIGNED, retries={ 'mode': 'adaptive', 'max_attempts': 10 }))
+
+
+def list_sso_accounts(sso_client, access_token):
+    paginator = sso_client.get_paginator('list_accounts')
+    return [account for page in paginator.paginate(accessToken=access_token) for account in page['accountList']]
+
+
+def list_sso_account_role_names(sso_client, access_token, account_id):
+    paginator = sso_client.get_paginator('list_account_roles')
+    return [role['roleName'] for page in paginator.paginate(accessToken=access_token, accountId=account_id) for role in page['roleList']]
+
+
+def discover_sso_profiles(sso_client, access_token, sso_session, sso_role_name=None, max_workers=8):
+    accounts = list_sso_accounts(sso_client, access_token)
+
+    # Clients are thread-safe, so the role listings of all the accounts share one client
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        role_names_by_account = executor.map(lambda account: list_sso_account_role_names(sso_client, access_token, account['accountId']), accounts)
+
+        profiles = []
+        for account, role_names in zip(accounts, role_names_by_account):
+            if not role_names or (sso_role_name and sso_role_name not in role_names):
+                continue
+
+            profiles.append({
+                'sso_session': sso_session,
+                'profile_name': slugify(account['accountName']) or account['accountId'],
+                'account_id': account['accountId']
+            })
+
+    return sorted(profiles, key=lambda profile_info: profile_info['profile_name'])
+
+
+def merge_sso_profiles(existing_profiles, discovered_profiles, sso_session):
+    # Accounts already in the file keep their profile name, so renaming an account does not break the scripts that use the profile
+    discovered_account_ids = { profile_info['account_id'] for profile_info in discovered_profiles }
+    existing_account_ids = { profile_info['account_id'] for profile_info in existing_profiles if profile_info['sso_session'] == sso_session }
+
+    profiles = []
+    removed_profiles = []
+    for profile_info in existing_profiles:
+        if profile_info['sso_session'] != sso_session or profile_info['account_id'] in discovered_account_ids:
+            profiles.append(profile_info)
+        else:
+            removed_profiles.append(profile_info)
+
+    added_profiles = []
+    profile_names = { profile_info['profile_name'] for profile_info in profiles }
+    for profile_info in discovered_profiles:
+        if profile_info['account_id'] in existing_account_ids:
+            continue
+
+        # Two accounts with the same name get the account ID as a suffix instead of sharing a profile
+        profile_name = profile_info['profile_name']
+        if profile_name in profile_names:
+            profile_name = f"{profile_name}-{profile_info['account_id']}"
+
+        profile_names.add(profile_name)
+        added_profiles.append({ **profile_info, 'profile_name': profile_name })
+
+    return { 'profiles': profiles + added_profiles, 'added': added_profiles, 'removed': removed_profiles }
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    aws_config_filepath = os.path.expanduser(args.input_file)
+    output_csv_filepath = os.path.expanduser(args.output_file)
+
+    if not args.sso_session:
+        write_profiles_csv(output_csv_filepath, get_sso_profiles(aws_config_filepath))
+        return
+
+    try:
+        sso_session_config = get_sso_session_config(aws_config_filepath, args.sso_session)
+        access_token = load_sso_access_token(os.path.expanduser(args.sso_cache_dir), args.sso_session, sso_session_config['sso_start_url'])
+    except Exception as error:
+        parser.error(str(error))
+
+    sso_client = create_sso_client(sso_session_config['sso_region'])
+    discovered_profiles = discover_sso_profiles(sso_client, access_token, args.sso_session, args.sso_role_name, args.max_workers)
+    merged_profiles = merge_sso_profiles(read_profiles_csv(output_csv_filepath), discovered_profiles, args.sso_session)
+    write_profiles_csv(output_csv_filepath, merged_profiles['profiles'])
+
+    print(f"Discovered {len(discovered_profiles)} accounts in {args.sso_session}: {len(merged_profiles['added'])} added, {len(merged_profiles['removed'])} removed")
+    for profile_info in merged_profiles['added']:
+        print(f"  Added: {profile_info['profile_name']} ({profile_info['account_id']})")
+    for profile_info in merged_profiles['removed']:
+        print(f"  Removed: {profile_info['profile_name']} ({profile_info['account_id']})")
+
+
+if __name__ == '__main__':
+    main()
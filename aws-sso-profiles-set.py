@@ -2,33 +2,128 @@ import argparse
 import configparser
 import csv
 import os
+import re
+from collections import defaultdict
 
 parser = argparse.ArgumentParser(description='Set AWS SSO profiles from a CSV file.')
 parser.add_argument('--sso-role-name', required=True, help='SSO role name to be set for each profile.')
-parser.add_argument('--region', default='us-east-1', help='Default AWS region. Default is us-east-1.')
-parser.add_argument('--output', default='json', help='Default output format. Default is json.')
+parser.add_argument('--region', help='Default AWS region. Default is us-east-1, and with --merge the profiles already in the output file keep their own.')
+parser.add_argument('--output', help='Default output format. Default is json, and with --merge the profiles already in the output file keep their own.')
 parser.add_argument('--input-file', default='workspace/aws-profiles.csv', help='Input CSV file. Default is aws-profiles.csv.')
 parser.add_argument('--output-file', default='workspace/aws.config', help='Output AWS config file. Default is aws.config.')
+parser.add_argument('--merge', action='store_true', help='Add and update the profiles of the CSV file in the output file, keeping its other sections, settings and comments, instead of rewriting it.')
 
-args = parser.parse_args()
+DEFAULT_REGION = 'us-east-1'
+DEFAULT_OUTPUT = 'json'
+SECTION_PATTERN = re.compile(r'^\[([^\]]+)\]')
+KEY_PATTERN = re.compile(r'^([^\s=#;\[][^=]*?)\s*=')
 
-input_csv_filepath = os.path.expanduser(args.input_file)
-aws_config_filepath = os.path.expanduser(args.output_file)
 
-config = configparser.ConfigParser()
+def read_profiles_csv(input_csv_filepath):
+    with open(input_csv_filepath, mode='r', newline='') as file:
+        return list(csv.DictReader(file))
 
-with open(input_csv_filepath, mode='r', newline='') as file:
-    reader = csv.DictReader(file)
-    for row in reader:
+
+def generate_aws_config(profiles, sso_role_name, region, output):
+    config = configparser.ConfigParser()
+
+    for row in profiles:
         section_name = f"profile {row['profile_name']}"
         config.add_section(section_name)
 
         config.set(section_name, 'sso_session', row['sso_session'])
         config.set(section_name, 'sso_account_id', row['account_id'])
 
-        config.set(section_name, 'sso_role_name', args.sso_role_name)
-        config.set(section_name, 'region', args.region)
-        config.set(section_name, 'output', args.output)
+        config.set(section_name, 'sso_role_name', sso_role_name)
+        config.set(section_name, 'region', region)
+        config.set(section_name, 'output', output)
+
+    return config
+
+
+def read_aws_config_sections(lines):
+    sections = {}
+    section = None
+
+    for index, line in enumerate(lines):
+        section_match = SECTION_PATTERN.match(line)
+        key_match = KEY_PATTERN.match(line)
+
+        if section_match:
+            section = { 'keys': {}, 'end': index + 1 }
+            sections[section_match.group(1).strip()] = section
+        elif section is not None and key_match:
+            section['keys'][key_match.group(1).lower()] = index
+            section['end'] = index + 1
+        elif section is not None and line[:1].isspace() and line.strip():
+            # Indented lines are the nested values of the key above, like the s3 settings
+            section['end'] = index + 1
+
+    return sections
+
+
+def merge_aws_config(aws_config_filepath, profiles, sso_role_name, region=None, output=None):
+    lines = []
+    if os.path.exists(aws_config_filepath):
+        with open(aws_config_filepath, mode='r') as file:
+            lines = file.read().splitlines()
+
+    # The file is edited line by line instead of rewritten by ConfigParser, so its comments and the order of its settings are kept
+    sections = read_aws_config_sections(lines)
+    inserted_lines = defaultdict(list)
+    new_sections = []
+
+    for row in profiles:
+        section_name = f"profile {row['profile_name']}"
+        settings = { 'sso_session': row['sso_session'], 'sso_account_id': row['account_id'], 'sso_role_name': sso_role_name }
+
+        if section_name not in sections:
+            settings.update({ 'region': region or DEFAULT_REGION, 'output': output or DEFAULT_OUTPUT })
+            new_sections.append([f'[{section_name}]'] + [f'{key} = {value}' for key, value in settings.items()])
+            continue
+
+        # An existing profile keeps its region and output unless they are given, since they are often set by hand
+        if region is not None:
+            settings['region'] = region
+        if output is not None:
+            settings['output'] = output
+
+        section = sections[section_name]
+        for key, value in settings.items():
+            if key in section['keys']:
+                lines[section['keys'][key]] = f'{key} = {value}'
+            else:
+                inserted_lines[section['end']].append(f'{key} = {value}')
+
+    # Lines are inserted from the bottom, so the indexes of the sections above stay valid
+    for index in sorted(inserted_lines, reverse=True):
+        lines[index:index] = inserted_lines[index]
+
+    for section_lines in new_sections:
+        if lines and lines[-1].strip():
+            lines.append('')
+        lines.extend(section_lines)
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    input_csv_filepath = os.path.expanduser(args.input_file)
+    aws_config_filepath = os.path.expanduser(args.output_file)
+
+    profiles = read_profiles_csv(input_csv_filepath)
+    if args.merge:
+        aws_config = merge_aws_config(aws_config_filepath, profiles, args.sso_role_name, args.region, args.output)
+        with open(aws_config_filepath, 'w') as file:
+            file.write(aws_config)
+        return
+
+    config = generate_aws_config(profiles, args.sso_role_name, args.region or DEFAULT_REGION, args.output or DEFAULT_OUTPUT)
+    with open(aws_config_filepath, 'w') as file:
+        config.write(file)
+
 
-with open(aws_config_filepath, 'w') as file:
-    config.write(file)
+if __name__ == '__main__':
+    main()
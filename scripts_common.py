@@ -0,0 +1,45 @@
+import importlib.util
+import os
+
+SCRIPTS_DIRPATH = os.path.dirname(os.path.abspath(__file__))
+SERVICES = ('elb', 'cloudfront', 'apigw')
+GROUP_BY_COLUMNS = ('sso_session', 'profile_prefix', 'profile_name', 'account_id', 'region')
+
+
+def load_script(filename):
+    # The scripts have hyphens in their names, so they are loaded from their path instead of imported
+    module_name = os.path.splitext(filename)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPTS_DIRPATH, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def add_scan_arguments(parser, retry_budget_scope='the whole scan'):
+    # Options of the scan shared by waf-coverage-get-info.py and waf-coverage-serve.py
+    parser.add_argument('--input-file', default='workspace/aws-profiles.csv', help='Input CSV file. Default is aws-profiles.csv.')
+    parser.add_argument('--max-workers', type=int, default=1, help='Number of accounts scanned in parallel. Default is 1.')
+    parser.add_argument('--max-resource-workers', type=int, default=4, help='Number of per-resource calls, like stages and WAF lookups, made in parallel inside each collector. Default is 4.')
+    parser.add_argument('--waf-index', action='store_true', help='Resolve WAF associations from an index built once per account instead of one lookup per resource.')
+    parser.add_argument('--web-acl-cache-file', default='workspace/web-acl-name-cache.json', help='WebACL name cache file. Default is web-acl-name-cache.json.')
+    parser.add_argument('--checkpoint-dir', help='Directory for per-account checkpoint shards. Default is the output file name with a -checkpoints suffix.')
+    parser.add_argument('--rate-limit', type=float, default=10.0, help='Initial requests per second for each account, region and service. Default is 10.')
+    parser.add_argument('--max-rate-limit', type=float, default=50.0, help='Highest requests per second the rate limiter speeds up to. Default is 50.')
+    parser.add_argument('--max-attempts', type=int, default=10, help='Maximum attempts for a single AWS call. Default is 10.')
+    parser.add_argument('--retry-budget', type=int, default=1000, help=f'Maximum retries for {retry_budget_scope}. Default is 1000.')
+    parser.add_argument('--regions', type=lambda value: value.split(','), help='Comma-separated regions to scan, or "all" for every enabled region. Default is the profile region.')
+    parser.add_argument('--services', type=lambda value: value.split(','), default=list(SERVICES), help='Comma-separated resource families to scan: elb, cloudfront, apigw. The files of the other services are written with only the header. Default is all.')
+
+
+def add_group_by_argument(parser):
+    parser.add_argument('--group-by', type=lambda value: value.split(','), default=['profile_prefix'], help=f"Comma-separated columns the coverage is grouped by: {', '.join(GROUP_BY_COLUMNS)}. Default is profile_prefix.")
+
+
+def validate_services(parser, services):
+    if not set(services) <= set(SERVICES):
+        parser.error(f"invalid --services: {','.join(services)}")
+
+
+def validate_group_by(parser, group_by):
+    if not set(group_by) <= set(GROUP_BY_COLUMNS):
+        parser.error(f"invalid --group-by: {','.join(group_by)}")
@@ -0,0 +1,52 @@
+import pytest
+
+from scripts_common import load_script
+
+
+@pytest.fixture(scope='session')
+def scanner():
+    return load_script('waf-coverage-get-info.py')
+
+
+@pytest.fixture(scope='session')
+def merger():
+    return load_script('waf-coverage-merge.py')
+
+
+@pytest.fixture(scope='session')
+def calculator():
+    return load_script('waf-coverage-calculate.py')
+
+
+@pytest.fixture(scope='session')
+def profiles_getter():
+    return load_script('aws-sso-profiles-get.py')
+
+
+@pytest.fixture(scope='session')
+def profiles_setter():
+    return load_script('aws-sso-profiles-set.py')
+
+
+@pytest.fixture
+def create_stubbed_client():
+    import botocore.session
+    from botocore.stub import Stubber
+
+    stubbers = []
+
+    # Clients get fake credentials, and every call must be answered by a stubbed response
+    def create(service_name, region_name='us-east-1'):
+        client = botocore.session.get_session().create_client(
+            service_name, region_name=region_name, aws_access_key_id='testing', aws_secret_access_key='testing'
+        )
+        stubber = Stubber(client)
+        stubber.activate()
+        stubbers.append(stubber)
+        return client, stubber
+
+    yield create
+
+    for stubber in stubbers:
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
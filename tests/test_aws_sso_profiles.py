@@ -0,0 +1,120 @@
+import hashlib
+import json
+
+import pytest
+
+ACCESS_TOKEN = 'access-token'
+SSO_START_URL = 'https://example.awsapps.com/start'
+
+AWS_CONFIG = """# Managed by hand, keep the sso-session at the end
+[default]
+region = eu-west-1
+
+[profile production]
+# Tuned for large uploads
+sso_session = org
+sso_account_id = 100000000000
+sso_role_name = ReadOnly
+region = sa-east-1
+s3 =
+    max_concurrent_requests = 20
+
+[sso-session org]
+sso_start_url = https://example.awsapps.com/start
+sso_region = us-east-1
+"""
+
+
+def add_sso_accounts(stubber, accounts, role_names_by_account):
+    stubber.add_response(
+        'list_accounts',
+        { 'accountList': [{ 'accountId': account_id, 'accountName': account_name } for account_id, account_name in accounts] },
+        { 'accessToken': ACCESS_TOKEN }
+    )
+    for account_id, account_name in accounts:
+        stubber.add_response(
+            'list_account_roles',
+            { 'roleList': [{ 'roleName': role_name, 'accountId': account_id } for role_name in role_names_by_account[account_id]] },
+            { 'accessToken': ACCESS_TOKEN, 'accountId': account_id }
+        )
+
+
+def test_discover_sso_profiles(profiles_getter, create_stubbed_client):
+    sso_client, stubber = create_stubbed_client('sso')
+    add_sso_accounts(
+        stubber,
+        [('100000000000', 'Produção'), ('100000000001', 'Sandbox'), ('100000000002', 'Audit')],
+        { '100000000000': ['AdministratorAccess', 'ReadOnly'], '100000000001': ['ReadOnly'], '100000000002': [] }
+    )
+
+    # One worker keeps the role listings in the order of the stubbed responses
+    profiles = profiles_getter.discover_sso_profiles(sso_client, ACCESS_TOKEN, 'org', 'AdministratorAccess', max_workers=1)
+
+    assert profiles == [{ 'sso_session': 'org', 'profile_name': 'producao', 'account_id': '100000000000' }]
+
+
+def test_load_sso_access_token_asks_to_log_in(profiles_getter, tmp_path):
+    with pytest.raises(ValueError, match='run: aws sso login --sso-session org'):
+        profiles_getter.load_sso_access_token(str(tmp_path), 'org', SSO_START_URL)
+
+    # aws sso login names the cached token after the SHA-1 of the session name
+    cache_filepath = tmp_path / f"{hashlib.sha1('org'.encode()).hexdigest()}.json"
+    cache_filepath.write_text(json.dumps({ 'startUrl': SSO_START_URL, 'accessToken': ACCESS_TOKEN, 'expiresAt': '2020-01-01T00:00:00Z' }))
+    with pytest.raises(ValueError, match='has expired, run: aws sso login --sso-session org'):
+        profiles_getter.load_sso_access_token(str(tmp_path), 'org', SSO_START_URL)
+
+    cache_filepath.write_text(json.dumps({ 'startUrl': SSO_START_URL, 'accessToken': ACCESS_TOKEN, 'expiresAt': '2999-01-01T00:00:00Z' }))
+    assert profiles_getter.load_sso_access_token(str(tmp_path), 'org', SSO_START_URL) == ACCESS_TOKEN
+
+
+def test_merge_sso_profiles_keeps_existing_names(profiles_getter):
+    existing_profiles = [
+        { 'sso_session': 'org', 'profile_name': 'production', 'account_id': '100000000000' },
+        { 'sso_session': 'org', 'profile_name': 'closed', 'account_id': '100000000009' },
+        { 'sso_session': 'other', 'profile_name': 'sandbox', 'account_id': '200000000000' }
+    ]
+    discovered_profiles = [
+        { 'sso_session': 'org', 'profile_name': 'producao', 'account_id': '100000000000' },
+        { 'sso_session': 'org', 'profile_name': 'sandbox', 'account_id': '100000000001' }
+    ]
+
+    merged_profiles = profiles_getter.merge_sso_profiles(existing_profiles, discovered_profiles, 'org')
+
+    assert merged_profiles['profiles'] == [
+        { 'sso_session': 'org', 'profile_name': 'production', 'account_id': '100000000000' },
+        { 'sso_session': 'other', 'profile_name': 'sandbox', 'account_id': '200000000000' },
+        { 'sso_session': 'org', 'profile_name': 'sandbox-100000000001', 'account_id': '100000000001' }
+    ]
+    assert merged_profiles['removed'] == [existing_profiles[1]]
+
+
+def test_merge_aws_config_keeps_comments_and_hand_set_settings(profiles_setter, tmp_path):
+    aws_config_filepath = tmp_path / 'config'
+    aws_config_filepath.write_text(AWS_CONFIG)
+    profiles = [
+        { 'sso_session': 'org', 'profile_name': 'production', 'account_id': '100000000000' },
+        { 'sso_session': 'org', 'profile_name': 'sandbox', 'account_id': '100000000001' }
+    ]
+
+    aws_config = profiles_setter.merge_aws_config(str(aws_config_filepath), profiles, 'AdministratorAccess')
+
+    # Only the role of the existing profile changes, and the new profile gets the default region and output
+    assert aws_config == AWS_CONFIG.replace('sso_role_name = ReadOnly', 'sso_role_name = AdministratorAccess') + """
+[profile sandbox]
+sso_session = org
+sso_account_id = 100000000001
+sso_role_name = AdministratorAccess
+region = us-east-1
+output = json
+"""
+
+
+def test_merge_aws_config_sets_the_region_when_given(profiles_setter, tmp_path):
+    aws_config_filepath = tmp_path / 'config'
+    aws_config_filepath.write_text(AWS_CONFIG)
+    profiles = [{ 'sso_session': 'org', 'profile_name': 'production', 'account_id': '100000000000' }]
+
+    aws_config = profiles_setter.merge_aws_config(str(aws_config_filepath), profiles, 'ReadOnly', region='us-west-2', output='text')
+
+    assert 'region = us-west-2\ns3 =\n    max_concurrent_requests = 20\noutput = text\n\n[sso-session org]' in aws_config
+    assert aws_config.startswith('# Managed by hand')
@@ -0,0 +1,181 @@
+import csv
+from collections import defaultdict
+from itertools import product
+
+import pytest
+
+BASIC_FIELDNAMES = ['sso_session', 'profile_prefix', 'profile_name', 'account_id', 'region']
+FIELDNAMES = {
+    'elb': BASIC_FIELDNAMES + ['name', 'version', 'type', 'scheme', 'associated_waf', 'waf_version', 'marked_as_waf_ignore'],
+    'cloudfront': BASIC_FIELDNAMES + ['distribution_id', 'distribution_name', 'associated_waf', 'waf_version'],
+    'apigw': BASIC_FIELDNAMES + ['api_gateway_id', 'api_gateway_name', 'protocol', 'endpoint_type', 'stage_name', 'associated_waf', 'waf_version']
+}
+PROD = ['org', 'prod', 'prod-acct', '100000000000', 'us-east-1']
+DEV = ['org', 'dev', 'dev-acct', '200000000000', 'eu-west-1']
+
+# Every combination of the values the coverage rules look at
+RULE_VALUES = {
+    'elb': [
+        [name, 'v2' if elb_type != 'classic' else 'v1', elb_type, scheme, associated_waf, waf_version, marked_as_waf_ignore]
+        for name, (elb_type, scheme, associated_waf, waf_version, marked_as_waf_ignore) in enumerate(product(
+            ('application', 'network', 'classic'), ('internet-facing', 'internal'), ('acl', 'None', 'N/A'), ('v2', 'v1', 'None', 'N/A'), ('False', 'True')
+        ))
+    ],
+    'cloudfront': [
+        [f'D{name}', f'd{name}.cloudfront.net', associated_waf, waf_version]
+        for name, (associated_waf, waf_version) in enumerate(product(('acl', 'None'), ('v2', 'v1', 'None')))
+    ],
+    'apigw': [
+        [f'a{name}', f'api{name}', protocol, endpoint_type, 'prod', associated_waf, waf_version]
+        for name, (protocol, endpoint_type, associated_waf, waf_version) in enumerate(product(
+            ('REST', 'HTTP', 'WEBSOCKET'), ('REGIONAL', 'EDGE', 'PRIVATE'), ('acl', 'None', 'N/A'), ('v2', 'v1', 'None', 'N/A')
+        ))
+    ]
+}
+
+
+def write_scan(csv_filepaths, rows_by_service, fieldnames=FIELDNAMES):
+    for service, csv_filepath in csv_filepaths.items():
+        with open(csv_filepath, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(fieldnames[service])
+            writer.writerows(rows_by_service.get(service, []))
+
+
+def count_per_row(csv_file_path, group_by, is_skipped, has_no_waf):
+    # The per-row loop the coverage was counted with before the columns were encoded
+    total_resources = defaultdict(int)
+    waf_resources = defaultdict(int)
+
+    with open(csv_file_path, mode='r', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            if is_skipped(row):
+                continue
+
+            group_key = tuple(row[column] for column in group_by)
+            total_resources[group_key] += 1
+
+            if has_no_waf(row):
+                continue
+
+            waf_resources[group_key] += 1
+
+    return { 'total_resources': total_resources, 'waf_resources': waf_resources }
+
+
+PER_ROW_RULES = {
+    'cloudfront': (
+        lambda row: False,
+        lambda row: row['waf_version'].lower() == 'v1' or row['associated_waf'].lower() == 'none'
+    ),
+    'elb': (
+        lambda row: row['marked_as_waf_ignore'].lower() == 'true' or row['scheme'].lower() == 'internal' or row['type'].lower() == 'network',
+        lambda row: row['type'].lower() == 'classic' or row['waf_version'].lower() == 'v1' or row['associated_waf'].lower() == 'none'
+    ),
+    'apigw': (
+        lambda row: row['endpoint_type'].lower() == 'private',
+        lambda row: row['protocol'].lower() == 'http' or row['waf_version'].lower() == 'v1' or row['associated_waf'].lower() == 'none'
+    )
+}
+
+
+def write_rule_values_scan(csv_filepaths):
+    # The first rows of each service go to prod and the others to dev, so the groups get different counts
+    rows_by_service = {
+        service: [(PROD if index % 3 else DEV) + [str(value) for value in values] for index, values in enumerate(rule_values)]
+        for service, rule_values in RULE_VALUES.items()
+    }
+    write_scan(csv_filepaths, rows_by_service)
+    return rows_by_service
+
+
+@pytest.mark.parametrize('group_by', [['profile_prefix'], ['region'], ['sso_session', 'account_id'], ['profile_name', 'region', 'profile_prefix']])
+def test_encoded_counts_match_the_per_row_counts(calculator, tmp_path, group_by):
+    csv_filepaths = calculator.generate_csv_filepaths(str(tmp_path / 'waf-coverage.csv'))
+    write_rule_values_scan(csv_filepaths)
+
+    for service, (is_skipped, has_no_waf) in PER_ROW_RULES.items():
+        counts = getattr(calculator, f'count_{service}_with_waf')(csv_filepaths[service], group_by)
+        assert { name: dict(count) for name, count in counts.items() } == { name: dict(count) for name, count in count_per_row(csv_filepaths[service], group_by, is_skipped, has_no_waf).items() }
+
+
+def test_main_rejects_a_group_by_column_missing_from_the_csv(calculator, tmp_path, capsys):
+    csv_filepaths = calculator.generate_csv_filepaths(str(tmp_path / 'waf-coverage.csv'))
+    write_scan(csv_filepaths, {}, { service: [column for column in fieldnames if column != 'sso_session'] for service, fieldnames in FIELDNAMES.items() })
+
+    with pytest.raises(SystemExit):
+        calculator.main(['--input-file', str(tmp_path / 'waf-coverage.csv'), '--group-by', 'sso_session'])
+
+    assert f"{csv_filepaths['cloudfront']} has no sso_session column" in capsys.readouterr().err
+
+
+def test_diff_snapshots_reports_added_removed_and_changed_resources(calculator, tmp_path):
+    old_csv_filepaths = calculator.generate_csv_filepaths(str(tmp_path / 'old.csv'))
+    new_csv_filepaths = calculator.generate_csv_filepaths(str(tmp_path / 'new.csv'))
+    write_scan(old_csv_filepaths, { 'elb': [
+        PROD + ['alb1', 'v2', 'application', 'internet-facing', 'acl', 'v2', 'False'],
+        PROD + ['alb2', 'v2', 'application', 'internet-facing', 'acl', 'v2', 'False'],
+        PROD + ['alb3', 'v2', 'application', 'internet-facing', 'None', 'None', 'False'],
+        PROD + ['nlb1', 'v2', 'network', 'internal', 'N/A', 'N/A', 'False']
+    ] })
+    write_scan(new_csv_filepaths, { 'elb': [
+        PROD + ['alb1', 'v2', 'application', 'internet-facing', 'None', 'None', 'False'],
+        PROD + ['alb3', 'v2', 'application', 'internet-facing', 'None', 'None', 'False'],
+        PROD + ['nlb1', 'v2', 'network', 'internal', 'N/A', 'N/A', 'False'],
+        PROD + ['alb4', 'v2', 'application', 'internet-facing', 'acl', 'v2', 'False']
+    ] })
+
+    snapshot_diff = calculator.diff_snapshots(calculator.load_snapshot(old_csv_filepaths), calculator.load_snapshot(new_csv_filepaths))
+
+    # The prod coverage was 2 of 3, so losing alb1 alone would take it to 1 of 3, and so on
+    changes = [(change['change'], change['key'][-1], change['old_status'], change['new_status'], round(change['coverage_delta'], 2)) for change in snapshot_diff['changes']]
+    assert changes == [
+        ('changed', 'alb1', 'protected', 'unprotected', -33.33),
+        ('removed', 'alb2', 'protected', 'absent', -16.67),
+        ('added', 'alb4', 'absent', 'protected', 8.33)
+    ]
+    assert snapshot_diff['changes'][0]['fields'] == { 'associated_waf': ('acl', 'None'), 'waf_version': ('v2', 'None') }
+    assert (snapshot_diff['old']['waf_resources'][('prod',)], snapshot_diff['old']['total_resources'][('prod',)]) == (2, 3)
+    assert (snapshot_diff['new']['waf_resources'][('prod',)], snapshot_diff['new']['total_resources'][('prod',)]) == (1, 3)
+
+
+def test_main_rejects_a_diff_input_file_without_the_region_column(calculator, tmp_path, capsys):
+    old_csv_filepaths = calculator.generate_csv_filepaths(str(tmp_path / 'old.csv'))
+    new_csv_filepaths = calculator.generate_csv_filepaths(str(tmp_path / 'new.csv'))
+    write_scan(old_csv_filepaths, {}, { service: [column for column in fieldnames if column != 'region'] for service, fieldnames in FIELDNAMES.items() })
+    write_scan(new_csv_filepaths, {})
+
+    with pytest.raises(SystemExit):
+        calculator.main(['--input-file', str(tmp_path / 'new.csv'), '--diff-input-file', str(tmp_path / 'old.csv')])
+
+    assert f"{old_csv_filepaths['elb']} has no region column" in capsys.readouterr().err
+
+
+def test_sqlite_counts_match_the_csv_counts(scanner, calculator, tmp_path):
+    csv_filepaths = calculator.generate_csv_filepaths(str(tmp_path / 'waf-coverage.csv'))
+    rows_by_service = write_rule_values_scan(csv_filepaths)
+
+    connection, snapshot_id = scanner.open_sqlite_snapshot(str(tmp_path / 'waf-coverage.db'), list(RULE_VALUES))
+    for service, rows in rows_by_service.items():
+        for row in rows:
+            scanner.insert_sqlite_row(connection, snapshot_id, service, row)
+    scanner.complete_sqlite_snapshot(connection, snapshot_id)
+
+    for group_by in (['profile_prefix'], ['account_id', 'region']):
+        for service in RULE_VALUES:
+            csv_counts = getattr(calculator, f'count_{service}_with_waf')(csv_filepaths[service], group_by)
+            sqlite_counts = getattr(calculator, f'count_{service}_with_waf_from_sqlite')(connection, snapshot_id, group_by)
+            assert { name: dict(counts) for name, counts in csv_counts.items() } == { name: dict(counts) for name, counts in sqlite_counts.items() }
+
+    connection.close()
+
+
+def test_main_rejects_a_missing_sqlite_file(calculator, tmp_path, capsys):
+    sqlite_filepath = tmp_path / 'missing.db'
+
+    with pytest.raises(SystemExit):
+        calculator.main(['--sqlite-file', str(sqlite_filepath)])
+
+    # The database is opened read-only, so the mistyped path is not created
+    assert f'cannot read {sqlite_filepath}' in capsys.readouterr().err
+    assert not sqlite_filepath.exists()
@@ -0,0 +1,220 @@
+import json
+
+from botocore.stub import ANY
+
+ACCOUNT_ID = '100000000000'
+PROFILE_INFO = { 'sso_session': 'org', 'profile_name': 'prod-acct', 'account_id': ACCOUNT_ID }
+
+
+def test_get_elbv2_tags_batches_describe_tags(scanner, create_stubbed_client):
+    elbv2_client, stubber = create_stubbed_client('elbv2')
+    elb_arns = [f'arn:aws:elasticloadbalancing:us-east-1:{ACCOUNT_ID}:loadbalancer/app/alb{i}/{i}' for i in range(45)]
+
+    # DescribeTags accepts 20 ARNs, so 45 load balancers take 3 calls
+    for batch in (elb_arns[:20], elb_arns[20:40], elb_arns[40:]):
+        stubber.add_response(
+            'describe_tags',
+            { 'TagDescriptions': [{ 'ResourceArn': elb_arn, 'Tags': [{ 'Key': 'Name', 'Value': elb_arn.split('/')[-2] }] } for elb_arn in batch] },
+            { 'ResourceArns': batch }
+        )
+
+    tags_by_arn = scanner.get_elbv2_tags(elbv2_client, elb_arns)
+
+    assert len(tags_by_arn) == 45
+    assert tags_by_arn[elb_arns[44]] == [{ 'Key': 'Name', 'Value': 'alb44' }]
+
+
+def add_config_results(stubber, resources):
+    stubber.add_response(
+        'select_aggregate_resource_config',
+        { 'Results': [json.dumps(resource) for resource in resources] },
+        { 'Expression': ANY, 'ConfigurationAggregatorName': 'org', 'Limit': 100 }
+    )
+
+
+def test_load_config_inventory_covers_only_the_recorded_resource_types(scanner, create_stubbed_client):
+    config_client, stubber = create_stubbed_client('config')
+    add_config_results(stubber, [
+        {
+            'accountId': ACCOUNT_ID, 'awsRegion': 'us-east-1', 'resourceType': 'AWS::ElasticLoadBalancingV2::LoadBalancer',
+            'resourceId': 'arn:alb1', 'resourceName': 'alb1',
+            'configuration': { 'loadBalancerName': 'alb1', 'type': 'application', 'scheme': 'internet-facing' },
+            'relationships': [{ 'resourceType': 'AWS::WAFv2::WebACL', 'resourceId': 'arn:acl', 'resourceName': 'acl-v2' }],
+            'tags': [{ 'key': 'et:waf-ignore', 'value': 'true' }]
+        },
+        {
+            'accountId': ACCOUNT_ID, 'awsRegion': 'us-east-1', 'resourceType': 'AWS::ElasticLoadBalancingV2::LoadBalancer',
+            'resourceId': 'arn:nlb1', 'resourceName': 'nlb1',
+            'configuration': json.dumps({ 'loadBalancerName': 'nlb1', 'type': 'network', 'scheme': 'internal' })
+        },
+        {
+            'accountId': ACCOUNT_ID, 'awsRegion': 'us-east-1', 'resourceType': 'AWS::CloudFront::Distribution',
+            'resourceId': 'D1', 'resourceName': 'D1',
+            'configuration': { 'domainName': 'd1.cloudfront.net', 'distributionConfig': { 'aliases': { 'quantity': 0 }, 'webACLId': 'classic-acl-id' } }
+        }
+    ])
+
+    inventory = scanner.load_config_inventory(config_client, 'org', ['elb', 'cloudfront', 'apigw'])
+
+    # Only Application and Network Load Balancers were recorded, so Classic ELBs and APIs are left to the direct collectors
+    assert inventory['covered'] == { (ACCOUNT_ID, 'us-east-1', 'AWS::ElasticLoadBalancingV2::LoadBalancer'), (ACCOUNT_ID, 'global', 'AWS::CloudFront::Distribution') }
+    assert scanner.is_covered_by_inventory(inventory, PROFILE_INFO, 'us-east-1', 'elbv2')
+    assert not scanner.is_covered_by_inventory(inventory, PROFILE_INFO, 'us-east-1', 'elbv1')
+    assert not scanner.is_covered_by_inventory(inventory, PROFILE_INFO, 'us-east-1', 'apigwv1')
+    assert [record for service, record, web_acl_lookup in inventory['records'][(ACCOUNT_ID, 'us-east-1', 'elbv2')]] == [
+        scanner.ElbRecord('alb1', 'v2', 'application', 'internet-facing', 'acl-v2', 'v2', True),
+        scanner.ElbRecord('nlb1', 'v2', 'network', 'internal', 'N/A', 'N/A', False)
+    ]
+    assert inventory['records'][(ACCOUNT_ID, 'global', 'cloudfront')] == [
+        ('cloudfront', scanner.CloudFrontRecord('D1', 'd1.cloudfront.net', 'classic-acl-id', 'v1'), ('waf', 'classic-acl-id', None))
+    ]
+
+
+def test_get_inventory_info_resolves_waf_classic_names(scanner, create_stubbed_client, tmp_path):
+    waf_client, stubber = create_stubbed_client('waf')
+    stubber.add_response(
+        'get_web_acl',
+        { 'WebACL': { 'WebACLId': 'classic-acl-id', 'Name': 'classic-acl', 'DefaultAction': { 'Type': 'ALLOW' }, 'Rules': [] } },
+        { 'WebACLId': 'classic-acl-id' }
+    )
+    client_pool = scanner.create_client_pool(None, PROFILE_INFO, {})
+    client_pool['clients'][('waf', None)] = waf_client
+    web_acl_name_cache = scanner.load_web_acl_name_cache(str(tmp_path / 'web-acl-name-cache.json'))
+
+    cloudfront_info = scanner.CloudFrontRecord('D1', 'd1.cloudfront.net', 'classic-acl-id', 'v1')
+    inventory = { 'covered': set(), 'records': { (ACCOUNT_ID, 'global', 'cloudfront'): [('cloudfront', cloudfront_info, ('waf', 'classic-acl-id', None))] * 2 } }
+
+    records = list(scanner.get_inventory_info(inventory, ACCOUNT_ID, 'global', 'cloudfront', client_pool, web_acl_name_cache))
+
+    # The second distribution gets the name from the cache instead of another GetWebACL
+    assert records == [('cloudfront', cloudfront_info._replace(associated_waf='classic-acl'))] * 2
+    assert (web_acl_name_cache['hits'], web_acl_name_cache['misses']) == (1, 1)
+
+
+def test_get_inventory_info_looks_up_regional_names_in_the_stage_region(scanner, create_stubbed_client):
+    waf_regional_client, stubber = create_stubbed_client('waf-regional', 'eu-west-1')
+    stubber.add_response(
+        'get_web_acl',
+        { 'WebACL': { 'WebACLId': 'regional-acl-id', 'Name': 'regional-acl', 'DefaultAction': { 'Type': 'BLOCK' }, 'Rules': [] } },
+        { 'WebACLId': 'regional-acl-id' }
+    )
+    client_pool = scanner.create_client_pool(None, PROFILE_INFO, {})
+    client_pool['clients'][('waf-regional', 'eu-west-1')] = waf_regional_client
+
+    apigw_info = scanner.ApigwRecord('r1', 'rest1', 'REST', 'REGIONAL', 'prod', 'regional-acl-id', 'v1')
+    inventory = { 'covered': set(), 'records': { (ACCOUNT_ID, 'eu-west-1', 'apigwv1'): [('apigw', apigw_info, ('waf-regional', 'regional-acl-id', 'eu-west-1'))] } }
+
+    assert list(scanner.get_inventory_info(inventory, ACCOUNT_ID, 'eu-west-1', 'apigwv1', client_pool)) == [('apigw', apigw_info._replace(associated_waf='regional-acl'))]
+
+
+def test_get_config_web_acl_looks_up_classic_relationships_without_a_name(scanner):
+    stage = {
+        'awsRegion': 'eu-west-1',
+        'relationships': [{ 'resourceType': 'AWS::WAFRegional::WebACL', 'resourceId': 'regional-acl-id' }]
+    }
+
+    assert scanner.get_config_web_acl(stage) == { 'name': 'regional-acl-id', 'waf_version': 'v1', 'lookup': ('waf-regional', 'regional-acl-id', 'eu-west-1') }
+
+
+def test_scan_waf_coverage_for_region_collects_the_unrecorded_resource_types(scanner, create_stubbed_client):
+    elb_client, elb_stubber = create_stubbed_client('elb')
+    elb_stubber.add_response(
+        'describe_load_balancers',
+        { 'LoadBalancerDescriptions': [{ 'LoadBalancerName': 'clb1', 'Scheme': 'internet-facing' }] },
+        { 'PageSize': 400 }
+    )
+    apigw_client, apigw_stubber = create_stubbed_client('apigateway')
+    apigw_stubber.add_response('get_rest_apis', { 'items': [] }, {})
+    client_pool = scanner.create_client_pool(None, PROFILE_INFO, {})
+    client_pool['clients'][('elb', 'us-east-1')] = elb_client
+    client_pool['clients'][('apigateway', 'us-east-1')] = apigw_client
+
+    # Application Load Balancers and HTTP APIs are recorded, Classic ELBs and REST APIs are not
+    alb_info = scanner.ElbRecord('alb1', 'v2', 'application', 'internet-facing', 'acl-v2', 'v2', False)
+    http_api_info = scanner.ApigwRecord('h1', 'http1', 'HTTP', 'REGIONAL', '$default', 'N/A', 'N/A')
+    inventory = {
+        'covered': {
+            (ACCOUNT_ID, 'us-east-1', 'AWS::ElasticLoadBalancingV2::LoadBalancer'),
+            (ACCOUNT_ID, 'us-east-1', 'AWS::ApiGatewayV2::Api'),
+            (ACCOUNT_ID, 'us-east-1', 'AWS::ApiGatewayV2::Stage')
+        },
+        'records': {
+            (ACCOUNT_ID, 'us-east-1', 'elbv2'): [('elb', alb_info, None)],
+            (ACCOUNT_ID, 'us-east-1', 'apigwv2'): [('apigw', http_api_info, None)]
+        }
+    }
+    scan_options = { 'services': ['elb', 'apigw'], 'inventory': inventory, 'use_waf_index': False, 'web_acl_name_cache': None, 'max_resource_workers': 1 }
+
+    assert list(scanner.scan_waf_coverage_for_region(client_pool, 'us-east-1', PROFILE_INFO, scan_options)) == [
+        ('elb', alb_info),
+        ('elb', scanner.ElbRecord('clb1', 'v1', 'classic', 'internet-facing', 'N/A', 'N/A', False)),
+        ('apigw', http_api_info)
+    ]
+
+
+def generate_cloudtrail_event(event_source, event_name, request_parameters, region_name='us-east-1', **fields):
+    return { 'eventSource': event_source, 'eventName': event_name, 'awsRegion': region_name, 'requestParameters': request_parameters, **fields }
+
+
+def test_get_cloudtrail_resource_keys_of_load_balancers(scanner):
+    alb_arn = f'arn:aws:elasticloadbalancing:us-east-1:{ACCOUNT_ID}:loadbalancer/app/alb1/50dc6c495c0c9188'
+
+    create_event = generate_cloudtrail_event('elasticloadbalancing.amazonaws.com', 'CreateLoadBalancer', { 'name': 'alb2', 'type': 'application' }, apiVersion='2015-12-01')
+    delete_event = generate_cloudtrail_event('elasticloadbalancing.amazonaws.com', 'DeleteLoadBalancer', { 'loadBalancerArn': alb_arn }, apiVersion='2015-12-01')
+    assert scanner.get_cloudtrail_resource_keys(create_event) == [('elb', 'us-east-1', 'v2', 'alb2')]
+    assert scanner.get_cloudtrail_resource_keys(delete_event) == [('elb', 'us-east-1', 'v2', 'alb1')]
+
+    # Only the et:waf-ignore tag changes the coverage, so the other tags are not refreshed
+    ignore_event = generate_cloudtrail_event('elasticloadbalancing.amazonaws.com', 'AddTags', { 'resourceArns': [alb_arn], 'tags': [{ 'key': 'et:waf-ignore', 'value': 'true' }] }, apiVersion='2015-12-01')
+    name_event = generate_cloudtrail_event('elasticloadbalancing.amazonaws.com', 'AddTags', { 'resourceArns': [alb_arn], 'tags': [{ 'key': 'Name', 'value': 'alb1' }] }, apiVersion='2015-12-01')
+    assert scanner.get_cloudtrail_resource_keys(ignore_event) == [('elb', 'us-east-1', 'v2', 'alb1')]
+    assert scanner.get_cloudtrail_resource_keys(name_event) == []
+
+
+def test_get_cloudtrail_resource_keys_of_web_acl_associations(scanner):
+    # WAF events are logged in the region of the call, and the key takes the region of the associated resource
+    alb_event = generate_cloudtrail_event('wafv2.amazonaws.com', 'AssociateWebACL', {
+        'webACLArn': f'arn:aws:wafv2:eu-west-1:{ACCOUNT_ID}:regional/webacl/acl/1',
+        'resourceArn': f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT_ID}:loadbalancer/app/alb1/50dc6c495c0c9188'
+    })
+    stage_event = generate_cloudtrail_event('waf-regional.amazonaws.com', 'AssociateWebACL', {
+        'webACLId': 'regional-acl-id',
+        'resourceArn': 'arn:aws:apigateway:eu-west-1::/restapis/r1/stages/prod'
+    })
+
+    assert scanner.get_cloudtrail_resource_keys(alb_event) == [('elb', 'eu-west-1', 'v2', 'alb1')]
+    assert scanner.get_cloudtrail_resource_keys(stage_event) == [('apigw', 'eu-west-1', 'v1', 'r1')]
+
+
+def test_get_cloudtrail_resource_keys_falls_back_to_the_whole_service(scanner):
+    event = generate_cloudtrail_event('apigateway.amazonaws.com', 'CreateDomainName', { 'domainName': 'api.example.com' })
+
+    assert scanner.get_cloudtrail_resource_keys(event) == [('apigw', 'us-east-1', None, None)]
+
+
+def test_merge_changed_records_replaces_and_drops_the_changed_resources(scanner):
+    records = [
+        ('elb', ['alb1', 'v2', 'application', 'internet-facing', 'acl', 'v2', False]),
+        ('elb', ['alb2', 'v2', 'application', 'internet-facing', 'acl', 'v2', False]),
+        ('elb', ['clb1', 'v1', 'classic', 'internet-facing', 'N/A', 'N/A', False]),
+        ('apigw', ['r1', 'rest1', 'REST', 'REGIONAL', 'prod', 'acl', 'v2'])
+    ]
+    alb1_info = scanner.ElbRecord('alb1', 'v2', 'application', 'internet-facing', 'None', 'None', False)
+    alb3_info = scanner.ElbRecord('alb3', 'v2', 'application', 'internal', 'None', 'None', False)
+    http_api_info = scanner.ApigwRecord('h1', 'http1', 'HTTP', 'REGIONAL', '$default', 'N/A', 'N/A')
+
+    # alb1 lost its WebACL, alb2 was deleted, alb3 was created, and API Gateway was collected again as a whole
+    changed_records = {
+        ('elb', 'us-east-1', 'v2', 'alb1'): [alb1_info],
+        ('elb', 'us-east-1', 'v2', 'alb2'): [],
+        ('elb', 'us-east-1', 'v2', 'alb3'): [alb3_info],
+        ('apigw', 'us-east-1', None, None): [http_api_info],
+        ('elb', 'eu-west-1', 'v2', 'alb4'): [alb3_info._replace(name='alb4')]
+    }
+
+    assert list(scanner.merge_changed_records(records, 'us-east-1', changed_records)) == [
+        ('elb', alb1_info),
+        records[2],
+        ('elb', alb3_info),
+        ('apigw', http_api_info)
+    ]
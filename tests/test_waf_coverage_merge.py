@@ -0,0 +1,79 @@
+import csv
+
+import pytest
+
+PROFILES = [
+    { 'sso_session': 'org', 'profile_name': f'prod-acct{i}', 'account_id': f'1000000000{i:02d}' }
+    for i in range(8)
+]
+
+
+def write_csv(csv_filepath, fieldnames, rows):
+    with open(csv_filepath, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
+
+
+def read_csv(csv_filepath):
+    with open(csv_filepath, mode='r', newline='', encoding='utf-8') as file:
+        return list(csv.reader(file))
+
+
+def generate_elb_row(scanner, profile_info):
+    basic_values = list(scanner.generate_basic_info(profile_info, 'us-east-1').values())
+    return basic_values + list(scanner.ElbRecord(f"alb-{profile_info['account_id']}", 'v2', 'application', 'internal', 'acl', 'v2', 'False'))
+
+
+@pytest.fixture
+def shards(scanner, tmp_path):
+    profiles_csv_filepath = str(tmp_path / 'aws-profiles.csv')
+    write_csv(profiles_csv_filepath, ['sso_session', 'profile_name', 'account_id'], [profile_info.values() for profile_info in PROFILES])
+
+    # Each shard writes the rows of the accounts that hash to it, in the order of the profiles file
+    manifest_filepaths = []
+    for shard_index in (1, 2):
+        profiles = [profile_info for profile_info in PROFILES if scanner.get_profile_shard(profile_info, 2) == shard_index]
+        output_csv_filepaths = { service: str(tmp_path / f'shard{shard_index}-for-{service}.csv') for service in scanner.FIELDNAMES }
+        write_csv(output_csv_filepaths['elb'], scanner.FIELDNAMES['elb'], [generate_elb_row(scanner, profile_info) for profile_info in profiles])
+        write_csv(output_csv_filepaths['apigw'], scanner.FIELDNAMES['apigw'], [])
+        write_csv(output_csv_filepaths['cloudfront'], scanner.FIELDNAMES['cloudfront'], [])
+
+        manifest_filepath = str(tmp_path / f'shard{shard_index}-manifest.json')
+        waf_coverage = { 'rows': { 'elb': len(profiles), 'apigw': 0 }, 'scanned': profiles, 'failed': [] }
+        scanner.write_manifest(manifest_filepath, profiles_csv_filepath, output_csv_filepaths, { 'regions': None, 'services': ['elb', 'apigw'] }, (shard_index, 2), waf_coverage)
+        manifest_filepaths.append(manifest_filepath)
+
+    return profiles_csv_filepath, manifest_filepaths
+
+
+def test_get_profile_shard_is_stable(scanner):
+    shard_indexes = [scanner.get_profile_shard(profile_info, 2) for profile_info in PROFILES]
+
+    assert shard_indexes == [scanner.get_profile_shard(profile_info, 2) for profile_info in PROFILES]
+    assert set(shard_indexes) == {1, 2}
+
+
+def test_merge_shard_outputs_keeps_the_profiles_order(scanner, merger, shards, tmp_path):
+    profiles_csv_filepath, manifest_filepaths = shards
+    manifests = [merger.read_manifest(manifest_filepath) for manifest_filepath in manifest_filepaths]
+    output_csv_filepaths = { service: str(tmp_path / f'merged-for-{service}.csv') for service in scanner.FIELDNAMES }
+
+    assert merger.validate_manifests(scanner, manifests, profiles_csv_filepath) == []
+    assert merger.merge_shard_outputs(scanner, manifests, profiles_csv_filepath, output_csv_filepaths) == { 'elb': 8, 'apigw': 0 }
+    assert read_csv(output_csv_filepaths['elb']) == [scanner.FIELDNAMES['elb']] + [generate_elb_row(scanner, profile_info) for profile_info in PROFILES]
+
+    # CloudFront was not scanned, so its file only has the header instead of the rows of an older merge
+    assert read_csv(output_csv_filepaths['cloudfront']) == [scanner.FIELDNAMES['cloudfront']]
+
+
+def test_validate_manifests_reports_missing_and_repeated_shards(scanner, merger, shards):
+    profiles_csv_filepath, manifest_filepaths = shards
+    first_manifest = merger.read_manifest(manifest_filepaths[0])
+
+    errors = merger.validate_manifests(scanner, [first_manifest, first_manifest], profiles_csv_filepath)
+
+    assert 'missing shard 2/2' in errors
+    assert 'shard 1/2 was given 2 times' in errors
+    assert any(error.endswith('was not scanned by any shard') for error in errors)
+    assert any(error.endswith('was scanned 2 times') for error in errors)
@@ -0,0 +1,425 @@
+import argparse
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import Counter
+from contextlib import redirect_stdout
+
+from scripts_common import SCRIPTS_DIRPATH, SERVICES, load_script
+
+parser = argparse.ArgumentParser(description='Benchmark the WAF coverage scripts against a simulated AWS organization.')
+parser.add_argument('--accounts', type=int, default=20, help='Number of simulated accounts. Default is 20.')
+parser.add_argument('--regions', type=lambda value: value.split(','), default=['us-east-1'], help='Comma-separated simulated regions. Default is us-east-1.')
+parser.add_argument('--albs', type=int, default=20, help='Application load balancers per account and region. Default is 20.')
+parser.add_argument('--nlbs', type=int, default=5, help='Network load balancers per account and region. Default is 5.')
+parser.add_argument('--classic-elbs', type=int, default=2, help='Classic load balancers per account and region. Default is 2.')
+parser.add_argument('--distributions', type=int, default=10, help='CloudFront distributions per account. Default is 10.')
+parser.add_argument('--rest-apis', type=int, default=10, help='REST APIs per account and region. Default is 10.')
+parser.add_argument('--http-apis', type=int, default=5, help='HTTP APIs per account and region. Default is 5.')
+parser.add_argument('--stages', type=int, default=2, help='Stages per API. Default is 2.')
+parser.add_argument('--latency-ms', type=float, default=20.0, help='Simulated latency of each AWS call in milliseconds. Default is 20.')
+parser.add_argument('--max-workers', type=int, default=1, help='Number of accounts scanned in parallel. Default is 1.')
+parser.add_argument('--max-resource-workers', type=int, default=1, help='Number of per-resource calls made in parallel inside each collector. Default is 1.')
+parser.add_argument('--waf-index', action='store_true', help='Scan with the per-account WAF association index.')
+parser.add_argument('--baseline-file', default='workspace/waf-coverage-benchmark-baseline.json', help='Baseline file. Default is waf-coverage-benchmark-baseline.json.')
+parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline instead of comparing against it.')
+parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative increase in time and memory over the baseline. Default is 0.2.')
+parser.add_argument('--startup-budget', type=float, default=0.2, help='Seconds the lightweight aws-scripts.py subcommands may take to start. Default is 0.2.')
+
+STARTUP_COMMANDS = (
+    ('profiles', 'get', '--help'),
+    ('profiles', 'set', '--help'),
+    ('waf', 'scan', '--help'),
+    ('waf', 'coverage', '--help'),
+    ('waf', 'merge', '--help'),
+    ('waf', 'serve', '--help')
+)
+HEAVY_MODULES = ('boto3', 'botocore', 'tqdm', 'tabulate')
+
+
+def generate_profiles(accounts):
+    return [
+        { 'sso_session': 'benchmark', 'profile_name': f'bench-account-{i:04d}', 'account_id': str(100000000000 + i) }
+        for i in range(accounts)
+    ]
+
+
+def write_profiles_csv(csv_filepath, profiles):
+    with open(csv_filepath, mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['sso_session', 'profile_name', 'account_id'], quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        writer.writerows(profiles)
+
+
+def write_aws_config(config_filepath, profiles, region_name):
+    with open(config_filepath, mode='w') as file:
+        for profile_info in profiles:
+            file.write(f"[profile {profile_info['profile_name']}]\n")
+            file.write(f"region = {region_name}\n")
+            file.write("aws_access_key_id = benchmark\n")
+            file.write("aws_secret_access_key = benchmark\n\n")
+
+
+def simulate_web_acl(resource_arn):
+    # The association is derived from the ARN, so per-resource lookups and the WAF index always agree
+    bucket = zlib.crc32(resource_arn.encode()) % 10
+
+    if bucket < 4:
+        return { 'name': f'waf-v2-{bucket % 2}', 'waf_version': 'v2' }
+
+    if bucket < 6:
+        return { 'name': f'waf-classic-{bucket % 2}', 'waf_version': 'v1' }
+
+    return None
+
+
+def simulate_load_balancers(estate, account_id, region_name):
+    load_balancers = []
+    for i in range(estate['albs']):
+        load_balancers.append({
+            'LoadBalancerArn': f'arn:aws:elasticloadbalancing:{region_name}:{account_id}:loadbalancer/app/alb-{i}/{i:016x}',
+            'LoadBalancerName': f'alb-{i}',
+            'Type': 'application',
+            'Scheme': 'internal' if i % 4 == 0 else 'internet-facing'
+        })
+    for i in range(estate['nlbs']):
+        load_balancers.append({
+            'LoadBalancerArn': f'arn:aws:elasticloadbalancing:{region_name}:{account_id}:loadbalancer/net/nlb-{i}/{i:016x}',
+            'LoadBalancerName': f'nlb-{i}',
+            'Type': 'network',
+            'Scheme': 'internet-facing'
+        })
+    return load_balancers
+
+
+def simulate_stage_arns(estate, region_name):
+    return [
+        f'arn:aws:apigateway:{region_name}::/restapis/rest-{i}/stages/stage-{j}'
+        for i in range(estate['rest_apis']) for j in range(estate['stages'])
+    ]
+
+
+def simulate_associated_arns(estate, account_id, region_name, web_acl_name, resource_type):
+    if resource_type == 'APPLICATION_LOAD_BALANCER':
+        resource_arns = [elb['LoadBalancerArn'] for elb in simulate_load_balancers(estate, account_id, region_name) if elb['Type'] == 'application']
+    else:
+        resource_arns = simulate_stage_arns(estate, region_name)
+
+    return [resource_arn for resource_arn in resource_arns if (simulate_web_acl(resource_arn) or {}).get('name') == web_acl_name]
+
+
+def paginate(items, params, marker_key, size_key, default_size):
+    start = int(params.get(marker_key) or 0)
+    size = int(params.get(size_key) or default_size)
+    next_marker = str(start + size) if start + size < len(items) else None
+    return items[start:start + size], next_marker
+
+
+def simulate_response(estate, account_id, region_name, service_name, operation_name, params):
+    if service_name == 'ec2' and operation_name == 'DescribeRegions':
+        return { 'Regions': [{ 'RegionName': simulated_region_name } for simulated_region_name in estate['regions']] }
+
+    if service_name == 'elbv2' and operation_name == 'DescribeLoadBalancers':
+        load_balancers, next_marker = paginate(simulate_load_balancers(estate, account_id, region_name), params, 'Marker', 'PageSize', 400)
+        return { 'LoadBalancers': load_balancers, **({ 'NextMarker': next_marker } if next_marker else {}) }
+
+    if service_name == 'elbv2' and operation_name == 'DescribeTags':
+        return { 'TagDescriptions': [
+            { 'ResourceArn': resource_arn, 'Tags': [{ 'Key': 'et:waf-ignore', 'Value': 'true' }] if zlib.crc32(resource_arn.encode()) % 7 == 0 else [] }
+            for resource_arn in params['ResourceArns']
+        ] }
+
+    if service_name == 'elb' and operation_name == 'DescribeLoadBalancers':
+        classic_elbs = [{ 'LoadBalancerName': f'classic-{i}', 'Scheme': 'internet-facing' } for i in range(estate['classic_elbs'])]
+        classic_elbs, next_marker = paginate(classic_elbs, params, 'Marker', 'PageSize', 400)
+        return { 'LoadBalancerDescriptions': classic_elbs, **({ 'NextMarker': next_marker } if next_marker else {}) }
+
+    if service_name == 'cloudfront' and operation_name == 'ListDistributions':
+        distributions = []
+        for i in range(estate['distributions']):
+            distribution_arn = f'arn:aws:cloudfront::{account_id}:distribution/E{i:012d}'
+            web_acl = simulate_web_acl(distribution_arn)
+            web_acl_id = ''
+            if web_acl and web_acl['waf_version'] == 'v2':
+                web_acl_id = f"arn:aws:wafv2:us-east-1:{account_id}:global/webacl/{web_acl['name']}/{i:08d}"
+            elif web_acl:
+                web_acl_id = web_acl['name']
+            distributions.append({
+                'Id': f'E{i:012d}',
+                'DomainName': f'd{i}.cloudfront.net',
+                'Aliases': { 'Quantity': 1, 'Items': [f'www{i}.example.com'] } if i % 2 else { 'Quantity': 0 },
+                'WebACLId': web_acl_id
+            })
+        distributions, next_marker = paginate(distributions, params, 'Marker', 'MaxItems', 100)
+        return { 'DistributionList': {
+            'Items': distributions,
+            'IsTruncated': next_marker is not None,
+            'Marker': params.get('Marker', ''),
+            'MaxItems': len(distributions),
+            'Quantity': len(distributions),
+            **({ 'NextMarker': next_marker } if next_marker else {})
+        } }
+
+    if service_name == 'waf' and operation_name == 'GetWebACL':
+        return { 'WebACL': { 'WebACLId': params['WebACLId'], 'Name': params['WebACLId'], 'DefaultAction': { 'Type': 'ALLOW' }, 'Rules': [] } }
+
+    if service_name == 'apigatewayv2' and operation_name == 'GetApis':
+        apis = [{ 'ApiId': f'http-{i}', 'Name': f'http-api-{i}', 'ProtocolType': 'HTTP' } for i in range(estate['http_apis'])]
+        apis, next_token = paginate(apis, params, 'NextToken', 'MaxResults', 100)
+        return { 'Items': apis, **({ 'NextToken': next_token } if next_token else {}) }
+
+    if service_name == 'apigatewayv2' and operation_name == 'GetStages':
+        return { 'Items': [{ 'StageName': f'stage-{j}' } for j in range(estate['stages'])] }
+
+    if service_name == 'apigateway' and operation_name == 'GetRestApis':
+        apis = [
+            { 'id': f'rest-{i}', 'name': f'rest-api-{i}', 'endpointConfiguration': { 'types': ['PRIVATE' if i % 5 == 0 else 'REGIONAL'] } }
+            for i in range(estate['rest_apis'])
+        ]
+        apis, position = paginate(apis, params, 'position', 'limit', 25)
+        return { 'items': apis, **({ 'position': position } if position else {}) }
+
+    if service_name == 'apigateway' and operation_name == 'GetStages':
+        return { 'item': [{ 'stageName': f'stage-{j}' } for j in range(estate['stages'])] }
+
+    if service_name == 'wafv2' and operation_name == 'GetWebACLForResource':
+        web_acl = simulate_web_acl(params['ResourceArn'])
+        if web_acl and web_acl['waf_version'] == 'v2':
+            return { 'WebACL': { 'Name': web_acl['name'], 'Id': web_acl['name'], 'ARN': f"arn:aws:wafv2:{region_name}:{account_id}:regional/webacl/{web_acl['name']}/{web_acl['name']}" } }
+        return {}
+
+    if service_name == 'waf-regional' and operation_name == 'GetWebACLForResource':
+        web_acl = simulate_web_acl(params['ResourceArn'])
+        if web_acl and web_acl['waf_version'] == 'v1':
+            return { 'WebACLSummary': { 'WebACLId': web_acl['name'], 'Name': web_acl['name'] } }
+        return {}
+
+    if service_name == 'wafv2' and operation_name == 'ListWebACLs':
+        return { 'WebACLs': [
+            { 'Name': f'waf-v2-{i}', 'Id': f'waf-v2-{i}', 'ARN': f'arn:aws:wafv2:{region_name}:{account_id}:regional/webacl/waf-v2-{i}/waf-v2-{i}' }
+            for i in range(2)
+        ] }
+
+    if service_name == 'waf-regional' and operation_name == 'ListWebACLs':
+        return { 'WebACLs': [{ 'WebACLId': f'waf-classic-{i}', 'Name': f'waf-classic-{i}' } for i in range(2)] }
+
+    if service_name == 'wafv2' and operation_name == 'ListResourcesForWebACL':
+        web_acl_name = params['WebACLArn'].split('/')[-2]
+        return { 'ResourceArns': simulate_associated_arns(estate, account_id, region_name, web_acl_name, params.get('ResourceType', 'APPLICATION_LOAD_BALANCER')) }
+
+    if service_name == 'waf-regional' and operation_name == 'ListResourcesForWebACL':
+        return { 'ResourceArns': simulate_associated_arns(estate, account_id, region_name, params['WebACLId'], params.get('ResourceType', 'APPLICATION_LOAD_BALANCER')) }
+
+    raise NotImplementedError(f'{service_name}.{operation_name} is not simulated')
+
+
+def register_simulated_estate(session, estate, account_id, api_calls, api_calls_lock):
+    from botocore.awsrequest import AWSResponse
+
+    def capture_params(params, context, **kwargs):
+        context['simulated_params'] = dict(params)
+
+    def respond(model, context, **kwargs):
+        service_name = model.service_model.service_name
+        region_name = context['client_region']
+        with api_calls_lock:
+            api_calls[f'{service_name}.{model.name}'] += 1
+
+        time.sleep(estate['latency_ms'] / 1000)
+        parsed_response = simulate_response(estate, account_id, region_name, service_name, model.name, context['simulated_params'])
+        return AWSResponse(None, 200, {}, None), parsed_response
+
+    # Like botocore's Stubber, a before-call response short-circuits the HTTP request, but it is safe to share across threads
+    session.events.register('before-parameter-build', capture_params)
+    session.events.register('before-call', respond)
+
+
+def run_benchmark(estate, scan_options, max_workers):
+    scanner = load_script('waf-coverage-get-info.py')
+    calculator = load_script('waf-coverage-calculate.py')
+    profiles = generate_profiles(estate['accounts'])
+    accounts_by_profile = { profile_info['profile_name']: profile_info['account_id'] for profile_info in profiles }
+    api_calls = Counter()
+    api_calls_lock = threading.Lock()
+
+    create_session = scanner.create_session
+
+    def create_simulated_session(profile_name):
+        session = create_session(profile_name)
+        register_simulated_estate(session, estate, accounts_by_profile[profile_name], api_calls, api_calls_lock)
+        return session
+
+    scanner.create_session = create_simulated_session
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        profiles_csv_filepath = os.path.join(dirpath, 'aws-profiles.csv')
+        write_profiles_csv(profiles_csv_filepath, profiles)
+        os.environ['AWS_CONFIG_FILE'] = os.path.join(dirpath, 'aws.config')
+        os.environ['AWS_SHARED_CREDENTIALS_FILE'] = os.path.join(dirpath, 'aws.credentials')
+        write_aws_config(os.environ['AWS_CONFIG_FILE'], profiles, estate['regions'][0])
+
+        output_csv_filepaths = { service: os.path.join(dirpath, f'waf-coverage-for-{service}.csv') for service in SERVICES }
+        scan_options = {
+            **scan_options,
+            'regions': estate['regions'],
+            'web_acl_name_cache': scanner.load_web_acl_name_cache(os.path.join(dirpath, 'web-acl-name-cache.json'))
+        }
+
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            waf_coverage = scanner.scan_waf_coverage_for_profiles_from_csv(
+                profiles_csv_filepath, output_csv_filepaths, max_workers, scan_options, os.path.join(dirpath, 'checkpoints')
+            )
+        scan_seconds = time.perf_counter() - started_at
+        scan_peak_memory = tracemalloc.get_traced_memory()[1]
+
+        # The peak is reset but not the memory the scan still holds, so that memory is taken off the peak of the calculator
+        tracemalloc.reset_peak()
+        calculate_base_memory = tracemalloc.get_traced_memory()[0]
+        started_at = time.perf_counter()
+        calculator.summarize_waf_info(
+            calculator.count_cloudfront_with_waf(output_csv_filepaths['cloudfront']),
+            calculator.count_elb_with_waf(output_csv_filepaths['elb']),
+            calculator.count_apigw_with_waf(output_csv_filepaths['apigw'])
+        )
+        calculate_seconds = time.perf_counter() - started_at
+        calculate_peak_memory = tracemalloc.get_traced_memory()[1] - calculate_base_memory
+        tracemalloc.stop()
+
+    if waf_coverage['failed']:
+        raise RuntimeError(f"simulated scan failed for {len(waf_coverage['failed'])} profile(s): {waf_coverage['failed'][0]['error']}")
+
+    return {
+        'scenario': { **estate, **{ key: value for key, value in scan_options.items() if key in ('use_waf_index', 'max_resource_workers') }, 'max_workers': max_workers },
+        'rows': waf_coverage['rows'],
+        'api_calls': dict(sorted(api_calls.items())),
+        'scan_seconds': scan_seconds,
+        'scan_peak_memory': scan_peak_memory,
+        'calculate_seconds': calculate_seconds,
+        'calculate_peak_memory': calculate_peak_memory
+    }
+
+
+def measure_startup(command_argv, runs=5):
+    argv = [sys.executable, os.path.join(SCRIPTS_DIRPATH, 'aws-scripts.py'), *command_argv]
+
+    # The fastest run is kept, so a busy machine does not break the budget
+    timings = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        subprocess.run(argv, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started_at)
+
+    # -X importtime slows the start down, so the imported modules come from a separate run
+    process = subprocess.run([argv[0], '-X', 'importtime', *argv[1:]], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imported_modules = { line.rsplit('|', 1)[1].strip().split('.')[0] for line in process.stderr.splitlines() if line.startswith('import time:') }
+
+    return { 'seconds': min(timings), 'heavy_modules': [module for module in HEAVY_MODULES if module in imported_modules] }
+
+
+def check_startup_budget(startup, startup_budget):
+    regressions = []
+    for command, command_startup in startup.items():
+        if command_startup['heavy_modules']:
+            regressions.append(f"{command} imports {', '.join(command_startup['heavy_modules'])}")
+        if command_startup['seconds'] > startup_budget:
+            regressions.append(f"{command} startup: {command_startup['seconds']:.3f}s over the {startup_budget:.3f}s budget")
+
+    return regressions
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+
+    # API calls are deterministic for a scenario, so any increase is a regression
+    for api_name, call_count in results['api_calls'].items():
+        baseline_call_count = baseline['api_calls'].get(api_name, 0)
+        if call_count > baseline_call_count:
+            regressions.append(f'{api_name} calls: {baseline_call_count} -> {call_count}')
+
+    for metric in ('scan_seconds', 'scan_peak_memory', 'calculate_seconds', 'calculate_peak_memory'):
+        if results[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(f'{metric}: {baseline[metric]:.2f} -> {results[metric]:.2f}')
+
+    return regressions
+
+
+def print_results(results):
+    from tabulate import tabulate
+
+    resource_count = sum(results['rows'].values())
+    print(tabulate([
+        ['Rows', ', '.join(f'{service}: {count}' for service, count in results['rows'].items())],
+        ['Scan time', f"{results['scan_seconds']:.2f}s"],
+        ['Scan peak memory', f"{results['scan_peak_memory'] / 1024 / 1024:.1f} MiB"],
+        ['Calculate time', f"{results['calculate_seconds']:.2f}s"],
+        ['Calculate peak memory', f"{results['calculate_peak_memory'] / 1024 / 1024:.1f} MiB"],
+        ['API calls', sum(results['api_calls'].values())],
+        ['API calls per row', f"{sum(results['api_calls'].values()) / max(1, resource_count):.2f}"],
+    ], tablefmt='grid'))
+    print(tabulate(results['api_calls'].items(), headers=['API', 'Calls'], tablefmt='grid'))
+    print(tabulate(
+        [[command, f"{command_startup['seconds'] * 1000:.0f} ms", ', '.join(command_startup['heavy_modules']) or '-'] for command, command_startup in results['startup'].items()],
+        headers=['Command', 'Startup', 'Heavy imports'], tablefmt='grid'
+    ))
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    # tqdm reads its environment overrides on import, so progress bars are disabled before the scanner is loaded
+    os.environ['TQDM_DISABLE'] = '1'
+
+    baseline_filepath = os.path.expanduser(args.baseline_file)
+    estate = {
+        'accounts': args.accounts,
+        'regions': args.regions,
+        'albs': args.albs,
+        'nlbs': args.nlbs,
+        'classic_elbs': args.classic_elbs,
+        'distributions': args.distributions,
+        'rest_apis': args.rest_apis,
+        'http_apis': args.http_apis,
+        'stages': args.stages,
+        'latency_ms': args.latency_ms
+    }
+    results = run_benchmark(estate, { 'use_waf_index': args.waf_index, 'max_resource_workers': args.max_resource_workers }, args.max_workers)
+    results['startup'] = { ' '.join(command_argv): measure_startup(command_argv) for command_argv in STARTUP_COMMANDS }
+    print_results(results)
+
+    # The startup budget is absolute, so it is checked even without a baseline
+    regressions = check_startup_budget(results['startup'], args.startup_budget)
+
+    if args.save_baseline:
+        with open(baseline_filepath, mode='w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f'Baseline saved to {baseline_filepath}')
+    elif not os.path.exists(baseline_filepath):
+        print(f'No baseline at {baseline_filepath}, run with --save-baseline to create one')
+    else:
+        with open(baseline_filepath, mode='r', encoding='utf-8') as file:
+            baseline = json.load(file)
+
+        if baseline['scenario'] != results['scenario']:
+            print('The baseline was recorded for a different scenario, run with --save-baseline to replace it')
+            sys.exit(1)
+
+        regressions += compare_with_baseline(results, baseline, args.tolerance)
+
+    for regression in regressions:
+        print(f'Regression: {regression}')
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
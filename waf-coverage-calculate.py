@@ -1,20 +1,22 @@
 import argparse
 import csv
 import os
-from collections import defaultdict
-from tabulate import tabulate
+import sqlite3
+from array import array
+from collections import Counter, defaultdict
+from operator import itemgetter
+from pathlib import Path
 
-parser = argparse.ArgumentParser(description='Set AWS SSO profiles from a CSV file.')
+from scripts_common import add_group_by_argument, validate_group_by
+
+parser = argparse.ArgumentParser(description='Calculate the WAF coverage from the waf-coverage-get-info.py output.')
 parser.add_argument('--input-file', default='workspace/waf-coverage.csv', help='Input CSV file. Default is waf-coverage.csv.')
 parser.add_argument('--debug', action='store_true', help='Print debug table.')
-
-args = parser.parse_args()
-
-input_csv_filepath = os.path.expanduser(args.input_file)
-input_file_path, input_file_extension = os.path.splitext(args.input_file)
-elb_csv_filepath = os.path.expanduser(f'{input_file_path}-for-elb{input_file_extension}')
-cloudfront_csv_filepath = os.path.expanduser(f'{input_file_path}-for-cloudfront{input_file_extension}')
-apigw_csv_filepath = os.path.expanduser(f'{input_file_path}-for-apigw{input_file_extension}')
+parser.add_argument('--sqlite-file', help='Read the scan from this SQLite database instead of the CSV files.')
+parser.add_argument('--snapshot', type=int, help='Snapshot ID to read from the SQLite database. Default is the latest complete snapshot.')
+add_group_by_argument(parser)
+parser.add_argument('--diff-input-file', help='Compare the scan of --input-file with this earlier scan and print the resources that changed.')
+parser.add_argument('--diff-snapshot', type=int, help='Compare the SQLite snapshot with this earlier snapshot and print the resources that changed.')
 
 
 def calculate_waf_coverage(resources):
@@ -22,85 +24,205 @@ def calculate_waf_coverage(resources):
     waf_resources = resources['waf_resources']
     coverage_results = {}
 
-    for profile_prefix in total_resources:
-        total_count = total_resources[profile_prefix]
-        waf_count = waf_resources.get(profile_prefix, 0)
+    for group_key in total_resources:
+        total_count = total_resources[group_key]
+        waf_count = waf_resources.get(group_key, 0)
 
         percentage = (waf_count / total_count) * 100
-        coverage_results[profile_prefix] = f"{percentage:.2f}%"
+        coverage_results[group_key] = f"{percentage:.2f}%"
 
     return coverage_results
 
 
-def count_cloudfront_with_waf(csv_file_path):
+def encode_columns(header, rows, columns):
+    # Every distinct combination of the selected columns is stored once and each row only keeps its code in an array.
+    # The codes are assigned by a defaultdict whose factory is its own length, so the whole pass runs without Python-level loops.
+    dictionary = defaultdict()
+    dictionary.default_factory = dictionary.__len__
+
+    get_columns = itemgetter(*(header.index(column) for column in columns))
+    codes = array('I', map(dictionary.__getitem__, map(get_columns, rows)))
+
+    # itemgetter returns a bare value instead of a tuple when only one column is selected
+    values = list(dictionary) if len(columns) > 1 else [(value,) for value in dictionary]
+    return { 'columns': columns, 'codes': codes, 'values': values }
+
+
+def read_columns(csv_file_path, columns):
+    with open(csv_file_path, mode='r', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        return encode_columns(header, reader, columns)
+
+
+def aggregate_columns(table, group_by, is_eligible, has_waf):
     total_resources = defaultdict(int)
     waf_resources = defaultdict(int)
 
-    with open(csv_file_path, mode='r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
+    # The rules run once per distinct combination and are applied to all of its rows through the counts
+    for code, count in Counter(table['codes']).items():
+        row = dict(zip(table['columns'], table['values'][code]))
+        rule_row = { column: value.lower() for column, value in row.items() }
 
-        for row in reader:
-            total_resources[row['profile_prefix']] += 1
+        if not is_eligible(rule_row):
+            continue
 
-            # This rule is explicit to serve as documentation, but it is the same as row['waf_version'] == 'v2'
-            if row['waf_version'].lower() == 'v1' or row['associated_waf'].lower() == 'none':
-                continue
+        group_key = tuple(row[column] for column in group_by)
+        total_resources[group_key] += count
 
-            waf_resources[row['profile_prefix']] += 1
+        if has_waf(rule_row):
+            waf_resources[group_key] += count
 
     return { 'total_resources': total_resources, 'waf_resources': waf_resources }
 
 
-def count_elb_with_waf(csv_file_path):
-    total_resources = defaultdict(int)
-    waf_resources = defaultdict(int)
+def is_cloudfront_eligible(row):
+    return True
 
-    with open(csv_file_path, mode='r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
 
-        for row in reader:
-            if row['marked_as_waf_ignore'].lower() == 'true' or row['scheme'].lower() == 'internal' or row['type'].lower() == 'network':
-                continue
+def cloudfront_has_waf(row):
+    # This rule is explicit to serve as documentation, but it is the same as row['waf_version'] == 'v2'
+    return not (row['waf_version'] == 'v1' or row['associated_waf'] == 'none')
 
-            total_resources[row['profile_prefix']] += 1
 
-            # This rule is explicit to serve as documentation, but it is the same as row['waf_version'] == 'v2'
-            if row['type'].lower() == 'classic' or row['waf_version'].lower() == 'v1' or row['associated_waf'].lower() == 'none':
-                continue
+def is_elb_eligible(row):
+    return not (row['marked_as_waf_ignore'] == 'true' or row['scheme'] == 'internal' or row['type'] == 'network')
 
-            waf_resources[row['profile_prefix']] += 1
 
-    return { 'total_resources': total_resources, 'waf_resources': waf_resources }
+def elb_has_waf(row):
+    # This rule is explicit to serve as documentation, but it is the same as row['waf_version'] == 'v2'
+    return not (row['type'] == 'classic' or row['waf_version'] == 'v1' or row['associated_waf'] == 'none')
+
+
+def is_apigw_eligible(row):
+    return row['endpoint_type'] != 'private'
+
+
+def apigw_has_waf(row):
+    # This rule is explicit to serve as documentation, but it is the same as row['waf_version'] == 'v2'
+    return not (row['protocol'] == 'http' or row['waf_version'] == 'v1' or row['associated_waf'] == 'none')
+
+
+# The columns each service's rules read, next to the rules themselves
+COVERAGE_RULES = {
+    'cloudfront': { 'columns': ['waf_version', 'associated_waf'], 'is_eligible': is_cloudfront_eligible, 'has_waf': cloudfront_has_waf },
+    'elb': { 'columns': ['marked_as_waf_ignore', 'scheme', 'type', 'waf_version', 'associated_waf'], 'is_eligible': is_elb_eligible, 'has_waf': elb_has_waf },
+    'apigw': { 'columns': ['endpoint_type', 'protocol', 'waf_version', 'associated_waf'], 'is_eligible': is_apigw_eligible, 'has_waf': apigw_has_waf }
+}
+
+
+def generate_required_columns(group_by, with_keys=False):
+    return {
+        service: list(dict.fromkeys([*(RESOURCE_KEYS[service] if with_keys else ()), *group_by, *rules['columns']]))
+        for service, rules in COVERAGE_RULES.items()
+    }
+
+
+def count_service_with_waf(service, table_reader, group_by=('profile_prefix',)):
+    rules = COVERAGE_RULES[service]
+    columns = list(dict.fromkeys([*group_by, *rules['columns']]))
+    return aggregate_columns(table_reader(columns), group_by, rules['is_eligible'], rules['has_waf'])
 
 
-def count_apigw_with_waf(csv_file_path):
+def count_cloudfront_with_waf(csv_file_path, group_by=('profile_prefix',)):
+    return count_service_with_waf('cloudfront', lambda columns: read_columns(csv_file_path, columns), group_by)
+
+
+def count_elb_with_waf(csv_file_path, group_by=('profile_prefix',)):
+    return count_service_with_waf('elb', lambda columns: read_columns(csv_file_path, columns), group_by)
+
+
+def count_apigw_with_waf(csv_file_path, group_by=('profile_prefix',)):
+    return count_service_with_waf('apigw', lambda columns: read_columns(csv_file_path, columns), group_by)
+
+
+def get_latest_snapshot_id(connection):
+    return connection.execute('SELECT MAX(snapshot_id) FROM snapshots WHERE completed_at IS NOT NULL').fetchone()[0]
+
+
+def is_snapshot_complete(connection, snapshot_id):
+    # A scan that failed or is still running leaves its snapshot without completed_at, and its rows are partial
+    row = connection.execute('SELECT completed_at FROM snapshots WHERE snapshot_id = ?', (snapshot_id,)).fetchone()
+    return row is not None and row[0] is not None
+
+
+def connect_sqlite_snapshot(parser, sqlite_file, snapshot_id=None):
+    # The database is opened read-only, so a wrong path is an error instead of a new empty database
+    sqlite_uri = Path(os.path.abspath(os.path.expanduser(sqlite_file))).as_uri()
+    try:
+        connection = sqlite3.connect(f'{sqlite_uri}?mode=ro', uri=True)
+        snapshot_id = snapshot_id or get_latest_snapshot_id(connection)
+    except sqlite3.Error as error:
+        parser.error(f'cannot read {sqlite_file}: {error}')
+
+    if snapshot_id is None:
+        parser.error(f'no complete snapshot in {sqlite_file}')
+
+    if not is_snapshot_complete(connection, snapshot_id):
+        parser.error(f'--snapshot {snapshot_id} is not a complete snapshot in {sqlite_file}')
+
+    return connection, snapshot_id
+
+
+def count_with_waf_from_sqlite(connection, snapshot_id, table, eligible_condition, waf_condition, group_by=('profile_prefix',)):
     total_resources = defaultdict(int)
     waf_resources = defaultdict(int)
 
-    with open(csv_file_path, mode='r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
+    group_by_columns = ', '.join(group_by)
+    query = f"""
+        SELECT {group_by_columns}, COUNT(*), SUM(CASE WHEN {waf_condition} THEN 1 ELSE 0 END)
+        FROM {table}
+        WHERE snapshot_id = ? AND {eligible_condition}
+        GROUP BY {group_by_columns}
+    """
+    for row in connection.execute(query, (snapshot_id,)):
+        group_key = tuple(row[:len(group_by)])
+        total_count, waf_count = row[len(group_by):]
+        total_resources[group_key] = total_count
+        if waf_count:
+            waf_resources[group_key] = waf_count
 
-        for row in reader:
-            if row['endpoint_type'].lower() == 'private':
-                continue
+    return { 'total_resources': total_resources, 'waf_resources': waf_resources }
 
-            total_resources[row['profile_prefix']] += 1
 
-            # This rule is explicit to serve as documentation, but it is the same as row['waf_version'] == 'v2'
-            if row['protocol'].lower() == 'http' or row['waf_version'].lower() == 'v1' or row['associated_waf'].lower() == 'none':
-                continue
+# The SQL conditions below are the same rules as the *_eligible and *_has_waf functions used for the CSV files
+def count_cloudfront_with_waf_from_sqlite(connection, snapshot_id, group_by=('profile_prefix',)):
+    return count_with_waf_from_sqlite(
+        connection, snapshot_id, 'cloudfront',
+        "1 = 1",
+        "NOT (lower(waf_version) = 'v1' OR lower(associated_waf) = 'none')",
+        group_by
+    )
 
-            waf_resources[row['profile_prefix']] += 1
 
-    return { 'total_resources': total_resources, 'waf_resources': waf_resources }
+def count_elb_with_waf_from_sqlite(connection, snapshot_id, group_by=('profile_prefix',)):
+    return count_with_waf_from_sqlite(
+        connection, snapshot_id, 'elb',
+        "NOT (lower(marked_as_waf_ignore) = 'true' OR lower(scheme) = 'internal' OR lower(type) = 'network')",
+        "NOT (lower(type) = 'classic' OR lower(waf_version) = 'v1' OR lower(associated_waf) = 'none')",
+        group_by
+    )
+
 
+def count_apigw_with_waf_from_sqlite(connection, snapshot_id, group_by=('profile_prefix',)):
+    return count_with_waf_from_sqlite(
+        connection, snapshot_id, 'apigw',
+        "lower(endpoint_type) != 'private'",
+        "NOT (lower(protocol) = 'http' OR lower(waf_version) = 'v1' OR lower(associated_waf) = 'none')",
+        group_by
+    )
 
-def generate_profile_prefixes(*resources):
-    profile_prefixes = set()
+
+def generate_group_keys(*resources):
+    group_keys = set()
     for resource in resources:
-        profile_prefixes |= set(resource['total_resources'].keys())
-    
-    return profile_prefixes
+        group_keys |= set(resource['total_resources'].keys())
+
+    return sorted(group_keys)
+
+
+def generate_group_headers(group_by):
+    return [column.replace('_', ' ').title() for column in group_by]
 
 
 def summarize_waf_info(cloudfront_resources, elb_resources, apigw_resources):
@@ -108,39 +230,40 @@ def summarize_waf_info(cloudfront_resources, elb_resources, apigw_resources):
         'total_resources': defaultdict(int),
         'waf_resources': defaultdict(int),
     }
-    profile_prefixes = generate_profile_prefixes(cloudfront_resources, elb_resources, apigw_resources)
-    
-    for profile_prefix in profile_prefixes:
-        combined_resources['total_resources'][profile_prefix] = \
-            cloudfront_resources['total_resources'].get(profile_prefix, 0) + \
-            elb_resources['total_resources'].get(profile_prefix, 0) + \
-            apigw_resources['total_resources'].get(profile_prefix, 0)
-
-        combined_resources['waf_resources'][profile_prefix] = \
-            cloudfront_resources['waf_resources'].get(profile_prefix, 0) + \
-            elb_resources['waf_resources'].get(profile_prefix, 0) + \
-            apigw_resources['waf_resources'].get(profile_prefix, 0)
-    
+    group_keys = generate_group_keys(cloudfront_resources, elb_resources, apigw_resources)
+
+    for group_key in group_keys:
+        combined_resources['total_resources'][group_key] = \
+            cloudfront_resources['total_resources'].get(group_key, 0) + \
+            elb_resources['total_resources'].get(group_key, 0) + \
+            apigw_resources['total_resources'].get(group_key, 0)
+
+        combined_resources['waf_resources'][group_key] = \
+            cloudfront_resources['waf_resources'].get(group_key, 0) + \
+            elb_resources['waf_resources'].get(group_key, 0) + \
+            apigw_resources['waf_resources'].get(group_key, 0)
+
     return combined_resources
 
 
-def print_debug_table(summarized_resources, cloudfront_resources, elb_resources, apigw_resources):
+def print_debug_table(summarized_resources, cloudfront_resources, elb_resources, apigw_resources, group_by=('profile_prefix',)):
+    from tabulate import tabulate
+
     combined_resources = {}
-    profile_prefixes = summarized_resources['total_resources'].keys()
-    for profile_prefix in profile_prefixes:
-        combined_resources[profile_prefix] = {
-        'CloudFront: Total': cloudfront_resources['total_resources'].get(profile_prefix, 0),
-        'CloudFront: WAF': cloudfront_resources['waf_resources'].get(profile_prefix, 0),
-        'ELB: Total': elb_resources['total_resources'].get(profile_prefix, 0),
-        'ELB: WAF': elb_resources['waf_resources'].get(profile_prefix, 0),
-        'API Gateway: Total': apigw_resources['total_resources'].get(profile_prefix, 0),
-        'API Gateway: WAF': apigw_resources['waf_resources'].get(profile_prefix, 0),
-        'Summarized: Total': summarized_resources['total_resources'].get(profile_prefix, 0),
-        'Summarized: WAF': summarized_resources['waf_resources'].get(profile_prefix, 0),
+    group_keys = summarized_resources['total_resources'].keys()
+    for group_key in group_keys:
+        combined_resources[group_key] = {
+        'CloudFront: Total': cloudfront_resources['total_resources'].get(group_key, 0),
+        'CloudFront: WAF': cloudfront_resources['waf_resources'].get(group_key, 0),
+        'ELB: Total': elb_resources['total_resources'].get(group_key, 0),
+        'ELB: WAF': elb_resources['waf_resources'].get(group_key, 0),
+        'API Gateway: Total': apigw_resources['total_resources'].get(group_key, 0),
+        'API Gateway: WAF': apigw_resources['waf_resources'].get(group_key, 0),
+        'Summarized: Total': summarized_resources['total_resources'].get(group_key, 0),
+        'Summarized: WAF': summarized_resources['waf_resources'].get(group_key, 0),
     }
 
-    headers = [
-        'Profile Prefix',
+    headers = generate_group_headers(group_by) + [
         'CloudFront: Total',
         'CloudFront: WAF',
         'ELB: Total',
@@ -150,43 +273,290 @@ def print_debug_table(summarized_resources, cloudfront_resources, elb_resources,
         'Summarized: Total',
         'Summarized: WAF'
     ]
-    table_data = [[profile_prefix] + list(stats.values()) for profile_prefix, stats in combined_resources.items()]
+    table_data = [list(group_key) + list(stats.values()) for group_key, stats in combined_resources.items()]
 
     print()
     print(tabulate(table_data, headers=headers, tablefmt='grid'))
     print()
 
 
-def print_coverage_table(summarized_resources, cloudfront_coverage, elb_coverage, apigw_coverage):
+def format_coverage_table(summarized_resources, cloudfront_coverage, elb_coverage, apigw_coverage, summarized_coverage, group_by=('profile_prefix',)):
+    from tabulate import tabulate
+
     combined_resources = {}
-    profile_prefixes = summarized_resources['total_resources'].keys()
-    for profile_prefix in profile_prefixes:
-        combined_resources[profile_prefix] = {
-        'CloudFront': cloudfront_coverage.get(profile_prefix, 'N/A'),
-        'ELB': elb_coverage.get(profile_prefix, 'N/A'),
-        'API Gateway': apigw_coverage.get(profile_prefix, 'N/A'),
-        'Summarized': summarized_coverage.get(profile_prefix, 'N/A'),
+    group_keys = summarized_resources['total_resources'].keys()
+    for group_key in group_keys:
+        combined_resources[group_key] = {
+        'CloudFront': cloudfront_coverage.get(group_key, 'N/A'),
+        'ELB': elb_coverage.get(group_key, 'N/A'),
+        'API Gateway': apigw_coverage.get(group_key, 'N/A'),
+        'Summarized': summarized_coverage.get(group_key, 'N/A'),
     }
 
-    headers = ['Profile Prefix', 'CloudFront', 'ELB', 'API Gateway', 'Summarized']
-    table_data = [ [profile_prefix] + list(stats.values()) for profile_prefix, stats in combined_resources.items()]
+    headers = generate_group_headers(group_by) + ['CloudFront', 'ELB', 'API Gateway', 'Summarized']
+    table_data = [ list(group_key) + list(stats.values()) for group_key, stats in combined_resources.items()]
 
-    print(tabulate(table_data, headers=headers, tablefmt='grid'))
+    return tabulate(table_data, headers=headers, tablefmt='grid')
 
 
-if __name__ == '__main__':
-    cloudfront_resources = count_cloudfront_with_waf(cloudfront_csv_filepath)
-    elb_resources = count_elb_with_waf(elb_csv_filepath)
-    apigw_resources = count_apigw_with_waf(apigw_csv_filepath)
+def print_coverage_table(summarized_resources, cloudfront_coverage, elb_coverage, apigw_coverage, summarized_coverage, group_by=('profile_prefix',)):
+    print(format_coverage_table(summarized_resources, cloudfront_coverage, elb_coverage, apigw_coverage, summarized_coverage, group_by))
+
+
+# A resource has the same key in every scan, so it is found in both snapshots even if everything else about it changed
+RESOURCE_KEYS = {
+    'cloudfront': ('account_id', 'distribution_id'),
+    'elb': ('account_id', 'region', 'version', 'name'),
+    'apigw': ('account_id', 'region', 'api_gateway_id', 'stage_name')
+}
+
+# How many eligible and protected resources each status adds to the coverage of its group
+STATUS_COUNTS = { 'absent': (0, 0), 'not eligible': (0, 0), 'unprotected': (1, 0), 'protected': (1, 1) }
+
+
+def index_resources(header, rows, key_columns):
+    get_key = itemgetter(*(header.index(column) for column in key_columns))
+    return { 'header': header, 'rows': { get_key(row): row for row in rows } }
+
+
+def read_resources(csv_file_path, key_columns):
+    with open(csv_file_path, mode='r', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        return index_resources(header, map(tuple, reader), key_columns)
+
+
+def read_csv_header(csv_file_path):
+    with open(csv_file_path, mode='r', encoding='utf-8') as file:
+        return next(csv.reader(file), [])
+
+
+def validate_csv_columns(parser, csv_filepaths, columns_by_service):
+    # Scans from before a column was added cannot be read with it, so they are rejected before any file is loaded
+    for service, csv_filepath in csv_filepaths.items():
+        header = read_csv_header(csv_filepath)
+        missing_columns = [column for column in columns_by_service[service] if column not in header]
+        if missing_columns:
+            parser.error(f"{csv_filepath} has no {', '.join(missing_columns)} column")
+
+
+def read_resources_from_sqlite(connection, snapshot_id, table, key_columns):
+    cursor = connection.execute(f'SELECT * FROM {table} WHERE snapshot_id = ?', (snapshot_id,))
+    header = [column[0] for column in cursor.description[1:]]
+    return index_resources(header, (row[1:] for row in cursor), key_columns)
+
+
+def generate_csv_filepaths(input_file):
+    input_file_path, input_file_extension = os.path.splitext(input_file)
+    return { service: os.path.expanduser(f'{input_file_path}-for-{service}{input_file_extension}') for service in RESOURCE_KEYS }
+
+
+def load_snapshot(csv_filepaths, group_by=('profile_prefix',)):
+    snapshot = { 'counts': {}, 'resources': {} }
+
+    # Each file is read once, and the coverage is counted from the rows of the index with the same rules as a normal run
+    for service, key_columns in RESOURCE_KEYS.items():
+        resources = read_resources(csv_filepaths[service], key_columns)
+        snapshot['resources'][service] = resources
+        snapshot['counts'][service] = count_service_with_waf(service, lambda columns: encode_columns(resources['header'], resources['rows'].values(), columns), group_by)
+
+    return snapshot
+
+
+def load_snapshot_from_sqlite(connection, snapshot_id, group_by=('profile_prefix',)):
+    return {
+        'counts': {
+            'cloudfront': count_cloudfront_with_waf_from_sqlite(connection, snapshot_id, group_by),
+            'elb': count_elb_with_waf_from_sqlite(connection, snapshot_id, group_by),
+            'apigw': count_apigw_with_waf_from_sqlite(connection, snapshot_id, group_by)
+        },
+        'resources': { service: read_resources_from_sqlite(connection, snapshot_id, service, key_columns) for service, key_columns in RESOURCE_KEYS.items() }
+    }
+
+
+def get_coverage_status(row, is_eligible, has_waf):
+    if row is None:
+        return 'absent'
+
+    rule_row = { column: value.lower() for column, value in row.items() }
+    if not is_eligible(rule_row):
+        return 'not eligible'
+
+    return 'protected' if has_waf(rule_row) else 'unprotected'
+
+
+def calculate_percentage(waf_count, total_count):
+    return (waf_count / total_count) * 100 if total_count else 0.0
+
+
+def calculate_coverage_delta(summarized_resources, group_key, old_status, new_status):
+    # The delta is how much the coverage of the group would move if this were the only change since the earlier scan
+    total_count = summarized_resources['total_resources'].get(group_key, 0)
+    waf_count = summarized_resources['waf_resources'].get(group_key, 0)
+    total_delta = STATUS_COUNTS[new_status][0] - STATUS_COUNTS[old_status][0]
+    waf_delta = STATUS_COUNTS[new_status][1] - STATUS_COUNTS[old_status][1]
+
+    return calculate_percentage(waf_count + waf_delta, total_count + total_delta) - calculate_percentage(waf_count, total_count)
+
+
+def diff_resources(service, old_resources, new_resources, old_summarized_resources, group_by=('profile_prefix',)):
+    if old_resources['header'] != new_resources['header']:
+        raise ValueError(f'the {service} snapshots have different columns')
+
+    header = new_resources['header']
+    old_rows = old_resources['rows']
+    new_rows = new_resources['rows']
+    is_eligible = COVERAGE_RULES[service]['is_eligible']
+    has_waf = COVERAGE_RULES[service]['has_waf']
+
+    # Rows are tuples, so the items of both key dicts are hashable and their symmetric difference keeps only the resources that differ.
+    # The whole join runs in C, and only the changed resources are turned into dicts.
+    changed_keys = { key for key, row in old_rows.items() ^ new_rows.items() }
+
+    changes = []
+    for key in changed_keys:
+        old_row = old_rows.get(key)
+        new_row = new_rows.get(key)
+
+        old_values = dict(zip(header, old_row)) if old_row is not None else None
+        new_values = dict(zip(header, new_row)) if new_row is not None else None
+        group_key = tuple((new_values or old_values)[column] for column in group_by)
+        old_status = get_coverage_status(old_values, is_eligible, has_waf)
+        new_status = get_coverage_status(new_values, is_eligible, has_waf)
+
+        changes.append({
+            'service': service,
+            'key': key,
+            'change': 'added' if old_row is None else 'removed' if new_row is None else 'changed',
+            'group_key': group_key,
+            'fields': {
+                column: (old_values[column], new_values[column])
+                for column in header if old_values and new_values and old_values[column] != new_values[column]
+            },
+            'old_status': old_status,
+            'new_status': new_status,
+            'coverage_delta': calculate_coverage_delta(old_summarized_resources, group_key, old_status, new_status)
+        })
+
+    return changes
+
+
+def diff_snapshots(old_snapshot, new_snapshot, group_by=('profile_prefix',)):
+    old_summarized_resources = summarize_waf_info(old_snapshot['counts']['cloudfront'], old_snapshot['counts']['elb'], old_snapshot['counts']['apigw'])
+    new_summarized_resources = summarize_waf_info(new_snapshot['counts']['cloudfront'], new_snapshot['counts']['elb'], new_snapshot['counts']['apigw'])
+
+    changes = []
+    for service in RESOURCE_KEYS:
+        changes.extend(diff_resources(service, old_snapshot['resources'][service], new_snapshot['resources'][service], old_summarized_resources, group_by))
+
+    # Lost coverage comes first, since that is what a diff is usually run for
+    changes.sort(key=lambda change: (change['coverage_delta'], change['service'], change['key']))
+    return { 'old': old_summarized_resources, 'new': new_summarized_resources, 'changes': changes }
+
+
+def print_snapshot_diff(snapshot_diff, group_by=('profile_prefix',)):
+    from tabulate import tabulate
+
+    change_counts = defaultdict(Counter)
+    for change in snapshot_diff['changes']:
+        change_counts[change['group_key']][change['change']] += 1
+
+    group_rows = []
+    for group_key in generate_group_keys(snapshot_diff['old'], snapshot_diff['new']):
+        old_coverage = calculate_percentage(snapshot_diff['old']['waf_resources'].get(group_key, 0), snapshot_diff['old']['total_resources'].get(group_key, 0))
+        new_coverage = calculate_percentage(snapshot_diff['new']['waf_resources'].get(group_key, 0), snapshot_diff['new']['total_resources'].get(group_key, 0))
+        if not change_counts[group_key] and old_coverage == new_coverage:
+            continue
+
+        group_rows.append(list(group_key) + [
+            f'{old_coverage:.2f}%',
+            f'{new_coverage:.2f}%',
+            f'{new_coverage - old_coverage:+.2f}',
+            change_counts[group_key]['added'],
+            change_counts[group_key]['removed'],
+            change_counts[group_key]['changed']
+        ])
+
+    print(tabulate(group_rows, headers=generate_group_headers(group_by) + ['Before', 'After', 'Delta', 'Added', 'Removed', 'Changed'], tablefmt='grid'))
+
+    resource_rows = [
+        [
+            change['service'],
+            change['change'],
+            '/'.join(change['key']),
+            '\n'.join(f'{column}: {old_value} -> {new_value}' for column, (old_value, new_value) in change['fields'].items()),
+            f"{change['old_status']} -> {change['new_status']}" if change['old_status'] != change['new_status'] else change['new_status'],
+            f"{change['coverage_delta']:+.2f}"
+        ]
+        for change in snapshot_diff['changes']
+    ]
+    print(tabulate(resource_rows, headers=['Service', 'Change', 'Resource', 'Fields', 'Coverage', 'Delta'], tablefmt='grid'))
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    validate_group_by(parser, args.group_by)
+
+    if args.diff_snapshot is not None and not args.sqlite_file:
+        parser.error('--diff-snapshot requires --sqlite-file')
+
+    if args.diff_input_file and args.sqlite_file:
+        parser.error('--diff-input-file cannot be combined with --sqlite-file, use --diff-snapshot')
+
+    if args.diff_input_file or args.diff_snapshot is not None:
+        if args.sqlite_file:
+            connection, snapshot_id = connect_sqlite_snapshot(parser, args.sqlite_file, args.snapshot)
+            if not is_snapshot_complete(connection, args.diff_snapshot):
+                parser.error(f'--diff-snapshot {args.diff_snapshot} is not a complete snapshot in {args.sqlite_file}')
+
+            old_snapshot = load_snapshot_from_sqlite(connection, args.diff_snapshot, args.group_by)
+            new_snapshot = load_snapshot_from_sqlite(connection, snapshot_id, args.group_by)
+            connection.close()
+        else:
+            old_csv_filepaths = generate_csv_filepaths(args.diff_input_file)
+            new_csv_filepaths = generate_csv_filepaths(args.input_file)
+            validate_csv_columns(parser, old_csv_filepaths, generate_required_columns(args.group_by, with_keys=True))
+            validate_csv_columns(parser, new_csv_filepaths, generate_required_columns(args.group_by, with_keys=True))
+
+            old_snapshot = load_snapshot(old_csv_filepaths, args.group_by)
+            new_snapshot = load_snapshot(new_csv_filepaths, args.group_by)
+
+        print_snapshot_diff(diff_snapshots(old_snapshot, new_snapshot, args.group_by), args.group_by)
+        return
+
+    input_csv_filepath = os.path.expanduser(args.input_file)
+    input_file_path, input_file_extension = os.path.splitext(args.input_file)
+    elb_csv_filepath = os.path.expanduser(f'{input_file_path}-for-elb{input_file_extension}')
+    cloudfront_csv_filepath = os.path.expanduser(f'{input_file_path}-for-cloudfront{input_file_extension}')
+    apigw_csv_filepath = os.path.expanduser(f'{input_file_path}-for-apigw{input_file_extension}')
+
+    if args.sqlite_file:
+        connection, snapshot_id = connect_sqlite_snapshot(parser, args.sqlite_file, args.snapshot)
+        cloudfront_resources = count_cloudfront_with_waf_from_sqlite(connection, snapshot_id, args.group_by)
+        elb_resources = count_elb_with_waf_from_sqlite(connection, snapshot_id, args.group_by)
+        apigw_resources = count_apigw_with_waf_from_sqlite(connection, snapshot_id, args.group_by)
+        connection.close()
+    else:
+        csv_filepaths = { 'cloudfront': cloudfront_csv_filepath, 'elb': elb_csv_filepath, 'apigw': apigw_csv_filepath }
+        validate_csv_columns(parser, csv_filepaths, generate_required_columns(args.group_by))
+
+        cloudfront_resources = count_cloudfront_with_waf(cloudfront_csv_filepath, args.group_by)
+        elb_resources = count_elb_with_waf(elb_csv_filepath, args.group_by)
+        apigw_resources = count_apigw_with_waf(apigw_csv_filepath, args.group_by)
 
     summarized_resources = summarize_waf_info(cloudfront_resources, elb_resources, apigw_resources)
 
     if args.debug:
-        print_debug_table(summarized_resources, cloudfront_resources, elb_resources, apigw_resources)
+        print_debug_table(summarized_resources, cloudfront_resources, elb_resources, apigw_resources, args.group_by)
 
     cloudfront_coverage = calculate_waf_coverage(cloudfront_resources)
     elb_coverage = calculate_waf_coverage(elb_resources)
     apigw_coverage = calculate_waf_coverage(apigw_resources)
     summarized_coverage = calculate_waf_coverage(summarized_resources)
 
-    print_coverage_table(summarized_resources, cloudfront_coverage, elb_coverage, apigw_coverage)
+    print_coverage_table(summarized_resources, cloudfront_coverage, elb_coverage, apigw_coverage, summarized_coverage, args.group_by)
+
+
+if __name__ == '__main__':
+    main()
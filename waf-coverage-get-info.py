@@ -1,23 +1,41 @@
 import argparse
-import boto3
+import bisect
 import csv
+import gzip
+import hashlib
+import json
 import os
-from tqdm import tqdm
+import random
+import sqlite3
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from scripts_common import SERVICES, add_scan_arguments, validate_services
 
 # TODO: suporte a tag 'et:waf-ignore' para CloudFront
 # TODO: suporte a tag 'et:waf-ignore' para API Gateway
 
-parser = argparse.ArgumentParser(description='Set AWS SSO profiles from a CSV file.')
-parser.add_argument('--input-file', default='workspace/aws-profiles.csv', help='Input CSV file. Default is aws-profiles.csv.')
+parser = argparse.ArgumentParser(description='Get the WAF association of CloudFront, ELB and API Gateway entrypoints in every account.')
+add_scan_arguments(parser)
+parser.add_argument('--shard', type=lambda value: tuple(int(part) for part in value.split('/')), help='Scan only the K-th of N stable slices of the profiles, as K/N. Default is all profiles.')
 parser.add_argument('--output-file', default='workspace/waf-coverage.csv', help='Output CSV file. Default is waf-coverage.csv.')
-
-args = parser.parse_args()
-
-input_csv_filepath = os.path.expanduser(args.input_file)
-output_file_path, output_file_extension = os.path.splitext(args.output_file)
-elb_csv_filepath = os.path.expanduser(f'{output_file_path}-for-elb{output_file_extension}')
-cloudfront_csv_filepath = os.path.expanduser(f'{output_file_path}-for-cloudfront{output_file_extension}')
-apigw_csv_filepath = os.path.expanduser(f'{output_file_path}-for-apigw{output_file_extension}')
+parser.add_argument('--credential-workers', type=int, default=16, help='Number of profiles whose credentials are resolved in parallel before the scan. Default is 16.')
+parser.add_argument('--web-acl-cache-ttl', type=int, default=86400, help='Seconds a cached WebACL name stays valid. Default is 86400.')
+parser.add_argument('--web-acl-cache-max-entries', type=int, default=10000, help='Maximum number of WebACL names kept in the cache file. Default is 10000.')
+parser.add_argument('--sqlite-file', help='Also store the scan as a snapshot in this SQLite database.')
+parser.add_argument('--resume', action='store_true', help='Skip accounts that already have a valid checkpoint shard.')
+parser.add_argument('--max-age', type=int, help='Seconds after the last full scan of an account after which its checkpoint shard is stale and the account is scanned again in full.')
+parser.add_argument('--cloudtrail-dir', help='Refresh accounts with a checkpoint shard from the CloudTrail log files in this directory instead of scanning them again.')
+parser.add_argument('--cloudtrail-s3', help='Refresh accounts with a checkpoint shard from the CloudTrail log files under this s3://bucket/prefix instead of scanning them again.')
+parser.add_argument('--cloudtrail-profile', help='Profile used to read the CloudTrail log files from S3. Default is the default profile.')
+parser.add_argument('--metrics-file', help='JSON report with count, latency, retries and errors of each AWS API per account. Default is the output file name with a -api-metrics.json suffix.')
+parser.add_argument('--prometheus-file', help='Also write the API metrics in the Prometheus textfile format to this file.')
+parser.add_argument('--config-aggregator', help='Read the inventory from this AWS Config aggregator. The resource types it does not record in an account and region are scanned directly there.')
+parser.add_argument('--config-aggregator-profile', help='Profile from the input file of the account that owns the Config aggregator.')
+parser.add_argument('--config-aggregator-region', help='Region of the Config aggregator. Default is the profile region.')
 
 
 def read_profiles_from_csv(csv_filepath):
@@ -33,15 +51,420 @@ def read_profiles_from_csv(csv_filepath):
     return profiles
 
 
-def generate_basic_info(profile_info):
+BASIC_FIELDNAMES = ['sso_session', 'profile_prefix', 'profile_name', 'account_id', 'region']
+ELB_FIELDNAMES = [
+    *BASIC_FIELDNAMES,
+    'name', 'version', 'type', 'scheme', 'associated_waf', 'waf_version', 'marked_as_waf_ignore'
+]
+CLOUDFRONT_FIELDNAMES = [
+    *BASIC_FIELDNAMES,
+    'distribution_id', 'distribution_name', 'associated_waf', 'waf_version'
+]
+APIGW_FIELDNAMES = [
+    *BASIC_FIELDNAMES,
+    'api_gateway_id', 'api_gateway_name', 'protocol', 'endpoint_type', 'stage_name', 'associated_waf', 'waf_version'
+]
+FIELDNAMES = { 'elb': ELB_FIELDNAMES, 'cloudfront': CLOUDFRONT_FIELDNAMES, 'apigw': APIGW_FIELDNAMES }
+
+# Collectors only keep the resource columns, the account and region columns are added once per region when the CSV is written
+ElbRecord = namedtuple('ElbRecord', ELB_FIELDNAMES[len(BASIC_FIELDNAMES):])
+CloudFrontRecord = namedtuple('CloudFrontRecord', CLOUDFRONT_FIELDNAMES[len(BASIC_FIELDNAMES):])
+ApigwRecord = namedtuple('ApigwRecord', APIGW_FIELDNAMES[len(BASIC_FIELDNAMES):])
+
+
+def get_profile_shard(profile_info, shard_count):
+    # Profiles are sliced by account, so the rate limits of an account are only ever used from one runner
+    account_hash = hashlib.sha256(profile_info['account_id'].encode()).hexdigest()
+    return int(account_hash, 16) % shard_count + 1
+
+
+def generate_basic_info(profile_info, region_name):
     return {
         'sso_session': profile_info['sso_session'],
         'profile_prefix': profile_info['profile_name'].split('-')[0],
         'profile_name': profile_info['profile_name'],
-        'account_id': profile_info['account_id']
+        'account_id': profile_info['account_id'],
+        'region': region_name
+    }
+
+
+def create_rate_limiter(initial_rate=10.0, max_rate=50.0, min_rate=0.5, max_attempts=10, retry_budget=1000, max_backoff=20.0):
+    from botocore.retries.standard import ThrottledRetryableChecker, TransientRetryableChecker
+
+    return {
+        'initial_rate': initial_rate,
+        'max_rate': max_rate,
+        'min_rate': min_rate,
+        'max_attempts': max_attempts,
+        'retry_budget': retry_budget,
+        'max_backoff': max_backoff,
+        'buckets': {},
+        'retries': 0,
+        'throttles': defaultdict(int),
+        'throttled_checker': ThrottledRetryableChecker(),
+        'transient_checker': TransientRetryableChecker(),
+        'lock': threading.Lock()
+    }
+
+
+def get_token_bucket(rate_limiter, account_id, region_name, service_name):
+    # AWS throttles per account, region and API, so each combination gets its own bucket shared by all clients
+    with rate_limiter['lock']:
+        return rate_limiter['buckets'].setdefault((account_id, region_name, service_name), {
+            'rate': rate_limiter['initial_rate'],
+            'tokens': 1.0,
+            'updated_at': time.monotonic(),
+            'lock': threading.Lock()
+        })
+
+
+def acquire_token(token_bucket):
+    while True:
+        with token_bucket['lock']:
+            now = time.monotonic()
+            capacity = max(1.0, token_bucket['rate'])
+            token_bucket['tokens'] = min(capacity, token_bucket['tokens'] + (now - token_bucket['updated_at']) * token_bucket['rate'])
+            token_bucket['updated_at'] = now
+
+            if token_bucket['tokens'] >= 1:
+                token_bucket['tokens'] -= 1
+                return
+
+            wait = (1 - token_bucket['tokens']) / token_bucket['rate']
+
+        time.sleep(wait)
+
+
+def handle_retry(rate_limiter, token_bucket, response, attempts, caught_exception, operation, request_dict, **kwargs):
+    from botocore.retries.standard import RetryContext
+
+    http_response, parsed_response = response if response is not None else (None, None)
+    retry_context = RetryContext(
+        attempt_number=attempts,
+        operation_model=operation,
+        parsed_response=parsed_response,
+        http_response=http_response,
+        caught_exception=caught_exception,
+        request_context=request_dict['context']
+    )
+
+    # Additive increase on success and multiplicative decrease on throttles keeps each bucket close to the highest sustainable rate
+    if rate_limiter['throttled_checker'].is_retryable(retry_context):
+        with token_bucket['lock']:
+            token_bucket['rate'] = max(rate_limiter['min_rate'], token_bucket['rate'] / 2)
+        with rate_limiter['lock']:
+            rate_limiter['throttles'][f'{operation.service_model.service_name}.{operation.name}'] += 1
+    elif not rate_limiter['transient_checker'].is_retryable(retry_context):
+        if caught_exception is None and http_response.status_code < 300:
+            with token_bucket['lock']:
+                token_bucket['rate'] = min(rate_limiter['max_rate'], token_bucket['rate'] + 0.5)
+        return None
+
+    if attempts >= rate_limiter['max_attempts']:
+        return None
+
+    with rate_limiter['lock']:
+        if rate_limiter['retries'] >= rate_limiter['retry_budget']:
+            return None
+        rate_limiter['retries'] += 1
+
+    return random.uniform(0, min(rate_limiter['max_backoff'], 0.5 * 2 ** attempts))
+
+
+API_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def create_api_metrics(latency_buckets=API_LATENCY_BUCKETS):
+    return {
+        'latency_buckets': latency_buckets,
+        'operations': {},
+        'lock': threading.Lock()
+    }
+
+
+def start_api_call(model, context, **kwargs):
+    context['api_call'] = (model.service_model.service_name, model.name, time.perf_counter())
+
+
+def record_api_call(api_metrics, account_id, context, http_response=None, exception=None, **kwargs):
+    service_name, operation_name, started_at = context['api_call']
+    latency = time.perf_counter() - started_at
+
+    # The latency covers every attempt of the call, including retries and backoff
+    retries = context.get('retries', {}).get('attempt', 1) - 1
+    failed = exception is not None or http_response.status_code >= 300
+
+    with api_metrics['lock']:
+        operation_metrics = api_metrics['operations'].setdefault((service_name, operation_name, account_id), {
+            'count': 0,
+            'errors': 0,
+            'retries': 0,
+            'latency_sum': 0.0,
+            'latency_max': 0.0,
+            'latency_counts': [0] * (len(api_metrics['latency_buckets']) + 1)
+        })
+        operation_metrics['count'] += 1
+        operation_metrics['errors'] += failed
+        operation_metrics['retries'] += retries
+        operation_metrics['latency_sum'] += latency
+        operation_metrics['latency_max'] = max(operation_metrics['latency_max'], latency)
+        operation_metrics['latency_counts'][bisect.bisect_left(api_metrics['latency_buckets'], latency)] += 1
+
+
+def register_api_metrics(client, api_metrics, account_id):
+    # Registered first so a handler that answers the call itself cannot skip the timer
+    client.meta.events.register_first('before-call', start_api_call)
+    client.meta.events.register('after-call', lambda **kwargs: record_api_call(api_metrics, account_id, **kwargs))
+    client.meta.events.register('after-call-error', lambda **kwargs: record_api_call(api_metrics, account_id, **kwargs))
+
+
+def generate_latency_histogram(latency_buckets, latency_counts):
+    latency_histogram = {}
+    cumulative_count = 0
+    for latency_bucket, latency_count in zip([*latency_buckets, '+Inf'], latency_counts):
+        cumulative_count += latency_count
+        latency_histogram[str(latency_bucket)] = cumulative_count
+    return latency_histogram
+
+
+def generate_api_metrics_report(api_metrics):
+    with api_metrics['lock']:
+        operations = sorted(api_metrics['operations'].items())
+
+    return {
+        'latency_buckets': list(api_metrics['latency_buckets']),
+        'operations': [
+            {
+                'service': service_name,
+                'operation': operation_name,
+                'account_id': account_id,
+                'count': operation_metrics['count'],
+                'errors': operation_metrics['errors'],
+                'retries': operation_metrics['retries'],
+                'latency_sum': round(operation_metrics['latency_sum'], 6),
+                'latency_max': round(operation_metrics['latency_max'], 6),
+                'latency_histogram': generate_latency_histogram(api_metrics['latency_buckets'], operation_metrics['latency_counts'])
+            }
+            for (service_name, operation_name, account_id), operation_metrics in operations
+        ]
+    }
+
+
+def save_api_metrics_report(api_metrics_report, json_filepath):
+    with open(json_filepath, mode='w', encoding='utf-8') as file:
+        json.dump(api_metrics_report, file, indent=2)
+
+
+def save_api_metrics_prometheus(api_metrics_report, prometheus_filepath):
+    lines = []
+    for metric_name, metric_type, report_key, help_text in (
+        ('waf_coverage_aws_api_calls_total', 'counter', 'count', 'AWS API calls made by the WAF coverage scan.'),
+        ('waf_coverage_aws_api_errors_total', 'counter', 'errors', 'AWS API calls that failed after all retries.'),
+        ('waf_coverage_aws_api_retries_total', 'counter', 'retries', 'Retries of AWS API calls.'),
+        ('waf_coverage_aws_api_call_duration_seconds', 'histogram', 'latency_histogram', 'Duration of AWS API calls, including retries.')
+    ):
+        lines.append(f'# HELP {metric_name} {help_text}')
+        lines.append(f'# TYPE {metric_name} {metric_type}')
+
+        for operation in api_metrics_report['operations']:
+            labels = f"service=\"{operation['service']}\",operation=\"{operation['operation']}\",account_id=\"{operation['account_id']}\""
+            if metric_type == 'counter':
+                lines.append(f'{metric_name}{{{labels}}} {operation[report_key]}')
+                continue
+
+            for latency_bucket, cumulative_count in operation[report_key].items():
+                lines.append(f'{metric_name}_bucket{{{labels},le="{latency_bucket}"}} {cumulative_count}')
+            lines.append(f"{metric_name}_sum{{{labels}}} {operation['latency_sum']}")
+            lines.append(f"{metric_name}_count{{{labels}}} {operation['count']}")
+
+    # The textfile collector may read at any time, so the file is replaced atomically
+    temporary_filepath = f'{prometheus_filepath}.tmp'
+    with open(temporary_filepath, mode='w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary_filepath, prometheus_filepath)
+
+
+def print_api_metrics_summary(api_metrics_report, top=5):
+    accounts = defaultdict(lambda: { 'count': 0, 'latency_sum': 0.0 })
+    operations = defaultdict(lambda: { 'count': 0, 'errors': 0, 'retries': 0, 'latency_sum': 0.0, 'latency_max': 0.0 })
+    for operation in api_metrics_report['operations']:
+        accounts[operation['account_id']]['count'] += operation['count']
+        accounts[operation['account_id']]['latency_sum'] += operation['latency_sum']
+
+        operation_totals = operations[f"{operation['service']}.{operation['operation']}"]
+        for metric in ('count', 'errors', 'retries', 'latency_sum'):
+            operation_totals[metric] += operation[metric]
+        operation_totals['latency_max'] = max(operation_totals['latency_max'], operation['latency_max'])
+
+    print('Slowest accounts:')
+    for account_id, account_totals in sorted(accounts.items(), key=lambda item: item[1]['latency_sum'], reverse=True)[:top]:
+        print(f"  {account_id}: {account_totals['latency_sum']:.1f}s in {account_totals['count']} calls")
+
+    print('Hottest operations:')
+    for api_name, operation_totals in sorted(operations.items(), key=lambda item: item[1]['latency_sum'], reverse=True)[:top]:
+        print(
+            f"  {api_name}: {operation_totals['latency_sum']:.1f}s in {operation_totals['count']} calls, "
+            f"avg {operation_totals['latency_sum'] / operation_totals['count']:.3f}s, max {operation_totals['latency_max']:.3f}s, "
+            f"{operation_totals['retries']} retries, {operation_totals['errors']} errors"
+        )
+
+
+SERVICE_MODEL_LOADER = { 'loader': None, 'lock': threading.Lock() }
+
+
+def create_session(profile_name):
+    import boto3
+    import botocore.loaders
+    import botocore.session
+
+    # Service models are parsed once and shared by every account session
+    with SERVICE_MODEL_LOADER['lock']:
+        if SERVICE_MODEL_LOADER['loader'] is None:
+            SERVICE_MODEL_LOADER['loader'] = botocore.loaders.create_loader()
+
+    botocore_session = botocore.session.get_session()
+    botocore_session.register_component('data_loader', SERVICE_MODEL_LOADER['loader'])
+    return boto3.Session(profile_name=profile_name, botocore_session=botocore_session)
+
+
+def create_session_with_credentials(profile_name):
+    from botocore.exceptions import NoCredentialsError
+
+    session = create_session(profile_name)
+    credentials = session.get_credentials()
+
+    if credentials is None:
+        raise NoCredentialsError()
+
+    # SSO credentials are refreshable, so botocore renews them shortly before they expire during long scans
+    credentials.get_frozen_credentials()
+    return session
+
+
+def prewarm_credentials(profiles, max_workers=16):
+    sessions = {}
+    failed_profiles = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(create_session_with_credentials, profile_info['profile_name']) for profile_info in profiles]
+
+        for profile_info, future in zip(profiles, futures):
+            try:
+                sessions[profile_info['profile_name']] = future.result()
+            except Exception as error:
+                print(f"Failed to resolve credentials for profile: {profile_info['profile_name']}: {error}")
+                failed_profiles.append({ **profile_info, 'error': str(error) })
+
+    return sessions, failed_profiles
+
+
+def create_client(session, service_name, profile_info, scan_options, region_name=None):
+    from botocore.config import Config
+
+    rate_limiter = scan_options['rate_limiter']
+    if rate_limiter is None:
+        client = session.client(service_name, region_name=region_name)
+    else:
+        # Retries are handled by handle_retry, so botocore is left with a single attempt
+        client = session.client(service_name, region_name=region_name, config=Config(retries={ 'mode': 'standard', 'total_max_attempts': 1 }))
+        token_bucket = get_token_bucket(rate_limiter, profile_info['account_id'], client.meta.region_name, service_name)
+        client.meta.events.register('before-send', lambda **kwargs: acquire_token(token_bucket))
+        client.meta.events.register_first('needs-retry', lambda **kwargs: handle_retry(rate_limiter, token_bucket, **kwargs))
+
+    if scan_options['api_metrics'] is not None:
+        register_api_metrics(client, scan_options['api_metrics'], profile_info['account_id'])
+
+    return client
+
+
+def create_client_pool(session, profile_info, scan_options):
+    return {
+        'session': session,
+        'profile_info': profile_info,
+        'scan_options': scan_options,
+        'clients': {},
+        'lock': threading.Lock()
+    }
+
+
+def get_client(client_pool, service_name, region_name=None):
+    # Clients are built on first use, and the lock keeps the regions of an account from using the session concurrently
+    with client_pool['lock']:
+        if (service_name, region_name) not in client_pool['clients']:
+            client_pool['clients'][(service_name, region_name)] = create_client(
+                client_pool['session'], service_name, client_pool['profile_info'], client_pool['scan_options'], region_name
+            )
+        return client_pool['clients'][(service_name, region_name)]
+
+
+def get_enabled_regions(ec2_client):
+    response = ec2_client.describe_regions(AllRegions=False)
+    return sorted(region['RegionName'] for region in response['Regions'])
+
+
+def resolve_regions(client_pool):
+    regions = client_pool['scan_options']['regions']
+
+    if not regions:
+        return [client_pool['session'].region_name]
+
+    if regions == ['all']:
+        return get_enabled_regions(get_client(client_pool, 'ec2'))
+
+    return regions
+
+
+def load_web_acl_name_cache(cache_filepath, ttl=86400, max_entries=10000):
+    entries = {}
+    if os.path.exists(cache_filepath):
+        with open(cache_filepath, mode='r', encoding='utf-8') as file:
+            entries = json.load(file)
+
+    now = time.time()
+    return {
+        'entries': { key: entry for key, entry in entries.items() if now - entry['cached_at'] < ttl },
+        'ttl': ttl,
+        'max_entries': max_entries,
+        'hits': 0,
+        'misses': 0,
+        'lock': threading.Lock()
     }
 
 
+def save_web_acl_name_cache(web_acl_name_cache, cache_filepath):
+    with web_acl_name_cache['lock']:
+        entries = sorted(web_acl_name_cache['entries'].items(), key=lambda item: item[1]['cached_at'], reverse=True)
+        entries = dict(entries[:web_acl_name_cache['max_entries']])
+
+    with open(f'{cache_filepath}.tmp', mode='w', encoding='utf-8') as file:
+        json.dump(entries, file)
+    os.replace(f'{cache_filepath}.tmp', cache_filepath)
+
+
+def cache_web_acl_name(web_acl_name_cache, service_name, web_acl_id, web_acl_name):
+    if web_acl_name_cache is None:
+        return
+
+    with web_acl_name_cache['lock']:
+        web_acl_name_cache['entries'][f'{service_name}:{web_acl_id}'] = { 'name': web_acl_name, 'cached_at': time.time() }
+
+
+def get_web_acl_name(client_pool, service_name, web_acl_id, web_acl_name_cache=None, region_name=None):
+    # WAF Classic global (waf, for CloudFront) and regional (waf-regional, for the REST stages of the Config inventory) share the GetWebACL API
+    if web_acl_name_cache is not None:
+        with web_acl_name_cache['lock']:
+            entry = web_acl_name_cache['entries'].get(f'{service_name}:{web_acl_id}')
+
+            if entry and time.time() - entry['cached_at'] < web_acl_name_cache['ttl']:
+                web_acl_name_cache['hits'] += 1
+                return entry['name']
+
+            web_acl_name_cache['misses'] += 1
+
+    response = get_client(client_pool, service_name, region_name).get_web_acl(WebACLId=web_acl_id)
+    cache_web_acl_name(web_acl_name_cache, service_name, web_acl_id, response['WebACL']['Name'])
+    return response['WebACL']['Name']
+
+
 def get_all_elbv2_load_balancers(elbv2_client, page_size=400):
     elbs_v2 = []
     paginator = elbv2_client.get_paginator('describe_load_balancers')
@@ -85,237 +508,1099 @@ def get_all_api_gateways_v1(apigw_client):
     return api_gateways
 
 
-def get_elbv2_info(elbv2_client, wafv2_client, waf_regional_client, profile_info):
-    elbs_v2 = get_all_elbv2_load_balancers(elbv2_client)
+def get_all_wafv2_web_acls(wafv2_client, scope='REGIONAL'):
+    web_acls = []
+    params = {'Scope': scope}
+    while True:
+        response = wafv2_client.list_web_acls(**params)
+        web_acls.extend(response['WebACLs'])
+        if not response.get('NextMarker') or not response['WebACLs']:
+            return web_acls
+        params['NextMarker'] = response['NextMarker']
 
-    elb_info_list = []
-    for elb in tqdm(elbs_v2, desc='ELB v2'):
-        tags_response = elbv2_client.describe_tags(ResourceArns=[elb['LoadBalancerArn']])
-        tags = tags_response['TagDescriptions'][0]['Tags']
-        waf_ignore = any(tag['Key'] == 'et:waf-ignore' for tag in tags)
-
-        basic_info = generate_basic_info(profile_info)
-        elb_info = {
-            **basic_info,
-            'name': elb['LoadBalancerName'],
-            'version': 'v2',
-            'type': elb['Type'],
-            'scheme': elb['Scheme'],
-            'associated_waf': 'None',
-            'waf_version': 'None',
-            'marked_as_waf_ignore': waf_ignore
-        }
 
-        response = {}
+def get_all_waf_regional_web_acls(waf_regional_client):
+    web_acls = []
+    params = {}
+    while True:
+        response = waf_regional_client.list_web_acls(**params)
+        web_acls.extend(response['WebACLs'])
+        if not response.get('NextMarker') or not response['WebACLs']:
+            return web_acls
+        params['NextMarker'] = response['NextMarker']
 
-        if elb['Type'] == 'network':
-            elb_info['associated_waf'] = 'N/A'
-            elb_info['waf_version'] = 'N/A'
-            elb_info_list.append(elb_info)
-            continue
 
-        if elb['Type'] == 'application':
-            response = wafv2_client.get_web_acl_for_resource(ResourceArn=elb['LoadBalancerArn'])
+def build_web_acl_index(client_pool, region_name, web_acl_name_cache=None, resource_types=('APPLICATION_LOAD_BALANCER', 'API_GATEWAY')):
+    wafv2_client = get_client(client_pool, 'wafv2', region_name)
+    waf_regional_client = get_client(client_pool, 'waf-regional', region_name)
+    web_acl_index = {}
 
-            if 'WebACL' in response:
-                elb_info['associated_waf'] = response['WebACL']['Name']
-                elb_info['waf_version'] = 'v2'
-                elb_info_list.append(elb_info)
-                continue
+    # WAF Classic is indexed first so that WAFv2 wins when a resource is associated with both, as in get_web_acl_for_resource
+    for web_acl in get_all_waf_regional_web_acls(waf_regional_client):
+        cache_web_acl_name(web_acl_name_cache, 'waf-regional', web_acl['WebACLId'], web_acl['Name'])
 
-            response = waf_regional_client.get_web_acl_for_resource(ResourceArn=elb['LoadBalancerArn'])
+        for resource_type in resource_types:
+            response = waf_regional_client.list_resources_for_web_acl(WebACLId=web_acl['WebACLId'], ResourceType=resource_type)
+            for resource_arn in response['ResourceArns']:
+                web_acl_index[resource_arn] = { 'name': web_acl['Name'], 'waf_version': 'v1' }
 
-            if 'WebACLSummary' in response:
-                elb_info['associated_waf'] = response['WebACLSummary']['Name']
-                elb_info['waf_version'] = 'v1'
-                elb_info_list.append(elb_info)
-                continue
+    for web_acl in get_all_wafv2_web_acls(wafv2_client):
+        for resource_type in resource_types:
+            response = wafv2_client.list_resources_for_web_acl(WebACLArn=web_acl['ARN'], ResourceType=resource_type)
+            for resource_arn in response['ResourceArns']:
+                web_acl_index[resource_arn] = { 'name': web_acl['Name'], 'waf_version': 'v2' }
 
-        elb_info_list.append(elb_info)
+    return web_acl_index
 
-    return elb_info_list
 
+def get_web_acl_for_resource(resource_arn, client_pool, region_name, web_acl_index=None):
+    if web_acl_index is not None:
+        return web_acl_index.get(resource_arn)
 
-def get_elbv1_info(elb_client, profile_info):
-    elbs_v1 = get_all_elbv1_load_balancers(elb_client)
+    response = get_client(client_pool, 'wafv2', region_name).get_web_acl_for_resource(ResourceArn=resource_arn)
 
-    elb_info_list = []
-    for elb in tqdm(elbs_v1, desc='ELB Classic'):
-        basic_info = generate_basic_info(profile_info)
-        elb_info = {
-            **basic_info,
-            'name': elb['LoadBalancerName'],
-            'version': 'v1',
-            'type': 'classic',
-            'scheme': elb['Scheme'],
-            'associated_waf': 'N/A',
-            'waf_version': 'N/A',
-            'marked_as_waf_ignore': False
-        }
+    if 'WebACL' in response:
+        return { 'name': response['WebACL']['Name'], 'waf_version': 'v2' }
 
-        elb_info_list.append(elb_info)
+    response = get_client(client_pool, 'waf-regional', region_name).get_web_acl_for_resource(ResourceArn=resource_arn)
 
-    return elb_info_list
+    if 'WebACLSummary' in response:
+        return { 'name': response['WebACLSummary']['Name'], 'waf_version': 'v1' }
 
+    return None
 
-def get_cloudfront_info(cloudfront_client, waf_global_client, profile_info):
-    distributions = get_all_cloudfront_distributions(cloudfront_client)
 
-    cloudfront_info_list = []
-    for dist in tqdm(distributions, desc='CloudFront Distribution'):
-        distribution_name = dist['Aliases']['Items'][0] if dist['Aliases']['Quantity'] > 0 else dist['DomainName']
-        web_acl_name = dist['WebACLId'] if dist['WebACLId'] != '' else 'None'
-        waf_version = 'None'
+def get_elbv2_tags(elbv2_client, elb_arns, batch_size=20):
+    # DescribeTags accepts up to 20 ARNs per request
+    tags_by_arn = {}
+    for i in range(0, len(elb_arns), batch_size):
+        tags_response = elbv2_client.describe_tags(ResourceArns=elb_arns[i:i + batch_size])
+        for tag_description in tags_response['TagDescriptions']:
+            tags_by_arn[tag_description['ResourceArn']] = tag_description['Tags']
+    return tags_by_arn
 
-        if web_acl_name != 'None':
-            web_acl_name_segments = web_acl_name.split('/')
 
-            if len(web_acl_name_segments) > 1:
-                web_acl_name = web_acl_name_segments[-2]
-                waf_version = 'v2'
-            else:
-                response = waf_global_client.get_web_acl(WebACLId=web_acl_name)
-                web_acl_name = response['WebACL']['Name']
-                waf_version = 'v1'
+def map_resources(function, resources, max_workers=1, desc=None):
+    from tqdm import tqdm
 
-        basic_info = generate_basic_info(profile_info)
-        cloudfront_info = {
-            **basic_info,
-            'distribution_id': dist['Id'],
-            'distribution_name': distribution_name,
-            'associated_waf': web_acl_name,
-            'waf_version': waf_version
-        }
+    if max_workers <= 1:
+        for result in tqdm(map(function, resources), total=len(resources), desc=desc):
+            yield result
+        return
+
+    # executor.map yields in input order, so the rows keep the order of the listing whatever call finishes first
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in tqdm(executor.map(function, resources), total=len(resources), desc=desc):
+            yield result
+
+
+def generate_elbv2_info(elb, tags_by_arn, client_pool, region_name, web_acl_index=None):
+    tags = tags_by_arn.get(elb['LoadBalancerArn'], [])
+    waf_ignore = any(tag['Key'] == 'et:waf-ignore' for tag in tags)
+    associated_waf = 'None'
+    waf_version = 'None'
+
+    if elb['Type'] == 'network':
+        associated_waf = 'N/A'
+        waf_version = 'N/A'
+
+    if elb['Type'] == 'application':
+        web_acl = get_web_acl_for_resource(elb['LoadBalancerArn'], client_pool, region_name, web_acl_index)
+
+        if web_acl:
+            associated_waf = web_acl['name']
+            waf_version = web_acl['waf_version']
+
+    return ElbRecord(
+        name=elb['LoadBalancerName'],
+        version='v2',
+        type=elb['Type'],
+        scheme=elb['Scheme'],
+        associated_waf=associated_waf,
+        waf_version=waf_version,
+        marked_as_waf_ignore=waf_ignore
+    )
+
+
+def get_elbv2_info(client_pool, region_name, web_acl_index=None, max_workers=1):
+    elbv2_client = get_client(client_pool, 'elbv2', region_name)
+    elbs_v2 = get_all_elbv2_load_balancers(elbv2_client)
+    tags_by_arn = get_elbv2_tags(elbv2_client, [elb['LoadBalancerArn'] for elb in elbs_v2])
+
+    elb_infos = map_resources(
+        lambda elb: generate_elbv2_info(elb, tags_by_arn, client_pool, region_name, web_acl_index),
+        elbs_v2, max_workers, desc=f'ELB v2 ({region_name})'
+    )
+    for elb_info in elb_infos:
+        yield elb_info
+
+
+def generate_elbv1_info(elb):
+    return ElbRecord(
+        name=elb['LoadBalancerName'],
+        version='v1',
+        type='classic',
+        scheme=elb['Scheme'],
+        associated_waf='N/A',
+        waf_version='N/A',
+        marked_as_waf_ignore=False
+    )
+
+
+def get_elbv1_info(client_pool, region_name):
+    elbs_v1 = get_all_elbv1_load_balancers(get_client(client_pool, 'elb', region_name))
+
+    for elb_info in map_resources(generate_elbv1_info, elbs_v1, desc=f'ELB Classic ({region_name})'):
+        yield elb_info
+
+
+def generate_cloudfront_info(dist, client_pool, web_acl_name_cache=None):
+    distribution_name = dist['Aliases']['Items'][0] if dist['Aliases']['Quantity'] > 0 else dist['DomainName']
+    web_acl_name = dist['WebACLId'] if dist['WebACLId'] != '' else 'None'
+    waf_version = 'None'
+
+    if web_acl_name != 'None':
+        web_acl_name_segments = web_acl_name.split('/')
+
+        if len(web_acl_name_segments) > 1:
+            web_acl_name = web_acl_name_segments[-2]
+            waf_version = 'v2'
+        else:
+            web_acl_name = get_web_acl_name(client_pool, 'waf', web_acl_name, web_acl_name_cache)
+            waf_version = 'v1'
+
+    return CloudFrontRecord(
+        distribution_id=dist['Id'],
+        distribution_name=distribution_name,
+        associated_waf=web_acl_name,
+        waf_version=waf_version
+    )
+
+
+def get_cloudfront_info(client_pool, web_acl_name_cache=None):
+    distributions = get_all_cloudfront_distributions(get_client(client_pool, 'cloudfront'))
 
-        cloudfront_info_list.append(cloudfront_info)
-    
-    return cloudfront_info_list
+    cloudfront_infos = map_resources(
+        lambda dist: generate_cloudfront_info(dist, client_pool, web_acl_name_cache),
+        distributions, desc='CloudFront Distribution'
+    )
+    for cloudfront_info in cloudfront_infos:
+        yield cloudfront_info
 
 
-def get_api_gateway_v2_info(apigwv2_client, profile_info):
+def generate_api_gateway_v2_info(api_gateway, apigwv2_client):
+    stages = apigwv2_client.get_stages(ApiId=api_gateway['ApiId'])['Items']
+
+    stage_infos = []
+    for stage in stages:
+        stage_info = ApigwRecord(
+            api_gateway_id=api_gateway['ApiId'],
+            api_gateway_name=api_gateway['Name'],
+            protocol=api_gateway['ProtocolType'],
+            endpoint_type='REGIONAL',
+            stage_name=stage['StageName'],
+            associated_waf='N/A',
+            waf_version='N/A'
+        )
+
+        stage_infos.append(stage_info)
+
+    return stage_infos
+
+
+def get_api_gateway_v2_info(client_pool, region_name, max_workers=1):
+    apigwv2_client = get_client(client_pool, 'apigatewayv2', region_name)
     api_gateways = get_all_api_gateways_v2(apigwv2_client)
-    region_name = apigwv2_client.meta.region_name
-
-    api_gateway_info_list = []
-    for api_gateway in tqdm(api_gateways, desc='API Gateway v2'):
-        basic_info = generate_basic_info(profile_info)
-        api_gateway_info = {
-            **basic_info,
-            'api_gateway_id': api_gateway['ApiId'],
-            'api_gateway_name': api_gateway['Name'],
-            'protocol': api_gateway['ProtocolType'],
-            'endpoint_type': 'REGIONAL'
-        }
 
-        stages = apigwv2_client.get_stages(ApiId=api_gateway['ApiId'])['Items']
+    stage_infos_by_api = map_resources(
+        lambda api_gateway: generate_api_gateway_v2_info(api_gateway, apigwv2_client),
+        api_gateways, max_workers, desc=f'API Gateway v2 ({region_name})'
+    )
+    for stage_infos in stage_infos_by_api:
+        for stage_info in stage_infos:
+            yield stage_info
 
-        for stage in stages:
-            stage_info = {
-                **api_gateway_info,
-                'stage_name': stage['StageName'],
-                'associated_waf': 'N/A',
-                'waf_version': 'N/A'
-            }
 
-            api_gateway_info_list.append(stage_info)
+def generate_api_gateway_v1_info(api_gateway, apigw_client, client_pool, region_name, web_acl_index=None):
+    stages = apigw_client.get_stages(restApiId=api_gateway['id'])['item']
+
+    stage_infos = []
+    for stage in stages:
+        stage_arn = f"arn:aws:apigateway:{region_name}::/restapis/{api_gateway['id']}/stages/{stage['stageName']}"
+        web_acl = get_web_acl_for_resource(stage_arn, client_pool, region_name, web_acl_index)
+        stage_info = ApigwRecord(
+            api_gateway_id=api_gateway['id'],
+            api_gateway_name=api_gateway['name'],
+            protocol='REST',
+            endpoint_type=api_gateway['endpointConfiguration']['types'][0],
+            stage_name=stage['stageName'],
+            associated_waf=web_acl['name'] if web_acl else 'None',
+            waf_version=web_acl['waf_version'] if web_acl else 'None'
+        )
+
+        stage_infos.append(stage_info)
 
-    return api_gateway_info_list
+    return stage_infos
 
 
-def get_api_gateway_v1_info(apigw_client, wafv2_client, waf_regional_client, profile_info):
+def get_api_gateway_v1_info(client_pool, region_name, web_acl_index=None, max_workers=1):
+    apigw_client = get_client(client_pool, 'apigateway', region_name)
     api_gateways = get_all_api_gateways_v1(apigw_client)
-    region_name = apigw_client.meta.region_name
-
-    api_gateway_info_list = []
-    for api_gateway in tqdm(api_gateways, desc='API Gateway v1'):
-        basic_info = generate_basic_info(profile_info)
-        api_gateway_info = {
-            **basic_info,
-            'api_gateway_id': api_gateway['id'],
-            'api_gateway_name': api_gateway['name'],
-            'protocol': 'REST',
-            'endpoint_type': api_gateway['endpointConfiguration']['types'][0]
+
+    stage_infos_by_api = map_resources(
+        lambda api_gateway: generate_api_gateway_v1_info(api_gateway, apigw_client, client_pool, region_name, web_acl_index),
+        api_gateways, max_workers, desc=f'API Gateway v1 ({region_name})'
+    )
+    for stage_infos in stage_infos_by_api:
+        for stage_info in stage_infos:
+            yield stage_info
+
+
+def scan_waf_coverage_for_region(client_pool, region_name, profile_info, scan_options):
+    collectors = [collector for service, collector in (('elb', 'elbv2'), ('elb', 'elbv1'), ('apigw', 'apigwv2'), ('apigw', 'apigwv1')) if service in scan_options['services']]
+    direct_collectors = [collector for collector in collectors if not is_covered_by_inventory(scan_options['inventory'], profile_info, region_name, collector)]
+    web_acl_index = None
+
+    if scan_options['use_waf_index']:
+        resource_types = [resource_type for collector, resource_type in (('elbv2', 'APPLICATION_LOAD_BALANCER'), ('apigwv1', 'API_GATEWAY')) if collector in direct_collectors]
+        if resource_types:
+            web_acl_index = build_web_acl_index(client_pool, region_name, scan_options['web_acl_name_cache'], resource_types)
+
+    for collector in collectors:
+        if collector not in direct_collectors:
+            for service, record in get_inventory_info(scan_options['inventory'], profile_info['account_id'], region_name, collector, client_pool, scan_options['web_acl_name_cache']):
+                yield service, record
+        elif collector == 'elbv2':
+            for elb_info in get_elbv2_info(client_pool, region_name, web_acl_index, scan_options['max_resource_workers']):
+                yield 'elb', elb_info
+        elif collector == 'elbv1':
+            for elb_info in get_elbv1_info(client_pool, region_name):
+                yield 'elb', elb_info
+        elif collector == 'apigwv2':
+            for apigw_info in get_api_gateway_v2_info(client_pool, region_name, scan_options['max_resource_workers']):
+                yield 'apigw', apigw_info
+        else:
+            for apigw_info in get_api_gateway_v1_info(client_pool, region_name, web_acl_index, scan_options['max_resource_workers']):
+                yield 'apigw', apigw_info
+
+
+CONFIG_RESOURCE_TYPES = {
+    'elb': ['AWS::ElasticLoadBalancingV2::LoadBalancer', 'AWS::ElasticLoadBalancing::LoadBalancer'],
+    'cloudfront': ['AWS::CloudFront::Distribution'],
+    'apigw': ['AWS::ApiGatewayV2::Api', 'AWS::ApiGatewayV2::Stage', 'AWS::ApiGateway::RestApi', 'AWS::ApiGateway::Stage']
+}
+# A direct collector is replaced by the inventory only where the aggregator records every resource type its rows are built from
+CONFIG_COLLECTOR_RESOURCE_TYPES = {
+    'elbv2': ['AWS::ElasticLoadBalancingV2::LoadBalancer'],
+    'elbv1': ['AWS::ElasticLoadBalancing::LoadBalancer'],
+    'cloudfront': ['AWS::CloudFront::Distribution'],
+    'apigwv2': ['AWS::ApiGatewayV2::Api', 'AWS::ApiGatewayV2::Stage'],
+    'apigwv1': ['AWS::ApiGateway::RestApi', 'AWS::ApiGateway::Stage']
+}
+CONFIG_WEB_ACL_VERSIONS = { 'AWS::WAFv2::WebACL': 'v2', 'AWS::WAFRegional::WebACL': 'v1', 'AWS::WAF::WebACL': 'v1' }
+
+
+def select_aggregate_resource_config(config_client, aggregator_name, expression, page_size=100):
+    paginator = config_client.get_paginator('select_aggregate_resource_config')
+    for page in paginator.paginate(Expression=expression, ConfigurationAggregatorName=aggregator_name, PaginationConfig={'PageSize': page_size}):
+        for result in page['Results']:
+            yield json.loads(result)
+
+
+def get_config_value(configuration, key):
+    # Types recorded through Cloud Control use PascalCase properties, the older ones use the camelCase of the service API
+    if key in configuration:
+        return configuration[key]
+    return configuration.get(key[0].upper() + key[1:])
+
+
+def get_config_related_resource_id(resource, resource_type):
+    for relationship in resource.get('relationships', []):
+        if relationship.get('resourceType') == resource_type:
+            return relationship.get('resourceId')
+    return None
+
+
+def get_config_web_acl(resource, web_acl_id=None, waf_service_name='waf'):
+    for relationship in resource.get('relationships', []):
+        if relationship.get('resourceType') in CONFIG_WEB_ACL_VERSIONS:
+            if relationship.get('resourceName') or relationship['resourceType'] == 'AWS::WAFv2::WebACL':
+                return {
+                    'name': relationship.get('resourceName') or relationship['resourceId'],
+                    'waf_version': CONFIG_WEB_ACL_VERSIONS[relationship['resourceType']]
+                }
+
+            # A WAF Classic relationship without the name only gives the ID, which is looked up below
+            web_acl_id = relationship['resourceId']
+            waf_service_name = 'waf' if relationship['resourceType'] == 'AWS::WAF::WebACL' else 'waf-regional'
+            break
+
+    if not web_acl_id:
+        return None
+
+    if ':wafv2:' in web_acl_id:
+        return { 'name': web_acl_id.split('/')[-2], 'waf_version': 'v2' }
+
+    # WAF Classic only gives the ID, so the name is looked up in the account when the inventory is read, like the direct collectors do
+    web_acl_id = web_acl_id.split('/')[-1]
+    return { 'name': web_acl_id, 'waf_version': 'v1', 'lookup': (waf_service_name, web_acl_id, None if waf_service_name == 'waf' else resource['awsRegion']) }
+
+
+def generate_config_elb_info(resource):
+    configuration = resource['configuration']
+    elb_name = get_config_value(configuration, 'loadBalancerName') or resource['resourceName']
+
+    if resource['resourceType'] == 'AWS::ElasticLoadBalancing::LoadBalancer':
+        return ElbRecord(
+            name=elb_name,
+            version='v1',
+            type='classic',
+            scheme=get_config_value(configuration, 'scheme'),
+            associated_waf='N/A',
+            waf_version='N/A',
+            marked_as_waf_ignore=False
+        )
+
+    elb_type = get_config_value(configuration, 'type')
+    associated_waf = 'None'
+    waf_version = 'None'
+
+    if elb_type == 'network':
+        associated_waf = 'N/A'
+        waf_version = 'N/A'
+    elif elb_type == 'application':
+        web_acl = get_config_web_acl(resource)
+
+        if web_acl:
+            associated_waf = web_acl['name']
+            waf_version = web_acl['waf_version']
+
+    return ElbRecord(
+        name=elb_name,
+        version='v2',
+        type=elb_type,
+        scheme=get_config_value(configuration, 'scheme'),
+        associated_waf=associated_waf,
+        waf_version=waf_version,
+        marked_as_waf_ignore=any(tag.get('key') == 'et:waf-ignore' for tag in resource.get('tags', []))
+    )
+
+
+def generate_config_cloudfront_info(resource):
+    configuration = resource['configuration']
+    distribution_config = get_config_value(configuration, 'distributionConfig') or {}
+    aliases = (get_config_value(distribution_config, 'aliases') or {}).get('items') or []
+    web_acl = get_config_web_acl(resource, get_config_value(distribution_config, 'webACLId'))
+
+    cloudfront_info = CloudFrontRecord(
+        distribution_id=resource['resourceId'],
+        distribution_name=aliases[0] if aliases else get_config_value(configuration, 'domainName'),
+        associated_waf=web_acl['name'] if web_acl else 'None',
+        waf_version=web_acl['waf_version'] if web_acl else 'None'
+    )
+    return cloudfront_info, web_acl.get('lookup') if web_acl else None
+
+
+def generate_config_records(resources_by_type):
+    for collector, resource_type in (('elbv2', 'AWS::ElasticLoadBalancingV2::LoadBalancer'), ('elbv1', 'AWS::ElasticLoadBalancing::LoadBalancer')):
+        for resource in resources_by_type[resource_type]:
+            yield collector, 'elb', generate_config_elb_info(resource), None
+
+    for resource in resources_by_type['AWS::CloudFront::Distribution']:
+        cloudfront_info, web_acl_lookup = generate_config_cloudfront_info(resource)
+        yield 'cloudfront', 'cloudfront', cloudfront_info, web_acl_lookup
+
+    stages_by_api_id = defaultdict(list)
+    for stage in resources_by_type['AWS::ApiGatewayV2::Stage']:
+        stages_by_api_id[get_config_value(stage['configuration'], 'apiId') or get_config_related_resource_id(stage, 'AWS::ApiGatewayV2::Api')].append(stage)
+
+    for api_gateway in resources_by_type['AWS::ApiGatewayV2::Api']:
+        api_gateway_id = get_config_value(api_gateway['configuration'], 'apiId') or api_gateway['resourceId']
+        for stage in stages_by_api_id[api_gateway_id]:
+            yield 'apigwv2', 'apigw', ApigwRecord(
+                api_gateway_id=api_gateway_id,
+                api_gateway_name=get_config_value(api_gateway['configuration'], 'name') or api_gateway['resourceName'],
+                protocol=get_config_value(api_gateway['configuration'], 'protocolType'),
+                endpoint_type='REGIONAL',
+                stage_name=get_config_value(stage['configuration'], 'stageName') or stage['resourceName'],
+                associated_waf='N/A',
+                waf_version='N/A'
+            ), None
+
+    stages_by_api_id = defaultdict(list)
+    for stage in resources_by_type['AWS::ApiGateway::Stage']:
+        stages_by_api_id[get_config_value(stage['configuration'], 'restApiId') or get_config_related_resource_id(stage, 'AWS::ApiGateway::RestApi')].append(stage)
+
+    for api_gateway in resources_by_type['AWS::ApiGateway::RestApi']:
+        api_gateway_id = get_config_value(api_gateway['configuration'], 'id') or api_gateway['resourceId']
+        endpoint_configuration = get_config_value(api_gateway['configuration'], 'endpointConfiguration') or {}
+        for stage in stages_by_api_id[api_gateway_id]:
+            web_acl = get_config_web_acl(stage, get_config_value(stage['configuration'], 'webAclArn'), 'waf-regional')
+            yield 'apigwv1', 'apigw', ApigwRecord(
+                api_gateway_id=api_gateway_id,
+                api_gateway_name=get_config_value(api_gateway['configuration'], 'name') or api_gateway['resourceName'],
+                protocol='REST',
+                endpoint_type=(get_config_value(endpoint_configuration, 'types') or ['EDGE'])[0],
+                stage_name=get_config_value(stage['configuration'], 'stageName') or stage['resourceName'],
+                associated_waf=web_acl['name'] if web_acl else 'None',
+                waf_version=web_acl['waf_version'] if web_acl else 'None'
+            ), web_acl.get('lookup') if web_acl else None
+
+
+def load_config_inventory(config_client, aggregator_name, services):
+    inventory = { 'covered': set(), 'records': {} }
+
+    resource_types = ', '.join(f"'{resource_type}'" for service in services for resource_type in CONFIG_RESOURCE_TYPES[service])
+    expression = f'SELECT accountId, awsRegion, resourceType, resourceId, resourceName, configuration, relationships, tags WHERE resourceType IN ({resource_types})'
+    resources = defaultdict(lambda: defaultdict(list))
+    for resource in select_aggregate_resource_config(config_client, aggregator_name, expression):
+        if isinstance(resource.get('configuration'), str):
+            resource['configuration'] = json.loads(resource['configuration'])
+        resource['configuration'] = resource.get('configuration') or {}
+
+        # CloudFront distributions are global and recorded in us-east-1 only
+        region_name = 'global' if resource['resourceType'] == 'AWS::CloudFront::Distribution' else resource['awsRegion']
+        resources[(resource['accountId'], region_name)][resource['resourceType']].append(resource)
+
+        # Only the resource types the aggregator records in an account and region are read from the inventory there
+        inventory['covered'].add((resource['accountId'], region_name, resource['resourceType']))
+
+    for (account_id, region_name), resources_by_type in resources.items():
+        for collector, service, record, web_acl_lookup in generate_config_records(resources_by_type):
+            inventory['records'].setdefault((account_id, region_name, collector), []).append((service, record, web_acl_lookup))
+
+    return inventory
+
+
+def is_covered_by_inventory(inventory, profile_info, region_name, collector):
+    return inventory is not None and all((profile_info['account_id'], region_name, resource_type) in inventory['covered'] for resource_type in CONFIG_COLLECTOR_RESOURCE_TYPES[collector])
+
+
+def get_inventory_info(inventory, account_id, region_name, collector, client_pool, web_acl_name_cache=None):
+    for service, record, web_acl_lookup in inventory['records'].get((account_id, region_name, collector), []):
+        if web_acl_lookup:
+            waf_service_name, web_acl_id, web_acl_region_name = web_acl_lookup
+            record = record._replace(associated_waf=get_web_acl_name(client_pool, waf_service_name, web_acl_id, web_acl_name_cache, web_acl_region_name))
+        yield service, record
+
+
+def open_sqlite_snapshot(sqlite_filepath, services):
+    connection = sqlite3.connect(sqlite_filepath)
+    connection.execute('CREATE TABLE IF NOT EXISTS snapshots (snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT, created_at TEXT NOT NULL, completed_at TEXT, services TEXT NOT NULL)')
+
+    # Each service has its own table, so the service is implied by the table and the indexes cover the remaining filters
+    for service, fieldnames in FIELDNAMES.items():
+        columns = ', '.join(f'{fieldname} TEXT' for fieldname in fieldnames)
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {service} (snapshot_id INTEGER NOT NULL REFERENCES snapshots (snapshot_id), {columns})')
+        for column in ('account_id', 'profile_prefix', 'waf_version'):
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {service}_{column} ON {service} (snapshot_id, {column})')
+
+    cursor = connection.execute(
+        'INSERT INTO snapshots (created_at, services) VALUES (?, ?)',
+        (datetime.now(timezone.utc).isoformat(), ','.join(services))
+    )
+    connection.commit()
+    return connection, cursor.lastrowid
+
+
+def insert_sqlite_row(connection, snapshot_id, service, row):
+    fieldnames = FIELDNAMES[service]
+    placeholders = ', '.join('?' for _ in range(len(fieldnames) + 1))
+    connection.execute(
+        f"INSERT INTO {service} (snapshot_id, {', '.join(fieldnames)}) VALUES ({placeholders})",
+        [snapshot_id] + [str(value) for value in row]
+    )
+
+
+def complete_sqlite_snapshot(connection, snapshot_id):
+    connection.execute('UPDATE snapshots SET completed_at = ? WHERE snapshot_id = ?', (datetime.now(timezone.utc).isoformat(), snapshot_id))
+    connection.commit()
+
+
+def get_checkpoint_filepath(checkpoint_dirpath, profile_info):
+    return os.path.join(checkpoint_dirpath, f"{profile_info['account_id']}-{profile_info['profile_name']}.jsonl")
+
+
+CHECKPOINT_FORMAT = 4
+
+
+def write_checkpoint_part(part_filepath, region_name, records):
+    # Rows are written as they are collected, so the rows of a large account are never all held in memory
+    with open(part_filepath, mode='w', encoding='utf-8') as file:
+        for service, record in records:
+            file.write(json.dumps([service, region_name, *record]) + '\n')
+
+
+def write_checkpoint(checkpoint_filepath, profile_info, scan_options, part_filepaths, started_at=None, full_scanned_at=None):
+    # The shard only gets its final name once it is complete, so an interrupted write is never mistaken for a valid shard
+    with open(f'{checkpoint_filepath}.tmp', mode='w', encoding='utf-8') as file:
+        scanned_at = time.time()
+        header = {
+            'format': CHECKPOINT_FORMAT,
+            'profile_info': profile_info,
+            'regions': scan_options['regions'],
+            'services': scan_options['services'],
+            'started_at': started_at or scanned_at,
+            'scanned_at': scanned_at,
+            # A CloudTrail refresh keeps the time of the last full scan, so --max-age still forces a full scan from time to time
+            'full_scanned_at': full_scanned_at or scanned_at
         }
+        file.write(json.dumps(header) + '\n')
+        for part_filepath in part_filepaths:
+            with open(part_filepath, mode='r', encoding='utf-8') as part_file:
+                for line in part_file:
+                    file.write(line)
+    os.replace(f'{checkpoint_filepath}.tmp', checkpoint_filepath)
 
-        stages = apigw_client.get_stages(restApiId=api_gateway['id'])['item']
 
-        for stage in stages:
-            stage_arn = f"arn:aws:apigateway:{region_name}::/restapis/{api_gateway['id']}/stages/{stage['stageName']}"
-            stage_info = {
-                **api_gateway_info,
-                'stage_name': stage['stageName'],
-                'associated_waf': 'None',
-                'waf_version': 'None'
-            }
+def read_checkpoint_header(checkpoint_filepath):
+    if not os.path.exists(checkpoint_filepath):
+        return None
 
-            response = wafv2_client.get_web_acl_for_resource(ResourceArn=stage_arn)
+    with open(checkpoint_filepath, mode='r', encoding='utf-8') as file:
+        try:
+            return json.loads(file.readline())
+        except json.JSONDecodeError:
+            return None
 
-            if 'WebACL' in response:
-                stage_info['associated_waf'] = response['WebACL']['Name']
-                stage_info['waf_version'] = 'v2'
-                api_gateway_info_list.append(stage_info)
-                continue
 
-            response = waf_regional_client.get_web_acl_for_resource(ResourceArn=stage_arn)
+def is_checkpoint_valid(checkpoint_filepath, profile_info, scan_options, max_age=None):
+    header = read_checkpoint_header(checkpoint_filepath)
+    if header is None:
+        return False
+
+    for key in ('regions', 'services'):
+        if header.get(key) != scan_options[key]:
+            return False
+
+    if header.get('format') != CHECKPOINT_FORMAT or header.get('profile_info') != profile_info:
+        return False
+
+    if max_age is not None and time.time() - header['full_scanned_at'] > max_age:
+        return False
+
+    return True
+
+
+def read_checkpoint_records(checkpoint_filepath):
+    with open(checkpoint_filepath, mode='r', encoding='utf-8') as file:
+        file.readline()
+        for line in file:
+            service, region_name, *values = json.loads(line)
+            yield service, region_name, values
+
+
+def read_checkpoint(checkpoint_filepath):
+    profile_info = read_checkpoint_header(checkpoint_filepath)['profile_info']
+
+    # The account and region columns are built once per region and shared by all of its rows
+    basic_values_by_region = {}
+    for service, region_name, values in read_checkpoint_records(checkpoint_filepath):
+        if region_name not in basic_values_by_region:
+            basic_values_by_region[region_name] = list(generate_basic_info(profile_info, region_name).values())
+        yield service, basic_values_by_region[region_name] + values
+
 
-            if 'WebACLSummary' in response:
-                stage_info['associated_waf'] = response['WebACLSummary']['Name']
-                stage_info['waf_version'] = 'v1'
-                api_gateway_info_list.append(stage_info)
+# CloudTrail delivers log files with a delay, so events slightly older than the previous scan are applied again
+CLOUDTRAIL_DELIVERY_DELAY = 900
+CLOUDTRAIL_EVENT_NAMES = {
+    'elasticloadbalancing.amazonaws.com': {'CreateLoadBalancer', 'DeleteLoadBalancer', 'AddTags', 'RemoveTags'},
+    'wafv2.amazonaws.com': {'AssociateWebACL', 'DisassociateWebACL'},
+    'waf-regional.amazonaws.com': {'AssociateWebACL', 'DisassociateWebACL'},
+    'cloudfront.amazonaws.com': {'CreateDistribution', 'CreateDistributionWithTags', 'UpdateDistribution', 'DeleteDistribution'},
+    'apigateway.amazonaws.com': {
+        'CreateRestApi', 'ImportRestApi', 'PutRestApi', 'UpdateRestApi', 'DeleteRestApi', 'CreateDeployment',
+        'CreateApi', 'ImportApi', 'ReimportApi', 'UpdateApi', 'DeleteApi',
+        'CreateStage', 'UpdateStage', 'DeleteStage'
+    }
+}
+
+
+def parse_cloudtrail_time(event_time):
+    return datetime.strptime(event_time, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+
+
+def read_cloudtrail_log(log_content, since):
+    for event in json.loads(gzip.decompress(log_content) if log_content[:2] == b'\x1f\x8b' else log_content).get('Records', []):
+        # Failed calls did not change anything
+        if event.get('errorCode') or event.get('eventName') not in CLOUDTRAIL_EVENT_NAMES.get(event.get('eventSource'), ()):
+            continue
+        if parse_cloudtrail_time(event['eventTime']) >= since:
+            yield event
+
+
+def get_cloudtrail_path_date(dirpath):
+    # CloudTrail delivers the log files under .../YYYY/MM/DD, and aws s3 sync keeps that layout
+    date_parts = os.path.normpath(dirpath).split(os.sep)[-3:]
+    if len(date_parts) != 3 or [len(date_part) for date_part in date_parts] != [4, 2, 2] or not all(date_part.isdigit() for date_part in date_parts):
+        return None
+
+    return datetime(*map(int, date_parts), tzinfo=timezone.utc).timestamp()
+
+
+def get_cloudtrail_log_contents(cloudtrail_source, since, max_workers=16):
+    if cloudtrail_source.get('dirpath'):
+        # Days that ended before the previous scan are not walked, and the other files are filtered on their modification time like the S3 objects
+        for dirpath, dirnames, filenames in os.walk(cloudtrail_source['dirpath']):
+            path_date = get_cloudtrail_path_date(dirpath)
+            if path_date is not None and path_date + 86400 < since:
+                dirnames.clear()
                 continue
 
-            api_gateway_info_list.append(stage_info)
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                if filename.endswith(('.json.gz', '.json')) and os.path.getmtime(filepath) >= since:
+                    with open(filepath, mode='rb') as file:
+                        yield file.read()
+        return
+
+    # Log files are only listed, and only the ones delivered after the previous scan are downloaded
+    s3_client = cloudtrail_source['s3_client']
+    bucket, _, prefix = cloudtrail_source['s3_uri'].removeprefix('s3://').partition('/')
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for s3_object in page.get('Contents', []):
+            if s3_object['Key'].endswith('.json.gz') and s3_object['LastModified'].timestamp() >= since:
+                keys.append(s3_object['Key'])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for log_content in executor.map(lambda key: s3_client.get_object(Bucket=bucket, Key=key)['Body'].read(), keys):
+            yield log_content
+
+
+def load_cloudtrail_events(cloudtrail_source, since):
+    events_by_account = defaultdict(list)
+    for log_content in get_cloudtrail_log_contents(cloudtrail_source, since):
+        for event in read_cloudtrail_log(log_content, since):
+            events_by_account[event.get('recipientAccountId')].append(event)
+    return events_by_account
+
+
+def get_resource_key(service, region_name, values):
+    if service == 'elb':
+        return 'elb', region_name, values[1], values[0]
+    if service == 'cloudfront':
+        return 'cloudfront', region_name, None, values[0]
+    return 'apigw', region_name, 'v1' if values[2] == 'REST' else 'v2', values[0]
+
+
+def get_cloudtrail_resource_keys(event):
+    # Keys are (service, region, version, resource), and a key without resource asks for the whole service in the region
+    event_source = event['eventSource']
+    event_name = event['eventName']
+    region_name = event['awsRegion']
+    request_parameters = event.get('requestParameters') or {}
+    response_elements = event.get('responseElements') or {}
+
+    if event_source == 'elasticloadbalancing.amazonaws.com':
+        if event_name in ('AddTags', 'RemoveTags'):
+            tag_keys = [tag.get('key') for tag in request_parameters.get('tags', [])] + request_parameters.get('tagKeys', [])
+            if 'et:waf-ignore' not in tag_keys:
+                return []
+
+        if event.get('apiVersion') == '2012-06-01':
+            elb_names = request_parameters.get('loadBalancerNames') or [request_parameters.get('loadBalancerName')]
+            return [('elb', region_name, 'v1', elb_name) for elb_name in elb_names if elb_name]
+
+        elb_arns = request_parameters.get('resourceArns') or [request_parameters.get('loadBalancerArn')]
+        elb_names = [elb_arn.split('/')[-2] for elb_arn in elb_arns if elb_arn and ':loadbalancer/' in elb_arn]
+        if event_name == 'CreateLoadBalancer':
+            elb_names.append(request_parameters.get('name'))
+        return [('elb', region_name, 'v2', elb_name) for elb_name in elb_names if elb_name]
+
+    if event_source in ('wafv2.amazonaws.com', 'waf-regional.amazonaws.com'):
+        resource_arn = request_parameters.get('resourceArn', '')
+        resource_region_name = resource_arn.split(':')[3] if resource_arn.count(':') >= 5 else region_name
+        if ':elasticloadbalancing:' in resource_arn and ':loadbalancer/' in resource_arn:
+            return [('elb', resource_region_name, 'v2', resource_arn.split('/')[-2])]
+        if ':apigateway:' in resource_arn and '/restapis/' in resource_arn:
+            return [('apigw', resource_region_name, 'v1', resource_arn.split('/restapis/')[1].split('/')[0])]
+        return []
+
+    if event_source == 'cloudfront.amazonaws.com':
+        distribution_id = request_parameters.get('id') or (response_elements.get('distribution') or {}).get('id')
+        return [('cloudfront', 'global', None, distribution_id)]
+
+    if 'restApiId' in request_parameters or event_name in ('CreateRestApi', 'ImportRestApi'):
+        return [('apigw', region_name, 'v1', request_parameters.get('restApiId') or response_elements.get('id'))]
+
+    if 'apiId' in request_parameters or event_name in ('CreateApi', 'ImportApi'):
+        return [('apigw', region_name, 'v2', request_parameters.get('apiId') or response_elements.get('apiId'))]
+
+    return [('apigw', region_name, None, None)]
+
+
+def describe_changed_resource(client_pool, resource_key, web_acl_name_cache=None):
+    service, region_name, version, resource_id = resource_key
+
+    if service == 'elb' and version == 'v2':
+        elbv2_client = get_client(client_pool, 'elbv2', region_name)
+        try:
+            elbs_v2 = elbv2_client.describe_load_balancers(Names=[resource_id])['LoadBalancers']
+        except elbv2_client.exceptions.LoadBalancerNotFoundException:
+            return []
+        tags_by_arn = get_elbv2_tags(elbv2_client, [elb['LoadBalancerArn'] for elb in elbs_v2])
+        return [generate_elbv2_info(elb, tags_by_arn, client_pool, region_name) for elb in elbs_v2]
+
+    if service == 'elb':
+        elb_client = get_client(client_pool, 'elb', region_name)
+        try:
+            elbs_v1 = elb_client.describe_load_balancers(LoadBalancerNames=[resource_id])['LoadBalancerDescriptions']
+        except elb_client.exceptions.AccessPointNotFoundException:
+            return []
+        return [generate_elbv1_info(elb) for elb in elbs_v1]
+
+    if service == 'cloudfront':
+        cloudfront_client = get_client(client_pool, 'cloudfront')
+        try:
+            distribution = cloudfront_client.get_distribution(Id=resource_id)['Distribution']
+        except cloudfront_client.exceptions.NoSuchDistribution:
+            return []
+        dist = { **distribution['DistributionConfig'], 'Id': distribution['Id'], 'DomainName': distribution['DomainName'] }
+        return [generate_cloudfront_info(dist, client_pool, web_acl_name_cache)]
+
+    if version == 'v1':
+        apigw_client = get_client(client_pool, 'apigateway', region_name)
+        try:
+            api_gateway = apigw_client.get_rest_api(restApiId=resource_id)
+        except apigw_client.exceptions.NotFoundException:
+            return []
+        return generate_api_gateway_v1_info(api_gateway, apigw_client, client_pool, region_name)
+
+    apigwv2_client = get_client(client_pool, 'apigatewayv2', region_name)
+    try:
+        api_gateway = apigwv2_client.get_api(ApiId=resource_id)
+    except apigwv2_client.exceptions.NotFoundException:
+        return []
+    return generate_api_gateway_v2_info(api_gateway, apigwv2_client)
+
+
+def collect_changed_service(client_pool, service, region_name, scan_options):
+    if service == 'elb':
+        return list(get_elbv2_info(client_pool, region_name, None, scan_options['max_resource_workers'])) + list(get_elbv1_info(client_pool, region_name))
+
+    if service == 'cloudfront':
+        return list(get_cloudfront_info(client_pool, scan_options['web_acl_name_cache']))
+
+    return (
+        list(get_api_gateway_v2_info(client_pool, region_name, scan_options['max_resource_workers'])) +
+        list(get_api_gateway_v1_info(client_pool, region_name, None, scan_options['max_resource_workers']))
+    )
+
+
+def merge_changed_records(records, region_name, changed_records):
+    emitted_resource_keys = set()
+    for service, values in records:
+        if (service, region_name, None, None) in changed_records:
+            continue
 
-    return api_gateway_info_list
+        # A changed resource takes the place of its previous rows, and a deleted one has no rows left
+        resource_key = get_resource_key(service, region_name, values)
+        if resource_key in changed_records:
+            if resource_key not in emitted_resource_keys:
+                emitted_resource_keys.add(resource_key)
+                for record in changed_records[resource_key]:
+                    yield service, record
+            continue
+
+        yield service, values
+
+    for resource_key, resource_records in changed_records.items():
+        if resource_key[1] == region_name and resource_key not in emitted_resource_keys:
+            for record in resource_records:
+                yield resource_key[0], record
 
 
-def scan_waf_coverage_for_profiles_from_csv(csv_filepath):
+def refresh_waf_coverage_for_profile(session, profile_info, scan_options, checkpoint_filepath, events):
+    started_at = time.time()
+    checkpoint_header = read_checkpoint_header(checkpoint_filepath)
+    since = checkpoint_header['started_at'] - CLOUDTRAIL_DELIVERY_DELAY
+    client_pool = create_client_pool(session, profile_info, scan_options)
+    region_names = resolve_regions(client_pool) if {'elb', 'apigw'} & set(scan_options['services']) else []
+
+    resource_keys = set()
+    for event in events:
+        if parse_cloudtrail_time(event['eventTime']) < since:
+            continue
+        for resource_key in get_cloudtrail_resource_keys(event):
+            if resource_key[0] in scan_options['services'] and resource_key[1] in ['global', *region_names]:
+                resource_keys.add(resource_key if resource_key[3] is not None else (resource_key[0], resource_key[1], None, None))
+
+    # A service that is collected again in a region already covers its changed resources there
+    resource_keys = { resource_key for resource_key in resource_keys if resource_key[3] is None or (resource_key[0], resource_key[1], None, None) not in resource_keys }
+
+    print(f"Refreshing profile: {profile_info['profile_name']} ({len(resource_keys)} changed resources)")
+    changed_records = {}
+    for resource_key in sorted(resource_keys, key=str):
+        if resource_key[3] is None:
+            changed_records[resource_key] = collect_changed_service(client_pool, resource_key[0], resource_key[1], scan_options)
+        else:
+            changed_records[resource_key] = describe_changed_resource(client_pool, resource_key, scan_options['web_acl_name_cache'])
+
+    records_by_region = defaultdict(list)
+    for service, region_name, values in read_checkpoint_records(checkpoint_filepath):
+        records_by_region[region_name].append((service, values))
+
+    part_filepaths = [f'{checkpoint_filepath}.{region_name}.part' for region_name in ['global', *region_names]]
+    try:
+        for part_filepath, region_name in zip(part_filepaths, ['global', *region_names]):
+            write_checkpoint_part(part_filepath, region_name, merge_changed_records(records_by_region[region_name], region_name, changed_records))
+        write_checkpoint(checkpoint_filepath, profile_info, scan_options, part_filepaths, started_at, checkpoint_header['full_scanned_at'])
+    finally:
+        for part_filepath in part_filepaths:
+            if os.path.exists(part_filepath):
+                os.remove(part_filepath)
+
+    return len(resource_keys)
+
+
+def scan_waf_coverage_for_profile(session, profile_info, scan_options, checkpoint_filepath):
+    # Sessions are not thread-safe, so each account gets its own session and its regions share it through the client pool
+    started_at = time.time()
+    client_pool = create_client_pool(session, profile_info, scan_options)
+    region_names = resolve_regions(client_pool) if {'elb', 'apigw'} & set(scan_options['services']) else []
+
+    print(f"Scanning profile: {profile_info['profile_name']}")
+    global_part_filepath = f'{checkpoint_filepath}.global.part'
+    regional_part_filepaths = [f'{checkpoint_filepath}.{region_name}.part' for region_name in region_names]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(region_names))) as executor:
+            futures = [
+                executor.submit(write_checkpoint_part, part_filepath, region_name, scan_waf_coverage_for_region(client_pool, region_name, profile_info, scan_options))
+                for part_filepath, region_name in zip(regional_part_filepaths, region_names)
+            ]
+
+            # CloudFront and WAF Classic are global, so they are scanned once per account while the regions run
+            cloudfront_info_records = []
+            if 'cloudfront' in scan_options['services'] and is_covered_by_inventory(scan_options['inventory'], profile_info, 'global', 'cloudfront'):
+                cloudfront_info_records = get_inventory_info(scan_options['inventory'], profile_info['account_id'], 'global', 'cloudfront', client_pool, scan_options['web_acl_name_cache'])
+            elif 'cloudfront' in scan_options['services']:
+                cloudfront_info_records = (('cloudfront', cloudfront_info) for cloudfront_info in get_cloudfront_info(client_pool, scan_options['web_acl_name_cache']))
+            write_checkpoint_part(global_part_filepath, 'global', cloudfront_info_records)
+
+            for future in futures:
+                future.result()
+
+        write_checkpoint(checkpoint_filepath, profile_info, scan_options, [global_part_filepath] + regional_part_filepaths, started_at)
+    finally:
+        for part_filepath in [global_part_filepath] + regional_part_filepaths:
+            if os.path.exists(part_filepath):
+                os.remove(part_filepath)
+
+
+def scan_waf_coverage_for_profiles_from_csv(csv_filepath, output_csv_filepaths, max_workers=1, scan_options=None, checkpoint_dirpath='workspace/waf-coverage-checkpoints', resume=False, max_age=None, credential_workers=16, sqlite_filepath=None, shard=None):
     profiles = read_profiles_from_csv(csv_filepath)
+    if shard is not None:
+        profiles = [profile_info for profile_info in profiles if get_profile_shard(profile_info, shard[1]) == shard[0]]
+    scan_options = {
+        'use_waf_index': False,
+        'regions': None,
+        'web_acl_name_cache': None,
+        'rate_limiter': None,
+        'api_metrics': None,
+        'inventory': None,
+        'max_resource_workers': 1,
+        'cloudtrail_source': None,
+        'services': list(SERVICES),
+        **(scan_options or {})
+    }
+    services = scan_options['services']
+    os.makedirs(checkpoint_dirpath, exist_ok=True)
 
-    elb_info_list = []
-    cloudfront_info_list = []
-    apigw_info_list = []
+    # The services left out of --services get a file with only the header, so the calculator does not read the rows of an older scan
+    output_files = { service: open(output_csv_filepath, mode='w', newline='') for service, output_csv_filepath in output_csv_filepaths.items() }
+    writers = { service: csv.writer(output_file) for service, output_file in output_files.items() }
+    for service, writer in writers.items():
+        writer.writerow(FIELDNAMES[service])
+
+    profiles_to_scan = []
     for profile_info in profiles:
-        session = boto3.Session(profile_name=profile_info['profile_name'])
-        wafv2_client = session.client('wafv2')
-        waf_regional_client = session.client('waf-regional')
-        waf_global_client = session.client('waf')
-        elbv2_client = session.client('elbv2')
-        elb_client = session.client('elb')
-        cloudfront_client = session.client('cloudfront')
-        apigwv2_client = session.client('apigatewayv2')
-        apigw_client = session.client('apigateway')
-
-        print(f"Scanning profile: {profile_info['profile_name']}")
-        elb_info_list.extend(get_elbv2_info(elbv2_client, wafv2_client, waf_regional_client, profile_info))
-        elb_info_list.extend(get_elbv1_info(elb_client, profile_info))
-        cloudfront_info_list.extend(get_cloudfront_info(cloudfront_client, waf_global_client, profile_info))
-        apigw_info_list.extend(get_api_gateway_v2_info(apigwv2_client, profile_info))
-        apigw_info_list.extend(get_api_gateway_v1_info(apigw_client, wafv2_client, waf_regional_client, profile_info))
-
-    return { 'elb': elb_info_list, 'cloudfront': cloudfront_info_list, 'apigw': apigw_info_list }
+        if resume and is_checkpoint_valid(get_checkpoint_filepath(checkpoint_dirpath, profile_info), profile_info, scan_options, max_age):
+            print(f"Skipping profile with valid checkpoint: {profile_info['profile_name']}")
+            continue
+        profiles_to_scan.append(profile_info)
+
+    # Accounts that already have a shard only get the resources changed since then described again
+    profiles_to_refresh = set()
+    cloudtrail_events = {}
+    if scan_options['cloudtrail_source'] is not None:
+        checkpoint_started_ats = []
+        for profile_info in profiles_to_scan:
+            checkpoint_filepath = get_checkpoint_filepath(checkpoint_dirpath, profile_info)
+            if is_checkpoint_valid(checkpoint_filepath, profile_info, scan_options, max_age):
+                profiles_to_refresh.add(profile_info['profile_name'])
+                checkpoint_started_ats.append(read_checkpoint_header(checkpoint_filepath)['started_at'])
+
+        if checkpoint_started_ats:
+            cloudtrail_events = load_cloudtrail_events(scan_options['cloudtrail_source'], min(checkpoint_started_ats) - CLOUDTRAIL_DELIVERY_DELAY)
+
+    # Credentials are resolved up front so that expired or missing permission sets are reported before any scanning starts
+    sessions, failed_profiles = prewarm_credentials(profiles_to_scan, credential_workers)
+
+    sqlite_connection, snapshot_id = open_sqlite_snapshot(sqlite_filepath, services) if sqlite_filepath else (None, None)
+
+    row_counts = { service: 0 for service in services }
+    scanned_profiles = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for profile_info in profiles_to_scan:
+                if profile_info['profile_name'] not in sessions:
+                    continue
+
+                checkpoint_filepath = get_checkpoint_filepath(checkpoint_dirpath, profile_info)
+                session = sessions.pop(profile_info['profile_name'])
+                if profile_info['profile_name'] in profiles_to_refresh:
+                    events = cloudtrail_events.get(profile_info['account_id'], [])
+                    futures[profile_info['profile_name']] = executor.submit(refresh_waf_coverage_for_profile, session, profile_info, scan_options, checkpoint_filepath, events)
+                else:
+                    futures[profile_info['profile_name']] = executor.submit(scan_waf_coverage_for_profile, session, profile_info, scan_options, checkpoint_filepath)
+
+            # Shards are appended in the CSV order, so the output does not depend on which account finishes first
+            failed_profile_names = { failed_profile['profile_name'] for failed_profile in failed_profiles }
+            for profile_info in profiles:
+                if profile_info['profile_name'] in failed_profile_names:
+                    continue
+
+                try:
+                    if profile_info['profile_name'] in futures:
+                        futures.pop(profile_info['profile_name']).result()
+                except Exception as error:
+                    print(f"Failed to scan profile: {profile_info['profile_name']}: {error}")
+                    failed_profiles.append({ **profile_info, 'error': str(error) })
+                    continue
+
+                for service, row in read_checkpoint(get_checkpoint_filepath(checkpoint_dirpath, profile_info)):
+                    writers[service].writerow(row)
+                    row_counts[service] += 1
+
+                    if sqlite_connection:
+                        insert_sqlite_row(sqlite_connection, snapshot_id, service, row)
+
+                scanned_profiles.append(profile_info)
+                for output_file in output_files.values():
+                    output_file.flush()
+
+                if sqlite_connection:
+                    sqlite_connection.commit()
+
+        if sqlite_connection:
+            complete_sqlite_snapshot(sqlite_connection, snapshot_id)
+    finally:
+        for output_file in output_files.values():
+            output_file.close()
+
+        if sqlite_connection:
+            sqlite_connection.close()
+
+    return { 'rows': row_counts, 'scanned': scanned_profiles, 'failed': failed_profiles }
+
+
+def write_manifest(manifest_filepath, csv_filepath, output_csv_filepaths, scan_options, shard, waf_coverage):
+    with open(csv_filepath, mode='rb') as file:
+        profiles_digest = hashlib.sha256(file.read()).hexdigest()
+
+    # Output paths are relative to the manifest, so the shards of several runners can be merged wherever they are downloaded
+    manifest_dirpath = os.path.dirname(os.path.abspath(manifest_filepath))
+    manifest = {
+        'shard': list(shard or (1, 1)),
+        'profiles_digest': profiles_digest,
+        'regions': scan_options['regions'],
+        'services': scan_options['services'],
+        'outputs': { service: os.path.relpath(os.path.abspath(output_csv_filepaths[service]), manifest_dirpath) for service in scan_options['services'] },
+        'scanned': waf_coverage['scanned'],
+        'failed': waf_coverage['failed'],
+        'rows': waf_coverage['rows'],
+        'created_at': datetime.now(timezone.utc).isoformat()
+    }
+    with open(f'{manifest_filepath}.tmp', mode='w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(f'{manifest_filepath}.tmp', manifest_filepath)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    validate_services(parser, args.services)
+
+    if args.shard and (len(args.shard) != 2 or not 1 <= args.shard[0] <= args.shard[1]):
+        parser.error(f"invalid --shard: {'/'.join(map(str, args.shard))}")
+
+    if args.cloudtrail_dir and args.cloudtrail_s3:
+        parser.error('--cloudtrail-dir and --cloudtrail-s3 cannot be combined')
+
+    if (args.cloudtrail_dir or args.cloudtrail_s3) and args.resume:
+        parser.error('--resume cannot be combined with a CloudTrail refresh')
+
+    if args.config_aggregator and not args.config_aggregator_profile:
+        parser.error('--config-aggregator requires --config-aggregator-profile')
+
+    input_csv_filepath = os.path.expanduser(args.input_file)
+    output_file_path, output_file_extension = os.path.splitext(args.output_file)
+    elb_csv_filepath = os.path.expanduser(f'{output_file_path}-for-elb{output_file_extension}')
+    cloudfront_csv_filepath = os.path.expanduser(f'{output_file_path}-for-cloudfront{output_file_extension}')
+    apigw_csv_filepath = os.path.expanduser(f'{output_file_path}-for-apigw{output_file_extension}')
+    web_acl_cache_filepath = os.path.expanduser(args.web_acl_cache_file)
+    checkpoint_dirpath = os.path.expanduser(args.checkpoint_dir or f'{output_file_path}-checkpoints')
+    sqlite_filepath = os.path.expanduser(args.sqlite_file) if args.sqlite_file else None
+    metrics_filepath = os.path.expanduser(args.metrics_file or f'{output_file_path}-api-metrics.json')
+    manifest_filepath = os.path.expanduser(f'{output_file_path}-manifest.json')
+
+    web_acl_name_cache = load_web_acl_name_cache(web_acl_cache_filepath, args.web_acl_cache_ttl, args.web_acl_cache_max_entries)
+    scan_options = {
+        'use_waf_index': args.waf_index,
+        'max_resource_workers': args.max_resource_workers,
+        'regions': args.regions,
+        'services': args.services,
+        'web_acl_name_cache': web_acl_name_cache,
+        'rate_limiter': create_rate_limiter(args.rate_limit, args.max_rate_limit, max_attempts=args.max_attempts, retry_budget=args.retry_budget),
+        'api_metrics': create_api_metrics()
+    }
+
+    if args.cloudtrail_dir:
+        scan_options['cloudtrail_source'] = { 'dirpath': os.path.expanduser(args.cloudtrail_dir) }
+    elif args.cloudtrail_s3:
+        scan_options['cloudtrail_source'] = { 's3_uri': args.cloudtrail_s3, 's3_client': create_session(args.cloudtrail_profile).client('s3') }
+
+    if args.config_aggregator:
+        aggregator_profile_info = next((profile_info for profile_info in read_profiles_from_csv(input_csv_filepath) if profile_info['profile_name'] == args.config_aggregator_profile), None)
+        if aggregator_profile_info is None:
+            parser.error(f'profile not found in the input file: {args.config_aggregator_profile}')
+
+        try:
+            aggregator_session = create_session_with_credentials(args.config_aggregator_profile)
+            config_client = create_client(aggregator_session, 'config', aggregator_profile_info, scan_options, args.config_aggregator_region)
+            scan_options['inventory'] = load_config_inventory(config_client, args.config_aggregator, args.services)
+            recorded_account_ids = { account_id for account_id, region_name, resource_type in scan_options['inventory']['covered'] }
+            print(f'Config aggregator {args.config_aggregator}: {len(recorded_account_ids)} accounts recorded')
+        except Exception as error:
+            print(f'Failed to read the Config aggregator, scanning every account directly: {error}')
+
+    output_csv_filepaths = { 'elb': elb_csv_filepath, 'cloudfront': cloudfront_csv_filepath, 'apigw': apigw_csv_filepath }
+    waf_coverage = scan_waf_coverage_for_profiles_from_csv(input_csv_filepath, output_csv_filepaths, args.max_workers, scan_options, checkpoint_dirpath, args.resume, args.max_age, args.credential_workers, sqlite_filepath, args.shard)
+    save_web_acl_name_cache(web_acl_name_cache, web_acl_cache_filepath)
+    write_manifest(manifest_filepath, input_csv_filepath, output_csv_filepaths, scan_options, args.shard, waf_coverage)
+
+    if waf_coverage['failed']:
+        print(f"Failed to scan {len(waf_coverage['failed'])} profile(s):")
+        for failed_profile in waf_coverage['failed']:
+            print(f"  {failed_profile['profile_name']} ({failed_profile['account_id']}): {failed_profile['error']}")
+
+    print(f"WebACL name cache: {web_acl_name_cache['hits']} hits, {web_acl_name_cache['misses']} misses")
+
+    rate_limiter = scan_options['rate_limiter']
+    print(f"Retries: {rate_limiter['retries']} of {rate_limiter['retry_budget']}")
+    for api_name, throttle_count in sorted(rate_limiter['throttles'].items()):
+        print(f"  Throttled {api_name}: {throttle_count}")
+
+    api_metrics_report = generate_api_metrics_report(scan_options['api_metrics'])
+    save_api_metrics_report(api_metrics_report, metrics_filepath)
+    if args.prometheus_file:
+        save_api_metrics_prometheus(api_metrics_report, os.path.expanduser(args.prometheus_file))
+    print_api_metrics_summary(api_metrics_report)
 
 
 if __name__ == '__main__':
-    waf_coverage = scan_waf_coverage_for_profiles_from_csv(input_csv_filepath)
-
-    if waf_coverage['elb']:
-        with open(elb_csv_filepath, mode='w', newline='') as file:
-            fieldnames = waf_coverage['elb'][0].keys()
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(waf_coverage['elb'])
-
-    if waf_coverage['cloudfront']:
-        with open(cloudfront_csv_filepath, mode='w', newline='') as file:
-            fieldnames = waf_coverage['cloudfront'][0].keys()
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(waf_coverage['cloudfront'])
-
-    if waf_coverage['apigw']:
-        with open(apigw_csv_filepath, mode='w', newline='') as file:
-            fieldnames = waf_coverage['apigw'][0].keys()
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(waf_coverage['apigw'])
+    main()
@@ -0,0 +1,155 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+
+from scripts_common import SERVICES, load_script
+
+parser = argparse.ArgumentParser(description='Merge the outputs of sharded waf-coverage-get-info.py runs.')
+parser.add_argument('--manifests', nargs='+', required=True, help='Manifest files written by each shard.')
+parser.add_argument('--input-file', default='workspace/aws-profiles.csv', help='Profiles CSV file the shards were scanned from. Default is aws-profiles.csv.')
+parser.add_argument('--output-file', default='workspace/waf-coverage.csv', help='Merged output CSV file. Default is waf-coverage.csv.')
+parser.add_argument('--allow-failed', action='store_true', help='Merge even if some profiles failed to scan in their shard.')
+
+
+def read_manifest(manifest_filepath):
+    with open(manifest_filepath, mode='r', encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    manifest_dirpath = os.path.dirname(os.path.abspath(manifest_filepath))
+    manifest['filepath'] = manifest_filepath
+    manifest['outputs'] = { service: os.path.join(manifest_dirpath, output_filepath) for service, output_filepath in manifest['outputs'].items() }
+    return manifest
+
+
+def get_profile_key(profile_info):
+    return profile_info['account_id'], profile_info['profile_name']
+
+
+def validate_manifests(scanner, manifests, csv_filepath, allow_failed=False):
+    errors = []
+    profiles = scanner.read_profiles_from_csv(csv_filepath)
+    with open(csv_filepath, mode='rb') as file:
+        profiles_digest = hashlib.sha256(file.read()).hexdigest()
+
+    shard_counts = { manifest['shard'][1] for manifest in manifests }
+    if len(shard_counts) > 1:
+        return [f"shards disagree on the number of shards: {', '.join(map(str, sorted(shard_counts)))}"]
+    shard_count = shard_counts.pop()
+
+    shard_indexes = Counter(manifest['shard'][0] for manifest in manifests)
+    for shard_index in range(1, shard_count + 1):
+        if shard_indexes[shard_index] == 0:
+            errors.append(f'missing shard {shard_index}/{shard_count}')
+        elif shard_indexes[shard_index] > 1:
+            errors.append(f'shard {shard_index}/{shard_count} was given {shard_indexes[shard_index]} times')
+
+    for manifest in manifests:
+        if manifest['profiles_digest'] != profiles_digest:
+            errors.append(f"{manifest['filepath']} was scanned from a different profiles file")
+        if manifest['services'] != manifests[0]['services']:
+            errors.append(f"{manifest['filepath']} scanned {','.join(manifest['services'])} instead of {','.join(manifests[0]['services'])}")
+
+    # Every profile must be scanned exactly once, and by the shard its account hashes to
+    scanned_profiles = Counter()
+    failed_profiles = set()
+    for manifest in manifests:
+        for profile_info in manifest['scanned'] + manifest['failed']:
+            profile_shard = scanner.get_profile_shard(profile_info, shard_count)
+            if profile_shard != manifest['shard'][0]:
+                errors.append(f"{profile_info['profile_name']} was scanned by shard {manifest['shard'][0]} but belongs to shard {profile_shard}")
+
+        scanned_profiles.update(get_profile_key(profile_info) for profile_info in manifest['scanned'])
+        failed_profiles.update(get_profile_key(profile_info) for profile_info in manifest['failed'])
+
+    profile_keys = { get_profile_key(profile_info) for profile_info in profiles }
+    for profile_info in profiles:
+        profile_key = get_profile_key(profile_info)
+        if scanned_profiles[profile_key] > 1:
+            errors.append(f"{profile_info['profile_name']} was scanned {scanned_profiles[profile_key]} times")
+        elif profile_key in failed_profiles and not allow_failed:
+            errors.append(f"{profile_info['profile_name']} failed to scan")
+        elif scanned_profiles[profile_key] == 0 and profile_key not in failed_profiles:
+            errors.append(f"{profile_info['profile_name']} was not scanned by any shard")
+
+    for account_id, profile_name in sorted((set(scanned_profiles) | failed_profiles) - profile_keys):
+        errors.append(f'{profile_name} ({account_id}) is not in {csv_filepath}')
+
+    return errors
+
+
+def merge_shard_outputs(scanner, manifests, csv_filepath, output_csv_filepaths):
+    profiles = scanner.read_profiles_from_csv(csv_filepath)
+    row_counts = {}
+
+    for service in output_csv_filepaths:
+        fieldnames = scanner.FIELDNAMES[service]
+        if service not in manifests[0]['services']:
+            # Like an unsharded run, the services that were not scanned get a file with only the header
+            with open(output_csv_filepaths[service], mode='w', newline='', encoding='utf-8') as file:
+                csv.writer(file).writerow(fieldnames)
+            continue
+
+        account_id_index = fieldnames.index('account_id')
+        profile_name_index = fieldnames.index('profile_name')
+
+        rows_by_profile = defaultdict(list)
+        seen_rows = set()
+        for manifest in manifests:
+            with open(manifest['outputs'][service], mode='r', newline='', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                if next(reader) != fieldnames:
+                    raise ValueError(f"unexpected header in {manifest['outputs'][service]}")
+
+                for row in reader:
+                    row_key = tuple(row)
+                    if row_key in seen_rows:
+                        continue
+                    seen_rows.add(row_key)
+                    rows_by_profile[(row[account_id_index], row[profile_name_index])].append(row)
+
+        # Rows are written in the order of the profiles file, like a single unsharded run
+        with open(output_csv_filepaths[service], mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(fieldnames)
+            for profile_info in profiles:
+                writer.writerows(rows_by_profile.pop(get_profile_key(profile_info), []))
+
+        row_counts[service] = len(seen_rows)
+
+    return row_counts
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    input_csv_filepath = os.path.expanduser(args.input_file)
+    output_file_path, output_file_extension = os.path.splitext(args.output_file)
+    output_csv_filepaths = {
+        service: os.path.expanduser(f'{output_file_path}-for-{service}{output_file_extension}')
+        for service in SERVICES
+    }
+
+    scanner = load_script('waf-coverage-get-info.py')
+    manifests = [read_manifest(os.path.expanduser(manifest_filepath)) for manifest_filepath in args.manifests]
+
+    errors = validate_manifests(scanner, manifests, input_csv_filepath, args.allow_failed)
+    if errors:
+        for error in errors:
+            print(f'Invalid shards: {error}')
+        sys.exit(1)
+
+    row_counts = merge_shard_outputs(scanner, manifests, input_csv_filepath, output_csv_filepaths)
+    for service, row_count in row_counts.items():
+        print(f'Merged {row_count} {service} rows into {output_csv_filepaths[service]}')
+
+    for manifest in manifests:
+        for failed_profile in manifest['failed']:
+            print(f"Failed to scan in shard {manifest['shard'][0]}: {failed_profile['profile_name']} ({failed_profile['account_id']}): {failed_profile['error']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+from scripts_common import SERVICES, add_group_by_argument, add_scan_arguments, load_script, validate_group_by, validate_services
+
+parser = argparse.ArgumentParser(description='Serve the WAF coverage over HTTP and refresh it in the background.')
+add_scan_arguments(parser, 'each batch')
+add_group_by_argument(parser)
+parser.add_argument('--output-file', default='workspace/waf-coverage.csv', help='Output CSV file, rewritten after every refresh. Default is waf-coverage.csv.')
+parser.add_argument('--host', default='127.0.0.1', help='Address the HTTP API listens on. Default is 127.0.0.1.')
+parser.add_argument('--port', type=int, default=8080, help='Port the HTTP API listens on. Default is 8080.')
+parser.add_argument('--refresh-interval', type=int, default=3600, help='Seconds in which every account is refreshed once. Default is 3600.')
+parser.add_argument('--refresh-batches', type=int, default=12, help='Number of batches the accounts are split in, refreshed one after the other over the refresh interval. Default is 12.')
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp is not None else None
+
+
+def create_coverage_state():
+    return {
+        'profiles': {},
+        'rows': { service: {} for service in SERVICES },
+        'snapshot': None,
+        'refreshing': None,
+        'started_at': time.time(),
+        'lock': threading.Lock()
+    }
+
+
+def refresh_profiles(scanner, state, daemon_options, shard=None, resume=False):
+    # The retry budget and the rate limiter are per batch, otherwise a long-running daemon would eventually run out of retries
+    scan_options = {
+        **daemon_options['scan_options'],
+        'rate_limiter': scanner.create_rate_limiter(**daemon_options['rate_limiter_options'])
+    }
+    batch_csv_filepaths = daemon_options['batch_csv_filepaths']
+    max_age = daemon_options['refresh_interval'] if resume else None
+
+    state['refreshing'] = { 'shard': list(shard or (1, 1)), 'started_at': time.time() }
+    try:
+        waf_coverage = scanner.scan_waf_coverage_for_profiles_from_csv(
+            daemon_options['input_csv_filepath'], batch_csv_filepaths, daemon_options['max_workers'], scan_options,
+            daemon_options['checkpoint_dirpath'], resume, max_age, shard=shard
+        )
+        scanner.save_web_acl_name_cache(scan_options['web_acl_name_cache'], daemon_options['web_acl_cache_filepath'])
+    finally:
+        state['refreshing'] = None
+
+    rows_by_profile = { service: defaultdict(list) for service in scan_options['services'] }
+    for service in scan_options['services']:
+        profile_name_index = scanner.FIELDNAMES[service].index('profile_name')
+        with open(batch_csv_filepaths[service], mode='r', newline='', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            next(reader)
+            for row in reader:
+                rows_by_profile[service][row[profile_name_index]].append(row)
+
+    # Accounts that failed keep their previous rows, and the health endpoint reports them until they are scanned again
+    for profile_info in waf_coverage['scanned']:
+        checkpoint_header = scanner.read_checkpoint_header(scanner.get_checkpoint_filepath(daemon_options['checkpoint_dirpath'], profile_info))
+        for service in scan_options['services']:
+            state['rows'][service][profile_info['profile_name']] = rows_by_profile[service].pop(profile_info['profile_name'], [])
+        state['profiles'][profile_info['profile_name']] = { 'refreshed_at': checkpoint_header['scanned_at'], 'error': None }
+
+    for failed_profile in waf_coverage['failed']:
+        profile_state = state['profiles'].setdefault(failed_profile['profile_name'], { 'refreshed_at': None })
+        profile_state['error'] = failed_profile['error']
+
+    return waf_coverage
+
+
+def write_output_csvs(scanner, state, profiles, output_csv_filepaths):
+    # The files are replaced at once, so a consumer reading them never sees half of a refresh
+    for service in SERVICES:
+        with open(f'{output_csv_filepaths[service]}.tmp', mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(scanner.FIELDNAMES[service])
+            for profile_info in profiles:
+                writer.writerows(state['rows'][service].get(profile_info['profile_name'], []))
+        os.replace(f'{output_csv_filepaths[service]}.tmp', output_csv_filepaths[service])
+
+
+def calculate_coverage(calculator, output_csv_filepaths, group_by):
+    resources = {
+        'cloudfront': calculator.count_cloudfront_with_waf(output_csv_filepaths['cloudfront'], group_by),
+        'elb': calculator.count_elb_with_waf(output_csv_filepaths['elb'], group_by),
+        'apigw': calculator.count_apigw_with_waf(output_csv_filepaths['apigw'], group_by)
+    }
+    resources['summarized'] = calculator.summarize_waf_info(resources['cloudfront'], resources['elb'], resources['apigw'])
+    coverage = { service: calculator.calculate_waf_coverage(service_resources) for service, service_resources in resources.items() }
+
+    table = calculator.format_coverage_table(resources['summarized'], coverage['cloudfront'], coverage['elb'], coverage['apigw'], coverage['summarized'], group_by)
+    groups = [
+        {
+            **dict(zip(group_by, group_key)),
+            **{
+                service: {
+                    'total': resources[service]['total_resources'].get(group_key, 0),
+                    'waf': resources[service]['waf_resources'].get(group_key, 0),
+                    'coverage': coverage[service].get(group_key, 'N/A')
+                }
+                for service in resources
+            }
+        }
+        for group_key in resources['summarized']['total_resources']
+    ]
+    return { 'groups': groups, 'table': table }
+
+
+def generate_account_details(scanner, state, profiles, account_coverage):
+    coverage_by_account_id = { group['account_id']: group for group in account_coverage['groups'] }
+    accounts = defaultdict(lambda: { 'profiles': [], 'resources': { service: [] for service in SERVICES } })
+
+    for profile_info in profiles:
+        account = accounts[profile_info['account_id']]
+        profile_state = state['profiles'].get(profile_info['profile_name'], { 'refreshed_at': None, 'error': None })
+        account['account_id'] = profile_info['account_id']
+        account['profiles'].append({
+            **profile_info,
+            'refreshed_at': format_time(profile_state['refreshed_at']),
+            'error': profile_state['error']
+        })
+        for service in SERVICES:
+            fieldnames = scanner.FIELDNAMES[service]
+            account['resources'][service].extend(dict(zip(fieldnames, row)) for row in state['rows'][service].get(profile_info['profile_name'], []))
+
+    for account_id, account in accounts.items():
+        account['coverage'] = { key: value for key, value in coverage_by_account_id.get(account_id, {}).items() if key != 'account_id' }
+
+    return accounts
+
+
+def publish_coverage(scanner, calculator, state, daemon_options):
+    profiles = scanner.read_profiles_from_csv(daemon_options['input_csv_filepath'])
+    write_output_csvs(scanner, state, profiles, daemon_options['output_csv_filepaths'])
+
+    generated_at = time.time()
+    coverage = calculate_coverage(calculator, daemon_options['output_csv_filepaths'], daemon_options['group_by'])
+    account_coverage = calculate_coverage(calculator, daemon_options['output_csv_filepaths'], ['account_id'])
+    accounts = generate_account_details(scanner, state, profiles, account_coverage)
+
+    # Every response is rendered here, so the HTTP handlers only pick a prepared body and never touch AWS or the CSV files
+    account_index = [
+        { 'account_id': account_id, 'profiles': [profile['profile_name'] for profile in account['profiles']], 'coverage': account['coverage'].get('summarized') }
+        for account_id, account in accounts.items()
+    ]
+    snapshot = {
+        'generated_at': generated_at,
+        'profiles': { profile_info['profile_name']: state['profiles'].get(profile_info['profile_name'], { 'refreshed_at': None, 'error': None }) for profile_info in profiles },
+        'coverage': json.dumps({ 'generated_at': format_time(generated_at), 'group_by': daemon_options['group_by'], 'groups': coverage['groups'] }).encode('utf-8'),
+        'coverage_table': (coverage['table'] + '\n').encode('utf-8'),
+        'accounts': json.dumps({ 'generated_at': format_time(generated_at), 'accounts': account_index }).encode('utf-8'),
+        'account_details': { account_id: json.dumps({ 'generated_at': format_time(generated_at), **account }).encode('utf-8') for account_id, account in accounts.items() }
+    }
+    with state['lock']:
+        state['snapshot'] = snapshot
+
+
+def generate_health(state, refresh_interval):
+    with state['lock']:
+        snapshot = state['snapshot']
+
+    now = time.time()
+    if snapshot is None:
+        return 503, { 'status': 'starting', 'started_at': format_time(state['started_at']), 'refreshing': state['refreshing'] }
+
+    # An account is stale once it missed a whole refresh cycle, which usually means its scans keep failing
+    refreshed_ats = [profile_state['refreshed_at'] for profile_state in snapshot['profiles'].values()]
+    stale_profiles = [
+        profile_name for profile_name, profile_state in snapshot['profiles'].items()
+        if profile_state['refreshed_at'] is None or now - profile_state['refreshed_at'] > 2 * refresh_interval
+    ]
+    failed_profiles = [
+        { 'profile_name': profile_name, 'error': profile_state['error'] }
+        for profile_name, profile_state in snapshot['profiles'].items() if profile_state['error']
+    ]
+    oldest_refreshed_at = min((refreshed_at for refreshed_at in refreshed_ats if refreshed_at is not None), default=None)
+
+    status = 'stale' if stale_profiles else 'degraded' if failed_profiles else 'ok'
+    return 503 if status == 'stale' else 200, {
+        'status': status,
+        'generated_at': format_time(snapshot['generated_at']),
+        'oldest_refreshed_at': format_time(oldest_refreshed_at),
+        'oldest_refresh_age': round(now - oldest_refreshed_at) if oldest_refreshed_at is not None else None,
+        'refreshing': state['refreshing'],
+        'profiles': len(snapshot['profiles']),
+        'stale_profiles': stale_profiles,
+        'failed_profiles': failed_profiles
+    }
+
+
+def run_refresh_loop(scanner, calculator, state, daemon_options, stop_event):
+    # The first pass reuses the checkpoints scanned within the refresh interval, so a restart serves data without scanning every account again
+    try:
+        refresh_profiles(scanner, state, daemon_options, resume=True)
+        publish_coverage(scanner, calculator, state, daemon_options)
+    except Exception as error:
+        print(f'Failed to load the coverage: {error}')
+
+    batch_count = daemon_options['refresh_batches']
+    batch_interval = daemon_options['refresh_interval'] / batch_count
+    batch_index = 0
+    next_refresh_at = time.monotonic() + batch_interval
+
+    while not stop_event.wait(max(0, next_refresh_at - time.monotonic())):
+        batch_index = batch_index % batch_count + 1
+        next_refresh_at += batch_interval
+
+        try:
+            waf_coverage = refresh_profiles(scanner, state, daemon_options, shard=(batch_index, batch_count))
+            publish_coverage(scanner, calculator, state, daemon_options)
+            print(f"Refreshed batch {batch_index}/{batch_count}: {len(waf_coverage['scanned'])} profiles, {len(waf_coverage['failed'])} failed")
+        except Exception as error:
+            print(f'Failed to refresh batch {batch_index}/{batch_count}: {error}')
+
+        # A batch slower than its slot delays the next one instead of starting a burst of batches to catch up
+        next_refresh_at = max(next_refresh_at, time.monotonic())
+
+
+class CoverageRequestHandler(BaseHTTPRequestHandler):
+    def send_body(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload):
+        self.send_body(status, json.dumps(payload).encode('utf-8'))
+
+    def do_GET(self):
+        state = self.server.coverage_state
+        path = urlsplit(self.path).path.rstrip('/')
+
+        if path == '/health':
+            self.send_json(*generate_health(state, self.server.refresh_interval))
+            return
+
+        with state['lock']:
+            snapshot = state['snapshot']
+
+        if snapshot is None:
+            self.send_json(503, { 'error': 'the first refresh has not finished yet' })
+        elif path == '/coverage':
+            self.send_body(200, snapshot['coverage'])
+        elif path == '/coverage.txt':
+            self.send_body(200, snapshot['coverage_table'], 'text/plain; charset=utf-8')
+        elif path == '/accounts':
+            self.send_body(200, snapshot['accounts'])
+        elif path.startswith('/accounts/') and unquote(path[len('/accounts/'):]) in snapshot['account_details']:
+            self.send_body(200, snapshot['account_details'][unquote(path[len('/accounts/'):])])
+        else:
+            self.send_json(404, { 'error': f'not found: {path}' })
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    validate_services(parser, args.services)
+    validate_group_by(parser, args.group_by)
+
+    if args.refresh_batches < 1 or args.refresh_interval < 1:
+        parser.error('--refresh-interval and --refresh-batches must be positive')
+
+    scanner = load_script('waf-coverage-get-info.py')
+    calculator = load_script('waf-coverage-calculate.py')
+
+    output_file_path, output_file_extension = os.path.splitext(args.output_file)
+    web_acl_cache_filepath = os.path.expanduser(args.web_acl_cache_file)
+    daemon_options = {
+        'input_csv_filepath': os.path.expanduser(args.input_file),
+        'output_csv_filepaths': { service: os.path.expanduser(f'{output_file_path}-for-{service}{output_file_extension}') for service in SERVICES },
+        'batch_csv_filepaths': { service: os.path.expanduser(f'{output_file_path}-batch-for-{service}{output_file_extension}') for service in SERVICES },
+        'checkpoint_dirpath': os.path.expanduser(args.checkpoint_dir or f'{output_file_path}-checkpoints'),
+        'web_acl_cache_filepath': web_acl_cache_filepath,
+        'refresh_interval': args.refresh_interval,
+        'refresh_batches': args.refresh_batches,
+        'group_by': args.group_by,
+        'max_workers': args.max_workers,
+        'rate_limiter_options': { 'initial_rate': args.rate_limit, 'max_rate': args.max_rate_limit, 'max_attempts': args.max_attempts, 'retry_budget': args.retry_budget },
+        'scan_options': {
+            'use_waf_index': args.waf_index,
+            'max_resource_workers': args.max_resource_workers,
+            'regions': args.regions,
+            'services': args.services,
+            'web_acl_name_cache': scanner.load_web_acl_name_cache(web_acl_cache_filepath)
+        }
+    }
+
+    state = create_coverage_state()
+    stop_event = threading.Event()
+    refresh_thread = threading.Thread(target=run_refresh_loop, args=(scanner, calculator, state, daemon_options, stop_event), daemon=True)
+    refresh_thread.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), CoverageRequestHandler)
+    server.coverage_state = state
+    server.refresh_interval = args.refresh_interval
+    print(f'Serving the WAF coverage on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()